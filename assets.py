@@ -0,0 +1,147 @@
+"""Precompiled frontend bundle: build it, and serve it with long-lived caching.
+
+    python assets.py            # compile static/js/*.jsx into static/dist
+
+The JSX files are concatenated in load order (they share one global scope,
+like the <script> tags they replace), then compiled and minified by esbuild
+into one app.<hash>.js, written next to .gz and, when the brotli package is
+installed, .br variants. manifest.json maps app.js to the current file.
+
+The name changes whenever the content does, so /assets responses are cached
+as immutable for a year, and send_asset picks the precompressed variant the
+browser accepts. Without a build root.html falls back to compiling the JSX
+in the browser."""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shlex
+import subprocess
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+JS_DIR = os.path.join(HERE, 'static', 'js')
+DIST_DIR = os.path.join(HERE, 'static', 'dist')
+
+# load order: later files use components defined by earlier ones
+JSX_FILES = ['userAuth.jsx', 'foodForThoughts.jsx', 'missingIngredients.jsx',
+             'recipeButtons.jsx', 'recipe_info.jsx', 'root.jsx']
+
+ESBUILD = os.environ.get('ESBUILD', 'npx --yes esbuild@0.19.12')
+
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+# (file suffix, Content-Encoding), smallest first
+ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')]
+
+
+# ***** Build *****
+
+def esbuild(source):
+    """Return JSX source compiled to minified JavaScript by esbuild."""
+
+    command = shlex.split(ESBUILD) + ['--loader=jsx', '--minify', '--format=iife', '--target=es2017']
+    return subprocess.run(command, input=source, stdout=subprocess.PIPE, check=True).stdout
+
+
+def build(compile=esbuild, js_dir=None, dist_dir=None):
+    """Compile the JSX into a hashed bundle with precompressed variants. Return the bundle's file name.
+
+    Older bundles are kept, for pages loaded before a deploy."""
+
+    js_dir = js_dir or JS_DIR
+    dist_dir = dist_dir or DIST_DIR
+
+    sources = []
+    for filename in JSX_FILES:
+        with open(os.path.join(js_dir, filename), 'rb') as file:
+            sources.append(file.read())
+    bundle = compile(b'\n;\n'.join(sources))
+
+    name = f'app.{hashlib.sha256(bundle).hexdigest()[:12]}.js'
+    path = os.path.join(dist_dir, name)
+    os.makedirs(dist_dir, exist_ok=True)
+    _write(path, bundle)
+    # mtime=0 so the same bundle always compresses to the same bytes
+    _write(path + '.gz', gzip.compress(bundle, compresslevel=9, mtime=0))
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(bundle, quality=11))
+
+    # manifest last, so servers never point at a half-written bundle
+    _write(os.path.join(dist_dir, 'manifest.json'), json.dumps({'app.js': name}).encode())
+    return name
+
+
+def _write(path, data):
+    # write then rename, so a running server never reads a partial file
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+
+
+# ***** Serve *****
+
+# ((path, mtime), manifest), reread when a build replaces it
+_manifest = (None, {})
+
+
+def bundle_url(dist_dir=None):
+    """Return URL of the built bundle, or None when it hasn't been built."""
+
+    global _manifest
+
+    path = os.path.join(dist_dir or DIST_DIR, 'manifest.json')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if _manifest[0] != (path, mtime):
+        with open(path) as file:
+            _manifest = ((path, mtime), json.load(file))
+
+    name = _manifest[1].get('app.js')
+    return f'/assets/{name}' if name else None
+
+
+def send_asset(filename, dist_dir=None):
+    """Return response for a built file, precompressed when the browser accepts it."""
+
+    path = safe_join(dist_dir or DIST_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    encoding = None
+    for suffix, name in ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            path += suffix
+            encoding = name
+            break
+
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                         conditional=True, cache_timeout=CACHE_SECONDS)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+
+    name = build()
+    print(f'built static/dist/{name}' + ('' if brotli else ' (pip install brotli for .br)'))
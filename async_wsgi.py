@@ -0,0 +1,61 @@
+"""Serve the app on gevent, so requests waiting on upstream APIs don't each hold a worker.
+
+    python async_wsgi.py --port 5000
+    gunicorn -k gevent --worker-connections 1000 -w 2 async_wsgi:app
+
+Flask 1.1 views are synchronous, so instead of async views this runs every
+request in a greenlet and makes blocking I/O cooperative: sockets (requests,
+so the Spoonacular and Twilio clients), locks, sleeps and threads are
+monkey-patched, and psycogreen does the same for psycopg2. While a request
+waits on Spoonacular the process serves other requests, so one process
+handles hundreds of concurrent searches. Routes run unchanged.
+
+The db pool (DB_POOL_SIZE + DB_MAX_OVERFLOW) still limits how many requests
+use the database at once, and SPOONACULAR_POOL_SIZE how many keep-alive
+connections to Spoonacular are reused."""
+
+# must run before anything imports socket, ssl or threading
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    patch_psycopg = None
+
+import argparse
+import logging
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from model import connect_to_db
+from server import app, INGREDIENTS
+
+
+if patch_psycopg is not None:
+    try:
+        # wait for postgres in the hub instead of blocking the whole process
+        patch_psycopg()
+    except ImportError:
+        # psycopg2 not installed (sqlite)
+        pass
+
+connect_to_db(app)
+with app.app_context():
+    INGREDIENTS.load()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max-connections', type=int, default=int(os.environ.get('GEVENT_MAX_CONNECTIONS', 1000)),
+                        help='requests handled at once')
+    args = parser.parse_args()
+
+    # under gunicorn its own logging config applies
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'))
+    print(f'Serving on http://{args.host}:{args.port} with gevent')
+    WSGIServer((args.host, args.port), app, spawn=Pool(args.max_connections), log=None).serve_forever()
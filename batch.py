@@ -0,0 +1,158 @@
+"""Run several API calls in one request and one database transaction.
+
+POST /api/batch takes a list of operations:
+
+    {"operations": [
+        {"id": "search", "method": "POST", "path": "/api/search_results", "body": {"ingredients": "egg"}},
+        {"method": "POST", "path": "/api/check_results", "body": {"results_list": {"$ref": "search"}}}]}
+
+and returns each operation's status and body in order. {"$ref": "id"}
+anywhere in a body is replaced by the body of the earlier operation with that
+id, and {"$ref": "id.key"} by one of its keys. Operations share the browser
+session, flask.g and db.session; crud commits only flush while a batch runs,
+and the batch commits once at the end, or rolls back everything if an
+operation raises.
+
+A malformed batch (operations that aren't objects, a path outside /api/,
+a $ref to nothing) fails with a 400 before anything more runs; an exception
+raised by a view fails it with a 500. Either way nothing is saved. Views
+defer updates of process-wide caches with after_commit, so a rolled back
+batch leaves them untouched.
+
+Operations run through app.dispatch_request, without before/after request
+hooks, so /metrics counts a batch as one /api/batch request."""
+
+import json
+
+from flask import g, has_app_context, session
+from werkzeug.exceptions import HTTPException
+
+import serializers
+from model import db
+
+
+MAX_OPERATIONS = 20
+
+
+class BatchError(Exception):
+    """Batch request or one of its operations is malformed."""
+
+
+def in_batch():
+    """Return True while running the operations of a batch."""
+
+    return has_app_context() and g.get('in_batch', False)
+
+
+def after_commit(callback):
+    """Call callback once the running batch commits, or right away outside a batch.
+
+    For process-wide caches (recipe_cache, search_index, saved_index), which
+    mustn't see writes a batch may still roll back."""
+
+    if in_batch():
+        g.batch_after_commit.append(callback)
+    else:
+        callback()
+
+
+def run(app, operations):
+    """Run operations, commit them, and return list of result dictionaries.
+
+    Results have id, status and body (RawJSON when the operation returned
+    JSON). If an operation raises, the transaction is rolled back and the
+    exception propagates."""
+
+    if not isinstance(operations, list) or not operations:
+        raise BatchError('operations must be a non-empty list')
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError(f'at most {MAX_OPERATIONS} operations per batch')
+
+    results = []
+    # id -> result, for $ref
+    by_id = {}
+
+    g.in_batch = True
+    g.batch_after_commit = []
+    try:
+        for i, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                raise BatchError(f'operation {i} must be an object')
+            path = operation.get('path')
+            if not isinstance(path, str) or not path.startswith('/api/') or path.startswith('/api/batch'):
+                raise BatchError(f'can\'t batch {path!r}')
+            method = operation.get('method', 'GET' if operation.get('body') is None else 'POST')
+            if not isinstance(method, str):
+                raise BatchError(f'operation {i} method must be a string')
+
+            body = _resolve_refs(operation.get('body'), by_id)
+
+            result = {'id': operation.get('id')}
+            result['status'], result['body'] = _dispatch(app, method.upper(), path, body)
+            results.append(result)
+            if result['id'] is not None:
+                by_id[result['id']] = result
+
+        db.session.commit()
+        callbacks = g.batch_after_commit
+
+    except Exception:
+        db.session.rollback()
+        raise
+
+    finally:
+        g.in_batch = False
+        g.batch_after_commit = []
+
+    for callback in callbacks:
+        callback()
+
+    return results
+
+
+def _dispatch(app, method, path, body):
+    """Run one operation's view in its own request context. Return (status, body)."""
+
+    ctx = app.test_request_context(path, method=method, json=body)
+    # share the batch request's browser session, so a login or logout carries over
+    ctx.session = session._get_current_object()
+
+    with ctx:
+        try:
+            response = app.make_response(app.dispatch_request())
+        except HTTPException as error:
+            response = error.get_response()
+        # read streamed bodies while their request context is still pushed
+        data = response.get_data()
+
+    if response.is_json:
+        return response.status_code, serializers.RawJSON(data)
+    return response.status_code, data.decode()
+
+
+def _resolve_refs(value, by_id):
+    """Return value with {"$ref": "id.key..."} replaced by earlier results' bodies."""
+
+    if isinstance(value, dict):
+        if set(value) == {'$ref'}:
+            return _lookup(value['$ref'], by_id)
+        return {key: _resolve_refs(item, by_id) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve_refs(item, by_id) for item in value]
+    return value
+
+
+def _lookup(ref, by_id):
+    operation_id, *keys = ref.split('.')
+    if operation_id not in by_id:
+        raise BatchError(f'$ref to unknown operation {operation_id!r}')
+
+    value = by_id[operation_id]['body']
+    if isinstance(value, serializers.RawJSON):
+        value = json.loads(value)
+    for key in keys:
+        try:
+            value = value[int(key) if isinstance(value, list) else key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise BatchError(f'$ref {ref!r} not found')
+    return value
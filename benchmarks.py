@@ -0,0 +1,759 @@
+"""Benchmarks, run offline against a local sqlite db and fake upstreams.
+
+    python benchmarks.py routes --rows 100000 --save-baseline baseline.json
+    python benchmarks.py routes --rows 100000 --compare baseline.json
+    python benchmarks.py queries --calls 5000
+    python benchmarks.py serializers --recipes 200
+    python benchmarks.py message_queue --messages 2000 --workers 4
+    python benchmarks.py resolver --tokens 20000
+    python benchmarks.py concurrency --concurrency 200 --delay 0.2
+    python benchmarks.py compression --library 200"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# server reads api keys at import
+os.environ.setdefault('SPOONACULAR_KEY', 'bench-key')
+os.environ.setdefault('TWILIO_SID', 'bench-sid')
+os.environ.setdefault('TWILIO_TOKEN', 'bench-token')
+
+from sqlalchemy import event
+
+import server
+from server import app
+from model import connect_to_db, db, Outbound_Message, User, Saved_Recipe, Recipe, load_profile
+import compression
+import crud
+import helper_functions
+import message_queue
+import serializers
+import search_index
+import synthetic_data
+from spoonacular_stub import StubServer, fake_recipe
+from ingredient_index import load_csv_ingredients
+from ingredient_resolver import IngredientResolver
+
+
+def setup_db(db_uri=None):
+    """Connect app to a fresh db (temporary sqlite file by default) and create tables."""
+
+    if db_uri is None:
+        db_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+
+    connect_to_db(app, db_uri, echo=False)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+# ***** Routes *****
+
+class StatementCounter:
+    """Count SQL statements the engine runs."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def route_scenarios(users, recipes, saves_per_user):
+    """Return list of (name, method, path, json) request factories covering every route.
+
+    Each factory takes the request number and returns (method, path, json body)."""
+
+    # synthetic user i has user_id i
+    user_recipe_ids = [saved['recipe_id'] for saved in crud.get_saved_recipes(1)] or [1]
+    recipe_ids = itertools.cycle(user_recipe_ids)
+    results_list = [{'recipe_id': recipe_id} for recipe_id in range(1, 11)]
+    # generated recipes user 1 hasn't saved, for saves when --routes skips add_recipe
+    unsaved_recipe_ids = itertools.cycle(sorted(set(range(1, recipes + 1)) - set(user_recipe_ids)) or [1])
+    # recipes added during the run get ids past the generated ones
+    new_recipe_ids = itertools.count(recipes + 1)
+    added_recipe_ids = []
+    saved_recipe_ids = []
+
+    def bench_recipe(recipe_id):
+        return {'recipe_id': recipe_id, 'title': f'Bench recipe {recipe_id}', 'image': '',
+                'servings': 2, 'sourceUrl': '', 'cooking_mins': 10, 'prep_mins': 5, 'ready_mins': 15,
+                'ingredients': [{'ingredient_id': 11529, 'name': 'tomatoes', 'amount': 2, 'unit': ''},
+                                {'ingredient_id': 11282, 'name': 'onion', 'amount': 1, 'unit': ''}],
+                'instructions': ['Chop.', 'Cook.', 'Serve.'],
+                'equipment': {'pot': 'pot'}}
+
+    def new_recipe(i):
+        recipe_id = next(new_recipe_ids)
+        added_recipe_ids.append(recipe_id)
+        return 'POST', '/api/add_recipe', {'recipe_details': bench_recipe(recipe_id)}
+
+    def save_recipe(i):
+        recipe_id = added_recipe_ids[i % len(added_recipe_ids)] if added_recipe_ids else next(unsaved_recipe_ids)
+        saved_recipe_ids.append(recipe_id)
+        return 'POST', '/api/save_a_recipe', {'recipe_id': recipe_id}
+
+    def remove_recipe(i):
+        # what save_a_recipe saved, or the user's own saves when --routes skipped it
+        recipe_id = saved_recipe_ids.pop() if saved_recipe_ids else next(recipe_ids)
+        return 'POST', '/api/remove_recipe', {'recipe_id': recipe_id}
+
+    def add_and_save(i):
+        # the frontend's save button: add the recipe, then save it, in one round trip
+        recipe_id = next(new_recipe_ids)
+        return 'POST', '/api/batch', {'operations': [
+            {'path': '/api/add_recipe', 'body': {'recipe_details': bench_recipe(recipe_id)}},
+            {'path': '/api/save_a_recipe', 'body': {'recipe_id': recipe_id}}]}
+
+    def search_page(i):
+        # a page of search results: half already in the catalog, half new
+        page = [bench_recipe(recipe_id) for recipe_id in range(i * 5 + 1, i * 5 + 6)]
+        page += [bench_recipe(next(new_recipe_ids)) for _ in range(5)]
+        return 'POST', '/api/save_recipes', {'recipe_details': page}
+
+    searches = itertools.cycle(['tomatoes, onion', 'milk, butter, flour', 'chiken breast, garlik',
+                                'rice, soy sauce', 'potatoes, cheddar'])
+    message_ids = []
+
+    def shopping_list(i):
+        return 'POST', '/api/shopping-list', {'shopping_list': {'2 cup milk': 1, '1 onion': 1},
+                                              'recipe_title': 'Bench recipe'}
+
+    return [
+        ('GET /', lambda i: ('GET', '/', None)),
+        ('POST /api/create_account', lambda i: ('POST', '/api/create_account',
+                                                {'email': f'bench{i}-{time.time()}@example.com',
+                                                 'password': 'pw', 'phone': '5555550000'})),
+        ('POST /api/login', lambda i: ('POST', '/api/login', {'email': synthetic_data.user_email(1),
+                                                               'password': synthetic_data.PASSWORD})),
+        ('GET /api/check_session', lambda i: ('GET', '/api/check_session', None)),
+        ('POST /api/search_results', lambda i: ('POST', '/api/search_results', {'ingredients': next(searches)})),
+        ('GET /api/ingredients/autocomplete', lambda i: ('GET', '/api/ingredients/autocomplete?q=to', None)),
+        ('GET /api/search_cache_stats', lambda i: ('GET', '/api/search_cache_stats', None)),
+        ('POST /api/check_results', lambda i: ('POST', '/api/check_results', {'results_list': results_list})),
+        ('POST /api/add_recipe', new_recipe),
+        ('POST /api/save_a_recipe', save_recipe),
+        ('POST /api/batch', add_and_save),
+        ('POST /api/save_recipes', search_page),
+        ('POST /api/favorite_a_recipe', lambda i: ('POST', '/api/favorite_a_recipe', {'recipe_id': next(recipe_ids)})),
+        ('GET /api/saved_recipe_details/<id>', lambda i: ('GET', f'/api/saved_recipe_details/{next(recipe_ids)}', None)),
+        ('GET /api/saved_recipes', lambda i: ('GET', '/api/saved_recipes', None)),
+        ('GET /api/user_thoughts/<id>', lambda i: ('GET', f'/api/user_thoughts/{next(recipe_ids)}', None)),
+        ('POST /api/update_user_thoughts', lambda i: ('POST', '/api/update_user_thoughts',
+                                                      {'recipe_id': next(recipe_ids), 'rating': 4,
+                                                       'comment': 'Bench comment', 'tried': True})),
+        ('POST /api/shopping-list', shopping_list),
+        ('GET /api/shopping-list/<id>', lambda i: ('GET', '/api/shopping-list/1', None)),
+        ('POST /api/remove_recipe', remove_recipe),
+        ('GET /metrics', lambda i: ('GET', '/metrics', None)),
+        ('GET /api/logout', lambda i: ('GET', '/api/logout', None)),
+    ]
+
+
+def percentile(values, pct):
+    """Return pct percentile of values (nearest rank)."""
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def bench_routes(args):
+    """Drive every route with the Flask test client against synthetic data; report latency, SQL and memory."""
+
+    setup_db(args.db)
+    with app.app_context():
+        start = time.perf_counter()
+        users, recipes, saves_per_user = synthetic_data.generate(args.rows)
+        print(f'generated {users} users, {recipes} recipes, {saves_per_user} saves/user '
+              f'in {time.perf_counter() - start:.1f}s')
+
+    # no network: Spoonacular answered by the local stub, Twilio by the fake transport
+    stub = StubServer().start()
+    server.SPOONACULAR.base_url = stub.url
+    server.MESSAGE_WORKERS.transport = message_queue.FakeTransport()
+    search_index.index.rebuild_secs = float('inf')
+
+    counter = StatementCounter(db.get_engine(app))
+    client = app.test_client()
+
+    with app.app_context():
+        scenarios = route_scenarios(users, recipes, saves_per_user)
+    client.post('/api/login', json={'email': synthetic_data.user_email(1), 'password': synthetic_data.PASSWORD})
+
+    results = {}
+    for name, make_request in scenarios:
+        if args.routes and not any(route in name for route in args.routes):
+            continue
+
+        latencies, statements = [], []
+        for i in range(args.requests):
+            method, path, body = make_request(i)
+            counter.count = 0
+            start = time.perf_counter()
+            # routes print debug output, keep it out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                res = client.open(path, method=method, json=body)
+                res.get_data()
+            latencies.append(time.perf_counter() - start)
+            statements.append(counter.count)
+            if res.status_code >= 400:
+                print(f'{name}: status {res.status_code}', file=sys.stderr)
+
+        # memory measured separately, tracemalloc slows everything down
+        tracemalloc.start()
+        method, path, body = make_request(args.requests)
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.open(path, method=method, json=body).get_data()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # logout ends session, log back in for the routes after it
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.post('/api/login', json={'email': synthetic_data.user_email(1), 'password': synthetic_data.PASSWORD})
+
+        results[name] = {'p50_ms': percentile(latencies, 50) * 1000,
+                         'p95_ms': percentile(latencies, 95) * 1000,
+                         'p99_ms': percentile(latencies, 99) * 1000,
+                         'sql_per_request': statistics.mean(statements),
+                         'peak_kb': peak / 1024}
+
+    stub.stop()
+    server.MESSAGE_WORKERS.stop()
+
+    print(f'\n{"route":40} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"sql/req":>8} {"peak KB":>9}')
+    for name, result in results.items():
+        print(f'{name:40} {result["p50_ms"]:8.2f} {result["p95_ms"]:8.2f} {result["p99_ms"]:8.2f} '
+              f'{result["sql_per_request"]:8.1f} {result["peak_kb"]:9.0f}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump({'rows': args.rows, 'requests': args.requests, 'routes': results}, file, indent=2)
+        print(f'\nsaved baseline to {args.save_baseline}')
+
+    if args.compare:
+        if not compare_to_baseline(results, args.compare, args.tolerance):
+            sys.exit(1)
+
+
+def compare_to_baseline(results, path, tolerance):
+    """Print change of each metric against a saved baseline. Return False if any regressed."""
+
+    with open(path) as file:
+        baseline = json.load(file)['routes']
+
+    ok = True
+    print(f'\ncompared to {path} (regression = more than {tolerance:.0%} worse)')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes = []
+        for metric in ('p95_ms', 'sql_per_request', 'peak_kb'):
+            before, after = baseline[name][metric], result[metric]
+            change = (after - before) / before if before else 0
+            # sql counts are exact, any increase is a regression
+            limit = 0 if metric == 'sql_per_request' else tolerance
+            regressed = change > limit and after - before > 0.5
+            ok = ok and not regressed
+            changes.append(f'{metric} {change:+.0%}{" REGRESSED" if regressed else ""}')
+        print(f'{name:40} ' + ', '.join(changes))
+
+    return ok
+
+
+# ***** Query compilation *****
+
+# the same queries as crud's hot lookups, built and compiled on every call instead of baked
+
+def unbaked_get_login(email):
+    return db.session.query(User.user_id, User.password).filter(User.email == email).first()
+
+
+def unbaked_get_identity(user_id):
+    return db.session.query(User.user_id, User.email, User.phone).filter(User.user_id == user_id).first()
+
+
+def unbaked_get_data_version(user_id):
+    return db.session.query(User.data_version).filter(User.user_id == user_id).scalar()
+
+
+def unbaked_get_a_saved_recipe(recipe_id, user_id):
+    return (db.session.query(Saved_Recipe).options(*load_profile(Saved_Recipe, 'identity'))
+            .filter(Saved_Recipe.user_id == user_id, Saved_Recipe.recipe_id == recipe_id)
+            .first())
+
+
+def unbaked_quick_get_recipe(recipe_id):
+    return (db.session.query(Recipe).options(*load_profile(Recipe, 'identity'))
+            .filter(Recipe.recipe_id == recipe_id).first())
+
+
+def unbaked_favorite_a_recipe(recipe_id, user_id):
+    saved = (db.session.query(Saved_Recipe).options(*load_profile(Saved_Recipe, 'identity'))
+             .filter(Saved_Recipe.user_id == user_id, Saved_Recipe.recipe_id == recipe_id).first())
+    if saved is None or saved.favorite:
+        return
+    saved.favorite = True
+    crud._bump_data_version(user_id)
+    db.session.commit()
+
+
+def statements_run(func):
+    """Return list of SQL statements func() runs."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    db.session.expire_all()
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return statements
+
+
+def bench_queries(args):
+    """Time per-call cost of the hot crud lookups, unbaked (compiled each call) vs baked."""
+
+    setup_db(args.db)
+    with app.app_context():
+        synthetic_data.generate(args.rows)
+        email = synthetic_data.user_email(1)
+        user_id = 1
+        recipe_ids = [saved['recipe_id'] for saved in crud.get_saved_recipes(user_id)]
+
+        lookups = [
+            ('get_login', lambda i: unbaked_get_login(email),
+             lambda i: crud.get_login(email)),
+            ('get_identity', lambda i: unbaked_get_identity(user_id),
+             lambda i: crud.get_identity(user_id)),
+            ('get_data_version', lambda i: unbaked_get_data_version(user_id),
+             lambda i: crud.get_data_version(user_id)),
+            ('get_a_saved_recipe', lambda i: unbaked_get_a_saved_recipe(recipe_ids[i % len(recipe_ids)], user_id),
+             lambda i: crud.get_a_saved_recipe(recipe_ids[i % len(recipe_ids)], user_id)),
+            ('quick_get_recipe', lambda i: unbaked_quick_get_recipe(recipe_ids[i % len(recipe_ids)]),
+             lambda i: crud.quick_get_recipe(recipe_ids[i % len(recipe_ids)])),
+            ('favorite_a_recipe', lambda i: unbaked_favorite_a_recipe(recipe_ids[i % len(recipe_ids)], user_id),
+             lambda i: crud.favorite_a_recipe(recipe_ids[i % len(recipe_ids)], user_id)),
+        ]
+
+        print(f'{"lookup":22} {"unbaked us":>11} {"baked us":>9} {"saved us":>9}')
+        for name, unbaked, baked in lookups:
+            # a baseline only means something while it runs the same SQL
+            if statements_run(lambda: unbaked(0)) != statements_run(lambda: baked(0)):
+                print(f'{name:22} unbaked SQL differs from crud, update unbaked_{name}')
+                continue
+            timings = []
+            for func in (unbaked, baked):
+                # warm up caches and the bakery
+                for i in range(20):
+                    func(i)
+                start = time.perf_counter()
+                for i in range(args.calls):
+                    func(i)
+                    # nothing answered from the identity map
+                    db.session.expire_all()
+                timings.append((time.perf_counter() - start) / args.calls * 1e6)
+            print(f'{name:22} {timings[0]:11.0f} {timings[1]:9.0f} {timings[0] - timings[1]:9.0f}')
+
+
+# ***** Serialization *****
+
+def as_dict_recipe_details(recipe):
+    """Recipe details as built before serializers.py: as_dict() copies, then stdlib JSON."""
+
+    recipe_details = recipe.as_dict()
+    recipe_details['ingredients'] = [ingredient.as_dict() for ingredient in recipe_details['ingredients']]
+    recipe_details['instructions'] = [instruction.as_dict()['step_instruction'] for instruction in recipe_details['instructions']]
+    recipe_details['equipment'] = {equipment.as_dict()['equipment']: equipment.as_dict()['equipment']
+                                   for equipment in recipe_details['equipment']}
+    return recipe_details
+
+
+def bench_serializers(args):
+    """Time building saved recipe details JSON for a whole library: ORM + as_dict + jsonify vs column rows + serializers."""
+
+    setup_db(args.db)
+    with app.app_context():
+        synthetic_data.generate(args.recipes * 23)
+        recipe_ids = [recipe_id for recipe_id, in db.session.query(Recipe.recipe_id).limit(args.recipes)]
+        for recipe_id in recipe_ids:
+            crud.save_a_recipe(1, recipe_id, False)
+
+        def old_document(recipe_id):
+            saved_recipe = crud.get_a_saved_recipe(recipe_id, 1)
+            recipe_details = as_dict_recipe_details(crud.get_recipe(recipe_id))
+            recipe_details['favorite'] = saved_recipe.favorite
+            return recipe_details
+
+        def new_document(recipe_id):
+            saved_recipe = crud.get_saved_recipe_columns(recipe_id, 1)
+            recipe_details = serializers.recipe_details(crud.get_recipe_columns(recipe_id),
+                                                        *crud.get_recipe_children_columns(recipe_id))
+            recipe_details['favorite'] = saved_recipe.favorite
+            return recipe_details
+
+        def timed(func):
+            db.session.expire_all()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                result = func()
+            return result, (time.perf_counter() - start) / args.repeat * 1000
+
+        with app.test_request_context():
+            old_docs, old_build = timed(lambda: [old_document(recipe_id) for recipe_id in recipe_ids])
+            new_docs, new_build = timed(lambda: [new_document(recipe_id) for recipe_id in recipe_ids])
+            old_json, old_encode = timed(lambda: [app.json_encoder().encode({'recipe_details': doc}) for doc in old_docs])
+            new_json, new_encode = timed(lambda: [serializers.dumps_bytes({'recipe_details': doc}) for doc in new_docs])
+
+        if [json.loads(doc) for doc in old_json] != [json.loads(doc) for doc in new_json]:
+            print('documents differ!', file=sys.stderr)
+            sys.exit(1)
+
+        encoder = 'orjson' if serializers.orjson else 'json'
+        size = sum(len(doc) for doc in new_json)
+        print(f'{len(recipe_ids)} saved recipes, {size / 1024:.0f} KB of JSON, same documents from both paths')
+        print(f'{"":28} {"as_dict + jsonify":>18} {"rows + " + encoder:>16}')
+        print(f'{"load + build (ms/library)":28} {old_build:18.1f} {new_build:16.1f}')
+        print(f'{"encode (ms/library)":28} {old_encode:18.1f} {new_encode:16.1f}')
+        print(f'{"total (ms/library)":28} {old_build + old_encode:18.1f} {new_build + new_encode:16.1f}')
+
+
+# ***** Message queue *****
+
+def bench_message_queue(args):
+    """Queue messages and time how fast the worker pool sends them through a fake transport."""
+
+    setup_db(args.db)
+    transport = message_queue.FakeTransport(latency=args.latency, failure_rate=args.failure_rate, seed=0)
+    pool = message_queue.MessageWorkerPool(app, transport, num_workers=args.workers,
+                                           batch_size=args.batch_size, poll_interval=0.01,
+                                           backoff=0.01, max_attempts=args.max_attempts)
+
+    with app.app_context():
+        for i in range(args.messages):
+            # spread messages over numbers, so some get batched together
+            crud.queue_message(f'+1555000{i % args.numbers:04d}', f'shopping list {i}:\negg\nmilk')
+
+    start = time.perf_counter()
+    pool.ensure_started()
+    with app.app_context():
+        while Outbound_Message.query.filter(Outbound_Message.status.in_(['queued', 'sending'])).count():
+            db.session.remove()
+            time.sleep(0.05)
+        sent = Outbound_Message.query.filter_by(status='sent').count()
+        failed = Outbound_Message.query.filter_by(status='failed').count()
+    elapsed = time.perf_counter() - start
+    pool.stop()
+
+    print(f'{args.messages} messages to {args.numbers} numbers, {args.workers} workers, '
+          f'{args.latency * 1000:.0f}ms send latency, {args.failure_rate:.0%} failure rate')
+    print(f'  {elapsed:.2f}s, {args.messages / elapsed:.0f} messages/s')
+    print(f'  sent={sent} failed={failed} sms_calls={len(transport.sent) + transport.failed} '
+          f'transport_failures={transport.failed}')
+
+
+# ***** Ingredient resolver *****
+
+def misspell(name, rand):
+    """Return name with a typical typo: dropped/doubled/swapped letter, plural, or odd case/spacing."""
+
+    i = rand.randrange(len(name))
+    typo = rand.choice(['drop', 'double', 'swap', 'plural', 'case'])
+    if typo == 'drop' and len(name) > 4:
+        return name[:i] + name[i + 1:]
+    if typo == 'double':
+        return name[:i] + name[i] + name[i:]
+    if typo == 'swap' and i < len(name) - 1:
+        return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+    if typo == 'plural':
+        return name + 's'
+    return '  ' + name.title() + ' '
+
+
+def bench_resolver(args):
+    """Time resolving typed ingredient tokens, cold (n-gram scoring) and warm (memo hits)."""
+
+    rand = random.Random(0)
+    ingredients = load_csv_ingredients()
+
+    start = time.perf_counter()
+    resolver = IngredientResolver(ingredients)
+    build_secs = time.perf_counter() - start
+
+    # vocabulary of typed tokens, mostly misspelled
+    vocabulary = []
+    for _ in range(args.vocabulary):
+        ingredient_id, name = rand.choice(ingredients)
+        typed = misspell(name, rand) if rand.random() < args.typo_rate else name
+        vocabulary.append((ingredient_id, typed))
+
+    # popular tokens repeat a lot, like real searches (zipf-like weights)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    sample = rand.choices(vocabulary, weights=weights, k=args.tokens)
+    expected_ids = [ingredient_id for ingredient_id, _ in sample]
+    tokens = [typed for _, typed in sample]
+    distinct = len(set(tokens))
+
+    start = time.perf_counter()
+    results = resolver.resolve_many(tokens)
+    first_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resolver.resolve_many(tokens)
+    warm_secs = time.perf_counter() - start
+
+    # cold cost: every token scored, nothing memoized
+    cold = IngredientResolver(ingredients, memo_size=0)
+    start = time.perf_counter()
+    cold.resolve_many(tokens)
+    cold_secs = time.perf_counter() - start
+
+    correct = sum(1 for ingredient_id, result in zip(expected_ids, results)
+                  if result and result[0] == ingredient_id)
+    unresolved = sum(1 for result in results if result is None)
+
+    per_token = cold_secs / len(tokens)
+    print(f'{len(ingredients)} ingredients, index built in {build_secs * 1000:.1f}ms')
+    print(f'{len(tokens)} tokens ({distinct} distinct, {args.typo_rate:.0%} of vocabulary misspelled)')
+    print(f'  cold (no memo):  {per_token * 1e6:.1f}us/token')
+    print(f'  first pass:      {first_secs / len(tokens) * 1e6:.1f}us/token')
+    print(f'  warm (memoized): {warm_secs / len(tokens) * 1e6:.2f}us/token')
+    print(f'  correct={correct / len(tokens):.1%} unresolved={unresolved / len(tokens):.1%}')
+    print(f'  at {args.rate} searches/s of {args.tokens_per_search} tokens, cold resolving '
+          f'uses {per_token * args.tokens_per_search * args.rate:.1%} of one core')
+
+
+# ***** Concurrency *****
+
+# sync baseline, like gunicorn sync workers: each process serves one request at a time
+SYNC_SERVER = """
+import sys
+from werkzeug.serving import run_simple
+from model import connect_to_db
+from server import app, INGREDIENTS
+connect_to_db(app)
+with app.app_context():
+    INGREDIENTS.load()
+run_simple('127.0.0.1', int(sys.argv[1]), app, threaded=False, processes=int(sys.argv[2]))
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, env):
+    """Start a server subprocess and wait until it answers. Return the process."""
+
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/check_session', timeout=1).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit(f'{command} exited with {process.returncode}')
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit(f'{command} didn\'t start')
+
+
+def search_load(port, concurrency, requests_count, offset):
+    """POST distinct searches concurrently. Return (elapsed secs, latencies, errors)."""
+
+    def search(i):
+        # distinct ingredients miss the search cache and the local catalog
+        body = json.dumps({'ingredients': f'benchfood{offset + i}'}).encode()
+        request = urllib.request.Request(f'http://127.0.0.1:{port}/api/search_results', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(request, timeout=60).read()
+        except OSError:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(search, range(requests_count)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency in results if latency is not None]
+    return elapsed, latencies, len(results) - len(latencies)
+
+
+def bench_concurrency(args):
+    """Compare sync worker processes with one gevent process on searches waiting on a slow upstream."""
+
+    db_uri = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    setup_db(db_uri)
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    servers = [(f'sync, {args.workers} processes',
+                lambda port: [sys.executable, '-c', SYNC_SERVER, str(port), str(args.workers)]),
+               ('gevent, 1 process',
+                lambda port: [sys.executable, os.path.join(here, 'async_wsgi.py'), '--port', str(port)])]
+
+    print(f'{args.requests} searches, {args.concurrency} at a time, upstream takes {args.delay * 1000:.0f}ms')
+    print(f'{"server":24} {"requests/s":>10} {"p50 (ms)":>9} {"p95 (ms)":>9} {"errors":>7}')
+
+    with StubServer(delay=args.delay) as stub:
+        env = dict(os.environ, DATABASE_URL=db_uri, SPOONACULAR_BASE_URL=stub.url,
+                   SPOONACULAR_POOL_SIZE=str(args.concurrency), CATALOG_WARMER_WORKERS='0',
+                   LOG_LEVEL='WARNING', PYTHONPATH=here)
+        for i, (name, command) in enumerate(servers):
+            port = free_port()
+            process = start_server(command(port), port, env)
+            try:
+                elapsed, latencies, errors = search_load(port, args.concurrency, args.requests,
+                                                         offset=i * args.requests)
+            finally:
+                process.terminate()
+                process.wait()
+
+            if latencies:
+                print(f'{name:24} {len(latencies) / elapsed:10.1f} {percentile(latencies, 50) * 1000:9.0f} '
+                      f'{percentile(latencies, 95) * 1000:9.0f} {errors:7}')
+            else:
+                print(f'{name:24} {"-":>10} {"-":>9} {"-":>9} {errors:7}')
+
+
+# ***** Compression *****
+
+STEP_WORDS = ('add the', 'stir in', 'until golden', 'over medium heat', 'for 5 minutes', 'season with',
+              'transfer to', 'a large bowl', 'and set aside', 'bring to a boil', 'then reduce', 'to a simmer')
+
+
+def api_recipe(recipe_id, rand, ingredients):
+    """Return a Spoonacular recipe of typical size: 8-14 ingredients and 6-10 wordy steps."""
+
+    names = [name for _, name in rand.sample(ingredients, rand.randint(8, 14))]
+    recipe = fake_recipe(recipe_id, names[:-2])
+    for step in recipe['analyzedInstructions'][0]['steps']:
+        step['step'] = ' '.join(rand.choice(STEP_WORDS) for _ in range(rand.randint(8, 20))).capitalize() + '.'
+    steps = recipe['analyzedInstructions'][0]['steps']
+    steps.extend({'number': number, 'step': steps[number % 4]['step'], 'equipment': []}
+                 for number in range(5, rand.randint(7, 11)))
+    return recipe
+
+
+def bench_compression(args):
+    """Measure CPU time against bytes saved compressing search results and saved libraries."""
+
+    rand = random.Random(0)
+    ingredients = load_csv_ingredients()
+
+    def details(count):
+        return [helper_functions.parse_API_recipe_details(api_recipe(recipe_id, rand, ingredients))
+                for recipe_id in range(count)]
+
+    # (name, chunks): streamed libraries come a recipe at a time
+    search = serializers.dumps_bytes(details(10))
+    library = [serializers.dumps_bytes(recipe) for recipe in details(args.library)]
+    payloads = [('search results (10)', [search]),
+                (f'library ({args.library}), one body', [b'[' + b','.join(library) + b']']),
+                (f'library ({args.library}), streamed', library)]
+
+    settings = [('gzip', level) for level in (1, 6, 9)]
+    if compression.brotli is not None:
+        settings += [('br', quality) for quality in (1, 4, 6, 11)]
+    else:
+        print('brotli not installed, gzip only')
+
+    print(f'{"payload":32} {"encoding":9} {"KB in":>7} {"KB out":>7} {"ratio":>6} {"ms":>8} {"MB/s":>7} {"us/KB saved":>11}')
+    for name, chunks in payloads:
+        size = sum(len(chunk) for chunk in chunks)
+        for encoding, level in settings:
+            times = []
+            for _ in range(args.repeat):
+                compress, flush, finish = compression.compressor(encoding, gzip_level=level, brotli_quality=level)
+                start = time.perf_counter()
+                if len(chunks) == 1:
+                    out = compress(chunks[0]) + finish()
+                else:
+                    out = b''.join(compression.compress_chunks(chunks, compress, flush, finish))
+                times.append(time.perf_counter() - start)
+
+            seconds = statistics.median(times)
+            saved_kb = (size - len(out)) / 1024
+            print(f'{name:32} {encoding + " " + str(level):9} {size / 1024:7.1f} {len(out) / 1024:7.1f} '
+                  f'{size / len(out):6.1f} {seconds * 1000:8.2f} {size / seconds / 1e6:7.1f} '
+                  f'{seconds * 1e6 / saved_kb:11.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='database uri (default: temporary sqlite file)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('routes', help=bench_routes.__doc__)
+    command.add_argument('--rows', type=int, default=1000, help='synthetic rows to generate (e.g. 1000, 100000, 1000000)')
+    command.add_argument('--requests', type=int, default=50, help='requests per route')
+    command.add_argument('--routes', nargs='*', help='only routes containing these strings')
+    command.add_argument('--save-baseline', metavar='PATH')
+    command.add_argument('--compare', metavar='PATH', help='baseline to compare against, exits 1 on regression')
+    command.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging')
+    command.set_defaults(func=bench_routes)
+
+    command = commands.add_parser('queries', help=bench_queries.__doc__)
+    command.add_argument('--rows', type=int, default=5000)
+    command.add_argument('--calls', type=int, default=2000, help='calls per lookup')
+    command.set_defaults(func=bench_queries)
+
+    command = commands.add_parser('serializers', help=bench_serializers.__doc__)
+    command.add_argument('--recipes', type=int, default=200, help='recipes in the saved library')
+    command.add_argument('--repeat', type=int, default=5)
+    command.set_defaults(func=bench_serializers)
+
+    command = commands.add_parser('message_queue', help=bench_message_queue.__doc__)
+    command.add_argument('--messages', type=int, default=1000)
+    command.add_argument('--numbers', type=int, default=100, help='distinct phone numbers')
+    command.add_argument('--workers', type=int, default=4)
+    command.add_argument('--batch-size', type=int, default=20)
+    command.add_argument('--latency', type=float, default=0.01, help='seconds per fake send')
+    command.add_argument('--failure-rate', type=float, default=0.05)
+    command.add_argument('--max-attempts', type=int, default=5)
+    command.set_defaults(func=bench_message_queue)
+
+    command = commands.add_parser('resolver', help=bench_resolver.__doc__)
+    command.add_argument('--tokens', type=int, default=20000)
+    command.add_argument('--vocabulary', type=int, default=2000, help='distinct typed tokens')
+    command.add_argument('--typo-rate', type=float, default=0.7)
+    command.add_argument('--rate', type=int, default=50, help='searches per second')
+    command.add_argument('--tokens-per-search', type=int, default=5)
+    command.set_defaults(func=bench_resolver)
+
+    command = commands.add_parser('concurrency', help=bench_concurrency.__doc__)
+    command.add_argument('--concurrency', type=int, default=200, help='requests in flight at once')
+    command.add_argument('--requests', type=int, default=1000)
+    command.add_argument('--delay', type=float, default=0.2, help='seconds the fake upstream takes')
+    command.add_argument('--workers', type=int, default=4, help='sync worker processes')
+    command.set_defaults(func=bench_concurrency)
+
+    command = commands.add_parser('compression', help=bench_compression.__doc__)
+    command.add_argument('--library', type=int, default=200, help='recipes in the saved library')
+    command.add_argument('--repeat', type=int, default=5)
+    command.set_defaults(func=bench_compression)
+
+    args = parser.parse_args()
+    args.func(args)
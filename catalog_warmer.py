@@ -0,0 +1,150 @@
+"""Background workers adding recipes from search results to the local catalog.
+
+Spoonacular search results already carry everything a saved recipe needs, so
+search_results hands them to a CatalogWarmer instead of throwing them away.
+Worker threads add the new ones to the db in batches (crud.add_recipes) and
+to the local search index, off the request path. Later saves skip the recipe
+insert and later searches can be answered locally.
+
+The queue is bounded: when workers fall behind, offer() drops recipes rather
+than slowing down searches. Queue depth and drops are exported as metrics."""
+
+import collections
+import logging
+import queue
+import threading
+
+import crud
+import search_index
+from model import db
+
+
+log = logging.getLogger(__name__)
+
+
+class CatalogWarmer:
+    """Bounded queue of recipe details and the worker threads upserting them."""
+
+    def __init__(self, app, num_workers=1, max_queue=1000, batch_size=50, batch_wait=0.2, remember=10000):
+        self.app = app
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        # how long an idle worker waits for a recipe before checking whether to stop
+        self.batch_wait = batch_wait
+        self.remember = remember
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        # recipe_ids recently queued, so repeated searches don't queue them again
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+        self.added = 0
+        self.dropped = 0
+
+    def ensure_started(self):
+        """Start worker threads, once."""
+
+        with self._start_lock:
+            if self._threads or not self.num_workers:
+                return
+
+            self._stopping.clear()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f'catalog-warmer-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def offer(self, recipe_details_list):
+        """Queue recipes to add to the catalog without waiting. Return number queued.
+
+        Recipes queued recently are skipped; when the queue is full the rest are dropped."""
+
+        if not self.num_workers:
+            return 0
+
+        queued = 0
+        for i, recipe_details in enumerate(recipe_details_list):
+            recipe_id = recipe_details['recipe_id']
+            with self._lock:
+                if recipe_id in self._recent:
+                    continue
+                try:
+                    self._queue.put_nowait(recipe_details)
+                except queue.Full:
+                    # this one and the rest
+                    self.dropped += len(recipe_details_list) - i
+                    break
+                self._remember(recipe_id)
+            queued += 1
+
+        return queued
+
+    def _remember(self, recipe_id):
+        self._recent[recipe_id] = True
+        while len(self._recent) > self.remember:
+            self._recent.popitem(last=False)
+
+    def depth(self):
+        """Return number of recipes waiting in the queue."""
+
+        return self._queue.qsize()
+
+    def stop(self, timeout=5):
+        """Stop workers after their current batch."""
+
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    self.run_once(timeout=self.batch_wait)
+                except Exception as error:
+                    log.exception('catalog warmer error: %s', error)
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def run_once(self, timeout=0):
+        """Take up to batch_size queued recipes and add the new ones. Return number added."""
+
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if not batch:
+            return 0
+
+        try:
+            added = crud.add_recipes(batch)
+        except Exception:
+            # let a later search queue them again
+            with self._lock:
+                for recipe_details in batch:
+                    self._recent.pop(recipe_details['recipe_id'], None)
+            raise
+
+        for recipe_details in batch:
+            if recipe_details['recipe_id'] in added:
+                search_index.index.add_recipe(recipe_details['recipe_id'], recipe_details['ingredients'])
+
+        with self._lock:
+            self.added += len(added)
+        return len(added)
+
+    def stats(self):
+        """Return dictionary of queue depth and counters."""
+
+        return {'queue_depth': self.depth(),
+                'added': self.added,
+                'dropped': self.dropped}
@@ -0,0 +1,130 @@
+"""Negotiated gzip/brotli compression of /api responses.
+
+Search results and saved recipe pages are JSON of up to hundreds of KB that
+compresses 5-10x. Responses are compressed with brotli when the browser
+accepts it and the brotli package is installed, gzip otherwise, and left
+alone when they're small, already encoded, not text, or marked no-transform.
+
+Streamed responses are compressed chunk by chunk and flushed every
+STREAM_FLUSH_BYTES, so they still arrive incrementally without a flush per
+tiny chunk costing most of the saving. They're always compressed, since
+their size isn't known up front.
+
+Settings come from COMPRESS_MIN_SIZE (bytes), COMPRESS_GZIP_LEVEL (1-9) and
+COMPRESS_BROTLI_QUALITY (0-11)."""
+
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml'}
+
+# fast settings for responses built per request; static assets are precompressed harder
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4
+
+# uncompressed bytes of a streamed body between flushes
+STREAM_FLUSH_BYTES = 16384
+
+
+def choose_encoding(accept_encodings):
+    """Return 'br', 'gzip' or None for a request's parsed Accept-Encoding."""
+
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compressor(encoding, gzip_level=DEFAULT_GZIP_LEVEL, brotli_quality=DEFAULT_BROTLI_QUALITY):
+    """Return (compress, flush, finish) functions of a new incremental compressor."""
+
+    if encoding == 'br':
+        brotli_compressor = brotli.Compressor(quality=brotli_quality)
+        return brotli_compressor.process, brotli_compressor.flush, brotli_compressor.finish
+
+    # wbits 31: gzip header and trailer
+    gzip_compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return (gzip_compressor.compress,
+            lambda: gzip_compressor.flush(zlib.Z_SYNC_FLUSH),
+            gzip_compressor.flush)
+
+
+def compressible(response):
+    """Return True if response's body is worth negotiating compression for."""
+
+    return (200 <= response.status_code < 300 and response.status_code not in (204, 206)
+            and 'Content-Encoding' not in response.headers
+            and not response.direct_passthrough
+            and not response.cache_control.no_transform
+            and (response.mimetype in COMPRESSIBLE_TYPES or response.mimetype.startswith('text/')))
+
+
+def init_app(app, prefix='/api/', min_size=None, gzip_level=None, brotli_quality=None):
+    """Compress responses to paths starting with prefix."""
+
+    env = os.environ
+    if min_size is None:
+        min_size = int(env.get('COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE))
+    if gzip_level is None:
+        gzip_level = int(env.get('COMPRESS_GZIP_LEVEL', DEFAULT_GZIP_LEVEL))
+    if brotli_quality is None:
+        brotli_quality = int(env.get('COMPRESS_BROTLI_QUALITY', DEFAULT_BROTLI_QUALITY))
+
+    @app.after_request
+    def compress_response(response):
+        if not request.path.startswith(prefix) or not compressible(response):
+            return response
+        if not response.is_streamed and response.calculate_content_length() < min_size:
+            return response
+
+        # the body depends on Accept-Encoding from here on, even when sent as is
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        compress, flush, finish = compressor(encoding, gzip_level, brotli_quality)
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, compress, flush, finish)
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(compress(response.get_data()) + finish())
+
+        response.headers['Content-Encoding'] = encoding
+        # the bytes differ from the uncompressed ones
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def compress_chunks(chunks, compress, flush, finish):
+    """Yield a streamed body compressed, flushing every STREAM_FLUSH_BYTES."""
+
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compress(chunk)
+            pending += len(chunk)
+            if pending >= STREAM_FLUSH_BYTES:
+                data += flush()
+                pending = 0
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # let the wrapped body run its cleanup (stream_with_context pops its request context)
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -2,133 +2,419 @@
 
 Create, Read, Update, Delete."""
 
-from model import db, User, Saved_Recipe, Recipe, Recipe_Ingredient, Instructions, Equipment, connect_to_db
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+
+import batch
+from model import db, User, Saved_Recipe, Recipe, Recipe_Ingredient, Instructions, Equipment, Ingredient, Outbound_Message, connect_to_db, load_profile
+
+# keep multi-row inserts under sqlite's limit of 999 bound parameters
+MAX_INSERT_PARAMS = 900
+
+# compiled SQL of the hot lookups, built once per process instead of per call
+bakery = baked.bakery()
+
+# recipe columns serializers.recipe_details expects
+RECIPE_COLUMNS = (Recipe.recipe_id, Recipe.title, Recipe.image, Recipe.servings, Recipe.sourceUrl,
+                  Recipe.cooking_mins, Recipe.prep_mins, Recipe.ready_mins)
 
 # ***** User class crud functions *****
 
 def create_user(email, password, phone):
-    """Create an user."""
+    """Create an user. Return new user's id."""
 
     # Instantiate an User 
     user = User(email=email, password=password, phone=phone)
 
     # add new instance of user to db and commit
     db.session.add(user)
-    db.session.commit()
+    _commit()
+
+    return user.user_id
+
+
+def get_login(email):
+    """Return (user_id, password) row of user with email, or None, for checking a login."""
+
+    query = bakery(lambda session: session.query(User.user_id, User.password))
+    query += lambda q: q.filter(User.email == bindparam('email'))
 
-    return 
+    return query(db.session()).params(email=email).first()
 
 
-def get_user_by_email(email):
-    """Retrieve user by email."""
+def get_identity(user_id):
+    """Return (user_id, email, phone) row of a user, or None.
 
-    # Use .first() so if none, then won't throw error
-    return db.session.query(User).filter_by(email=email).first()
+    Column-only, so it's cheap enough to load on every request."""
 
+    query = bakery(lambda session: session.query(User.user_id, User.email, User.phone))
+    query += lambda q: q.filter(User.user_id == bindparam('user_id'))
 
-def get_user_phone(email):
-    """Return user's phone number by email."""
-    phone = db.session.query(User.phone).filter_by(email=email).first()
+    return query(db.session()).params(user_id=user_id).first()
 
-    return phone
+
+def get_data_version(user_id):
+    """Return user's data_version, or None. It changes whenever their saved recipes do."""
+
+    query = bakery(lambda session: session.query(User.data_version))
+    query += lambda q: q.filter(User.user_id == bindparam('user_id'))
+
+    return query(db.session()).params(user_id=user_id).scalar()
 
 
 # ***** Saved Recipe class crud functions *****
 
 def save_a_recipe(user, recipe, is_favorite):
-    """Saves a recipe user picked."""
+    """Saves a recipe user picked.
 
-    # Instantiate a saved recipe
-    saved_recipe = Saved_Recipe(user_id=user, recipe_id=recipe, favorite=is_favorite)
+    Saving a recipe twice does nothing (unique user_id, recipe_id index).
+    Return True if recipe was newly saved."""
 
-    # add to database
-    db.session.add(saved_recipe)
-    db.session.commit()
+    saved = _insert_ignoring_conflicts(Saved_Recipe.__table__,
+                                       {'user_id': user, 'recipe_id': recipe, 'favorite': is_favorite})
+    if saved:
+        _bump_data_version(user)
+    _commit()
 
-    return
+    return saved
+
+
+def save_recipes(user_id, recipe_details_list, is_favorite=False):
+    """Save many recipes for a user in one transaction, adding any missing ones to the db.
+
+    recipe_details_list holds dictionaries shaped like parse_API_recipe_details.
+    Recipes already in the db (one IN query finds them) aren't rewritten, and
+    recipes the user already saved are skipped. Return (set of recipe_ids
+    added to the db, number of recipes newly saved)."""
+
+    # one payload per recipe_id
+    recipes = {recipe_details['recipe_id']: recipe_details for recipe_details in recipe_details_list}
+    if not recipes:
+        return set(), 0
 
+    try:
+        added = _add_missing_recipes(recipes)
 
-def get_saved_recipes(email):
+        saved = _insert_rows(Saved_Recipe.__table__,
+                             [{'user_id': user_id, 'recipe_id': recipe_id, 'favorite': is_favorite}
+                              for recipe_id in recipes],
+                             ignore_conflicts=True)
+        if saved:
+            _bump_data_version(user_id)
+        _commit()
+
+    except Exception:
+        _rollback()
+        raise
+
+    return added, saved
+
+
+def get_saved_recipes(user_id):
     """Show all of user's saved recipes.
 
     Return a list of user's saved recipes as objects."""
 
-    # eagarly load query so can access each saved recipe's ingredients, details, and instructions
-    user = User.query.filter_by(email=email).join(Saved_Recipe, Recipe, Recipe_Ingredient, Instructions, Equipment).first()
+    # eagarly load each saved recipe's ingredients, details, and instructions
+    saved_recipes = (Saved_Recipe.query
+                     .filter(Saved_Recipe.user_id == user_id)
+                     .options(joinedload(Saved_Recipe.user), *load_profile(Saved_Recipe, 'full'))
+                     .all())
 
-    # if user does not have any saved_recipes
-    if user == None:
-        return []
-
-    saved_list = [saved.as_dict() for saved in user.saved_recipes]
+    saved_list = [saved.as_dict() for saved in saved_recipes]
 
     return saved_list 
 
-def get_a_saved_recipe(recipe_id, email):
-    """Return saved recipe object given id and user's email."""
+def get_saved_recipe_ids(user_id):
+    """Return dictionary of user's saved recipe_ids to their favorite flag.
 
-    saved_recipe = db.session.query(Saved_Recipe).filter(User.email == email).group_by(Saved_Recipe.recipe_id, Saved_Recipe.saved_id).having(Saved_Recipe.recipe_id == recipe_id).join(User, Recipe, Recipe_Ingredient, Instructions, Equipment).first() 
+    Only reads saved_recipes' id columns, without loading any recipes."""
 
-    return saved_recipe
+    saved = db.session.query(Saved_Recipe.recipe_id, Saved_Recipe.favorite).filter(Saved_Recipe.user_id == user_id).all()
 
+    return {recipe_id: bool(favorite) for recipe_id, favorite in saved}
 
-def update_tried(saved_recipe, tried):
-    """Add/update user's tried."""
 
-    saved_recipe.tried = tried
-    db.session.commit()
+def get_saved_recipe_page(user_id, after_saved_id=None, limit=50):
+    """Return list of one page of user's saved recipes as (saved_id, recipe_id, favorite) rows.
 
-    return saved_recipe
+    Rows are ordered by saved_id, starting after after_saved_id (keyset
+    pagination). Recipe columns come from the recipe document cache."""
 
+    query = (db.session.query(Saved_Recipe.saved_id, Saved_Recipe.recipe_id, Saved_Recipe.favorite)
+             .filter(Saved_Recipe.user_id == user_id))
 
-def update_comment(saved_recipe, comment):
-    """Add/update user's comment."""
+    if after_saved_id is not None:
+        query = query.filter(Saved_Recipe.saved_id > after_saved_id)
 
-    saved_recipe.comment = comment
-    db.session.commit()
+    return query.order_by(Saved_Recipe.saved_id).limit(limit).all()
 
-    return saved_recipe
 
+def get_a_saved_recipe(recipe_id, user_id):
+    """Return saved recipe object given id and user's id, for updating its own columns."""
+
+    # lookup by (user_id, recipe_id); recipe and user load lazily if ever used
+    query = bakery(lambda session: session.query(Saved_Recipe).options(*load_profile(Saved_Recipe, 'identity')))
+    query += lambda q: q.filter(Saved_Recipe.user_id == bindparam('user_id'),
+                                Saved_Recipe.recipe_id == bindparam('recipe_id'))
+
+    return query(db.session()).params(user_id=user_id, recipe_id=recipe_id).first()
+
+
+def get_saved_recipe_columns(recipe_id, user_id):
+    """Return row of a user's saved recipe columns, or None.
+
+    Row has saved_id, recipe_id, user_id, favorite, tried, rating and comment,
+    without creating ORM objects."""
+
+    query = bakery(lambda session: session.query(
+        Saved_Recipe.saved_id, Saved_Recipe.recipe_id, Saved_Recipe.user_id, Saved_Recipe.favorite,
+        Saved_Recipe.tried, Saved_Recipe.rating, Saved_Recipe.comment))
+    query += lambda q: q.filter(Saved_Recipe.user_id == bindparam('user_id'),
+                                Saved_Recipe.recipe_id == bindparam('recipe_id'))
+
+    return query(db.session()).params(user_id=user_id, recipe_id=recipe_id).first()
 
-def update_rating(saved_recipe, rating):
-    """Add/update user's rating."""
 
-    saved_recipe.rating = rating
-    db.session.commit()
+def update_thoughts(saved_recipe, tried=None, rating=None, comment=None):
+    """Add/update user's tried, rating and comment; None leaves a field as it is.
+
+    One data_version bump and one commit for all of them."""
+
+    if tried is not None:
+        saved_recipe.tried = tried
+    if rating is not None:
+        saved_recipe.rating = rating
+    if comment is not None:
+        saved_recipe.comment = comment
+
+    _bump_data_version(saved_recipe.user_id)
+    _commit()
 
     return saved_recipe
 
 
-def favorite_a_recipe(recipe_id, email):
-    """Favorite a saved recipe from db."""
+def favorite_a_recipe(recipe_id, user_id):
+    """Favorite a saved recipe from db.
+
+    Return True if it's favorited now, False if it already was, None if the
+    user hasn't saved it."""
+
+    query = bakery(lambda session: session.query(Saved_Recipe).options(*load_profile(Saved_Recipe, 'identity')))
+    query += lambda q: q.filter(Saved_Recipe.user_id == bindparam('user_id'),
+                                Saved_Recipe.recipe_id == bindparam('recipe_id'))
+
+    favorited_recipe = query(db.session()).params(user_id=user_id, recipe_id=recipe_id).first()
+    if favorited_recipe == None:
+        return None
+    if favorited_recipe.favorite:
+        return False
 
-    favorited_recipe = Saved_Recipe.query.filter(Saved_Recipe.recipe_id == recipe_id, User.email == email).join(User).first()
     favorited_recipe.favorite = True
+    _bump_data_version(user_id)
 
-    db.session.commit()
+    _commit()
 
-    return
+    return True
 
 
 # ***** Recipe class crud functions *****
 
-def create_recipe(recipe_id, title, image, servings, sourceUrl, cooking_mins, prep_mins, ready_mins):
-    """Create a recipe."""
+def create_recipe_with_details(recipe_details):
+    """Create a recipe with its ingredients, instructions, and equipment in one transaction.
 
-    # Instantiate a recipe
-    recipe = Recipe(recipe_id=recipe_id, title=title, image=image, servings=servings, sourceUrl=sourceUrl, cooking_mins=cooking_mins, prep_mins=prep_mins, ready_mins=ready_mins)
+    recipe_details is a dictionary shaped like parse_API_recipe_details.
+    Idempotent on recipe_id: if the recipe already exists (or another request
+    inserts it first), nothing is written. Return True if recipe was inserted."""
 
-    # add to database
-    db.session.add(recipe)
-    db.session.commit()
+    try:
+        # recipe row first: it's the lock that makes concurrent saves of the same recipe safe
+        try:
+            inserted = _insert_ignoring_conflicts(Recipe.__table__, _recipe_row(recipe_details))
+        except IntegrityError:
+            # a batch can't roll back just this part of its transaction
+            if batch.in_batch():
+                raise
+            # dialects without conflict-ignoring inserts: another request saved it first
+            inserted = False
 
-    return
+        if not inserted:
+            _rollback()
+            return False
+
+        # errors from here on are real failures, not a recipe saved first elsewhere
+        _insert_recipe_children([recipe_details])
+
+        _commit()
+
+    except Exception:
+        _rollback()
+        raise
+
+    return True
+
+
+def add_recipes(recipe_details_list):
+    """Add recipes that aren't in the db yet, with their details, in one transaction.
+
+    Like save_recipes without saving them for anyone. Return set of recipe_ids added."""
+
+    recipes = {recipe_details['recipe_id']: recipe_details for recipe_details in recipe_details_list}
+    if not recipes:
+        return set()
+
+    try:
+        added = _add_missing_recipes(recipes)
+        _commit()
+
+    except Exception:
+        _rollback()
+        raise
+
+    return added
+
+
+def _add_missing_recipes(recipes):
+    """Insert recipes (dictionary of recipe_id to details) not in the db yet, without committing.
+
+    Return set of recipe_ids inserted."""
+
+    # one IN query instead of a lookup per recipe
+    existing = {recipe_id for recipe_id, in
+                db.session.query(Recipe.recipe_id).filter(Recipe.recipe_id.in_(list(recipes))).all()}
+
+    # concurrent saves of the same new recipe: only the one that inserts its row adds its children
+    added = _insert_new_recipes([_recipe_row(recipes[recipe_id])
+                                 for recipe_id in recipes if recipe_id not in existing])
+    _insert_recipe_children([recipes[recipe_id] for recipe_id in added])
+
+    return added
+
+
+def _recipe_row(recipe_details):
+    """Return recipes table row of a recipe details dictionary."""
+
+    return {'recipe_id': recipe_details['recipe_id'],
+            'title': recipe_details['title'],
+            'image': recipe_details['image'],
+            'servings': recipe_details['servings'],
+            'sourceUrl': recipe_details['sourceUrl'],
+            'cooking_mins': recipe_details['cooking_mins'],
+            'prep_mins': recipe_details['prep_mins'],
+            'ready_mins': recipe_details['ready_mins']}
+
+
+def _insert_recipe_children(recipe_details_list):
+    """Insert ingredients, instructions, and equipment of recipes with multi-row INSERTs, without committing."""
+
+    _insert_rows(Recipe_Ingredient.__table__,
+                 [{'recipe_id': recipe_details['recipe_id'],
+                   'ingredient_id': ingredient['ingredient_id'],
+                   'amount': ingredient['amount'],
+                   'unit': ingredient['unit'],
+                   'name': ingredient['name']}
+                  for recipe_details in recipe_details_list
+                  for ingredient in recipe_details['ingredients']])
+    # step_num starts at 1
+    _insert_rows(Instructions.__table__,
+                 [{'recipe_id': recipe_details['recipe_id'], 'step_num': i + 1, 'step_instruction': instruction}
+                  for recipe_details in recipe_details_list
+                  for i, instruction in enumerate(recipe_details['instructions'])])
+    _insert_rows(Equipment.__table__,
+                 [{'recipe_id': recipe_details['recipe_id'], 'equipment': equipment}
+                  for recipe_details in recipe_details_list
+                  for equipment in recipe_details['equipment']])
+
+
+def _insert_new_recipes(recipe_rows):
+    """Insert recipe rows, skipping ones that already exist. Return set of recipe_ids inserted."""
+
+    if db.engine.dialect.name == 'postgresql':
+        inserted = set()
+        chunk_size = max(1, MAX_INSERT_PARAMS // len(RECIPE_COLUMNS))
+        for start in range(0, len(recipe_rows), chunk_size):
+            statement = (postgresql.insert(Recipe.__table__).values(recipe_rows[start:start + chunk_size])
+                         .on_conflict_do_nothing().returning(Recipe.recipe_id))
+            inserted.update(recipe_id for recipe_id, in db.session.execute(statement))
+        return inserted
+
+    # no RETURNING here, one row at a time tells which rows were inserted
+    return {row['recipe_id'] for row in recipe_rows if _insert_ignoring_conflicts(Recipe.__table__, row)}
+
+
+def _commit():
+    """Commit, or only flush inside a batch, which commits once after its last operation."""
+
+    if batch.in_batch():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def _rollback():
+    """Roll back, except inside a batch, which rolls back as a whole if an operation fails."""
+
+    if not batch.in_batch():
+        db.session.rollback()
+
+
+def _bump_data_version(user_id):
+    """Mark user's saved recipes changed, in the same transaction as the change."""
+
+    db.session.execute(User.__table__.update()
+                       .where(User.user_id == user_id)
+                       .values(data_version=User.data_version + 1))
+
+
+def _insert_ignoring_conflicts(table, row):
+    """Insert one row, doing nothing if its primary key or a unique index already has it.
+
+    Return True if the row was inserted."""
+
+    return db.session.execute(_insert_statement(table, ignore_conflicts=True), row).rowcount == 1
+
+
+def _insert_statement(table, ignore_conflicts=False):
+    """Return INSERT statement for table, skipping rows that conflict if ignore_conflicts."""
+
+    if not ignore_conflicts:
+        return table.insert()
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        # waits for a concurrent insert of the same key to commit, then skips
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    else:
+        return table.insert()
+
+
+def _insert_rows(table, rows, ignore_conflicts=False):
+    """Insert list of rows using multi-row INSERT statements, without committing.
+
+    Return number of rows inserted."""
+
+    if not rows:
+        return 0
+
+    inserted = 0
+    # number of rows per statement so bound parameters stay under the limit
+    chunk_size = max(1, MAX_INSERT_PARAMS // len(rows[0]))
+    for start in range(0, len(rows), chunk_size):
+        statement = _insert_statement(table, ignore_conflicts).values(rows[start:start + chunk_size])
+        inserted += db.session.execute(statement).rowcount
+    return inserted
 
 
 def get_recipe(recipe_id):
     """Retrieve a recipe from database."""
 
-    recipe = db.session.query(Recipe).filter(Recipe.recipe_id == recipe_id).join(Saved_Recipe, User, Recipe_Ingredient, Instructions, Equipment).first() 
+    recipe = db.session.query(Recipe).options(*load_profile(Recipe, 'full')).filter(Recipe.recipe_id == recipe_id).first()
 
     return recipe
 
@@ -136,62 +422,131 @@ def get_recipe(recipe_id):
 def quick_get_recipe(id_num):
     """Return recipe_id if exists in db."""
 
-    recipe = Recipe.query.filter_by(recipe_id=id_num).first()
+    query = bakery(lambda session: session.query(Recipe).options(*load_profile(Recipe, 'identity')))
+    query += lambda q: q.filter(Recipe.recipe_id == bindparam('recipe_id'))
+
+    recipe = query(db.session()).params(recipe_id=id_num).first()
     
     return recipe
 
 
-def add_recipe_ingredient(recipe, ingredient_id, amount, unit, name):
-    """Add a recipe's ingredient to database."""
+def get_recipe_columns(recipe_id):
+    """Return row of a recipe's RECIPE_COLUMNS, or None."""
 
-    # Instantiate a recipe's ingredient
-    recipe_ingredient = Recipe_Ingredient(recipe_id=recipe, ingredient_id=ingredient_id, amount=amount, unit=unit, name=name)
+    query = bakery(lambda session: session.query(*RECIPE_COLUMNS))
+    query += lambda q: q.filter(Recipe.recipe_id == bindparam('recipe_id'))
 
-    # add to database
-    db.session.add(recipe_ingredient)
-    db.session.commit()
+    return query(db.session()).params(recipe_id=recipe_id).first()
 
-    return
 
+def get_recipe_summary_rows(recipe_ids):
+    """Return list of recipe card rows (recipe_id, title, image, servings, prep_mins,
+    cooking_mins, ready_mins) for recipe_ids."""
 
-def add_instructions(recipe, step_num, step_instruction):
-    """Add recipe's instructions, one by one, to databasee."""
+    return (db.session.query(Recipe.recipe_id, Recipe.title, Recipe.image, Recipe.servings,
+                             Recipe.prep_mins, Recipe.cooking_mins, Recipe.ready_mins)
+            .filter(Recipe.recipe_id.in_(recipe_ids))
+            .all())
 
-    # Instantiate a recipe's instructions
-    instructions = Instructions(recipe_id=recipe, step_num=step_num, step_instruction=step_instruction)
 
-    # add to database
-    db.session.add(instructions)
-    db.session.commit()
+def get_recipe_children_columns(recipe_id):
+    """Return (ingredient rows, instruction rows, equipment rows) of a recipe as column tuples.
 
-    return
+    Ingredient rows are (rec_ing_id, recipe_id, ingredient_id, amount, unit, name),
+    instruction rows (step_instruction,) in step order, equipment rows (equipment,)."""
+
+    ingredients = bakery(lambda session: session.query(
+        Recipe_Ingredient.rec_ing_id, Recipe_Ingredient.recipe_id, Recipe_Ingredient.ingredient_id,
+        Recipe_Ingredient.amount, Recipe_Ingredient.unit, Recipe_Ingredient.name)
+        .filter(Recipe_Ingredient.recipe_id == bindparam('recipe_id'))
+        .order_by(Recipe_Ingredient.rec_ing_id))
+    instructions = bakery(lambda session: session.query(Instructions.step_instruction)
+                          .filter(Instructions.recipe_id == bindparam('recipe_id'))
+                          .order_by(Instructions.step_num))
+    equipment = bakery(lambda session: session.query(Equipment.equipment)
+                       .filter(Equipment.recipe_id == bindparam('recipe_id'))
+                       .order_by(Equipment.equipment_id))
+
+    session = db.session()
+    return tuple(query(session).params(recipe_id=recipe_id).all()
+                 for query in (ingredients, instructions, equipment))
+
+
+def get_recipes_by_ids(recipe_ids):
+    """Return list of recipes, with ingredients, instructions, and equipment, for list of ids."""
+
+    return Recipe.query.options(*load_profile(Recipe, 'full')).filter(Recipe.recipe_id.in_(recipe_ids)).all()
 
 
-def add_equipment(recipe, equipment):
-    """Add recipe's equipment, one by one, to database."""
+def remove_recipe(recipe_id, user_id):
+    """Remove recipe from user's saved recipes. Return True if it was saved.
 
-    # Instantiate a recipe's equipment
-    equipment = Equipment(recipe_id=recipe, equipment=equipment)
+    The recipe itself stays in the catalog, other users may have saved it."""
 
-    # add to database
-    db.session.add(equipment)
-    db.session.commit()
+    removed = (db.session.query(Saved_Recipe)
+               .filter(Saved_Recipe.recipe_id == recipe_id, Saved_Recipe.user_id == user_id)
+               .delete(synchronize_session=False))
+    if removed:
+        _bump_data_version(user_id)
+    _commit()
+
+    return removed > 0
+
+
+# ***** Ingredient class crud functions *****
+
+def create_ingredient(ingredient_id, name):
+    """Create an ingredient."""
+
+    ingredient = Ingredient(ingredient_id=ingredient_id, name=name)
+
+    db.session.add(ingredient)
+    _commit()
 
     return
 
 
-def remove_recipe(recipe_id, email):
-    """Remove recipe from user's saved recipes."""
+def get_ingredients():
+    """Return list of all (ingredient_id, name) tuples."""
 
-    saved_recipe = db.session.query(Saved_Recipe).filter(Saved_Recipe.recipe_id == recipe_id, User.email == email).first()
-    recipe = Recipe.query.filter_by(recipe_id=recipe_id).first()
+    return db.session.query(Ingredient.ingredient_id, Ingredient.name).all()
 
-    # delete from database
-    db.session.delete(recipe)
-    db.session.delete(saved_recipe)
-    db.session.commit()
 
-    return True
+def get_ingredients_version():
+    """Return (count, max ingredient_id) of ingredients table, to cheaply notice changes."""
+
+    return tuple(db.session.query(func.count(Ingredient.ingredient_id),
+                                  func.max(Ingredient.ingredient_id)).one())
+
+
+# ***** Outbound_Message class crud functions *****
+
+def queue_message(to_number, body, user_id=None):
+    """Queue a text message for the message workers to send.
+
+    Return the new message's id."""
+
+    message = Outbound_Message(to_number=to_number, body=body, user_id=user_id)
+
+    db.session.add(message)
+    _commit()
+
+    return message.message_id
+
+
+def get_message(message_id, user_id):
+    """Return a user's queued message, or None."""
+
+    return Outbound_Message.query.filter_by(message_id=message_id, user_id=user_id).first()
+
+
+def count_messages_by_status():
+    """Return dictionary of message status to number of messages."""
+
+    return dict(db.session.query(Outbound_Message.status, func.count(Outbound_Message.message_id))
+                .group_by(Outbound_Message.status)
+                .all())
+
 
 if __name__ == '__main__':
     from server import app
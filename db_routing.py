@@ -0,0 +1,138 @@
+"""Send reads from read-only routes to replica databases.
+
+Routes decorated with @read_only run their SELECTs on a replica (one per
+request, picked at random). Anything else, and every request from a browser
+session that wrote in the last REPLICA_STICKY_SECS, uses the primary, so users
+always see their own writes."""
+
+import functools
+import random
+import time
+
+from flask import g, has_request_context, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import Select
+
+
+# replicas are assumed to lag the primary by less than this
+REPLICA_STICKY_SECS = 5
+
+# bind keys of replicas in SQLALCHEMY_BINDS
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+def replica_binds(uris):
+    """Return SQLALCHEMY_BINDS entries for a list of replica uris."""
+
+    return {f'{REPLICA_BIND_PREFIX}{i}': uri for i, uri in enumerate(uris)}
+
+
+def read_only(view):
+    """Mark a view as only reading, so its queries can go to a replica."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    """Session choosing primary or replica engine per statement."""
+
+    def get_bind(self, mapper=None, clause=None):
+        # models with their own __bind_key__ keep it
+        if mapper is not None and mapper.persist_selectable.info.get('bind_key') is not None:
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            _wrote()
+            return super().get_bind(mapper, clause)
+
+        replica = _replica_engine(self)
+        if replica is not None:
+            return replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions route read-only requests to replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_keys(self, app):
+        return sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or ()
+                      if key.startswith(REPLICA_BIND_PREFIX))
+
+    def engines(self, app):
+        """Return dictionary of name ('primary' or replica bind key) to engine."""
+
+        engines = {'primary': self.get_engine(app)}
+        for key in self.replica_keys(app):
+            engines[key] = self.get_engine(app, bind=key)
+        return engines
+
+
+def _wrote():
+    """Note that this request wrote, so later reads (and requests) use the primary."""
+
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _replica_engine(db_session):
+    """Return replica engine for this request's reads, or None to use the primary."""
+
+    if not has_request_context() or not g.get('read_only') or g.get('db_wrote'):
+        return None
+
+    # a batch's operations share one transaction on the primary
+    if g.get('in_batch'):
+        return None
+
+    state = db_session.app.extensions['sqlalchemy']
+
+    if 'replica_bind' not in g:
+        keys = state.db.replica_keys(db_session.app)
+        wrote_at = session.get('db_wrote_at')
+        recently_wrote = wrote_at is not None and time.time() - wrote_at < REPLICA_STICKY_SECS
+        g.replica_bind = random.choice(keys) if keys and not recently_wrote else None
+
+    if g.replica_bind is None:
+        return None
+
+    return state.db.get_engine(db_session.app, bind=g.replica_bind)
+
+
+def init_app(app):
+    """Remember in the browser session when it last wrote."""
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote'):
+            session['db_wrote_at'] = time.time()
+        return response
+
+
+def pool_stats(db, app):
+    """Return list of ({'engine', 'state'}, connections) for each engine's pool.
+
+    States are checked_out, idle, overflow and size (connections kept open,
+not counting overflow), all from QueuePool's public methods. The overflow
+limit is DB_MAX_OVERFLOW."""
+
+    stats = []
+    for name, engine in db.engines(app).items():
+        pool = engine.pool
+        # only QueuePool keeps counts; sqlite test pools don't
+        if not hasattr(pool, 'checkedout'):
+            continue
+        stats.append(({'engine': name, 'state': 'checked_out'}, pool.checkedout()))
+        stats.append(({'engine': name, 'state': 'idle'}, pool.checkedin()))
+        stats.append(({'engine': name, 'state': 'overflow'}, max(pool.overflow(), 0)))
+        stats.append(({'engine': name, 'state': 'size'}, pool.size()))
+    return stats
@@ -2,7 +2,9 @@
 
 import crud
 from model import connect_to_db, db
-from pprint import pprint
+import logging
+
+log = logging.getLogger(__name__)
 
 
 # ***** Parse Spoonacular's API Endpoint data (Complex Search data) *****
@@ -58,21 +60,41 @@ def parse_API_recipe_details(complex_data):
 
 # ***** Parsing recipes from db (sqlAlchemy objects) *****
 
-def parse_db_recipe_details(recipe):
-    """Return dictionary of a db recipe's details information."""
+def parse_db_search_result(recipe, used_ingredient_ids):
+    """Return a db recipe in the same shape as parse_API_recipe_details.
+
+    Ingredients not in used_ingredient_ids are listed as missing_ingredients."""
 
-    recipe_details = recipe.as_dict()
-    print(recipe_details)
+    recipe_data = {}
 
-    ingredients = [ingredient.as_dict() for ingredient in recipe_details['ingredients']]
-    instructions = [instruction.as_dict()['step_instruction'] for instruction in recipe_details['instructions']]
-    equipment = {equipment.as_dict()['equipment']: equipment.as_dict()['equipment'] for equipment in recipe_details['equipment']}
-    # reassign values from db objects as python dictionaries
-    recipe_details['ingredients'] = ingredients
-    recipe_details['instructions'] = instructions
-    recipe_details['equipment'] = equipment
+    recipe_data['recipe_id'] = recipe.recipe_id
+    recipe_data['title'] = recipe.title
+    recipe_data['servings'] = recipe.servings
+    recipe_data['sourceUrl'] = recipe.sourceUrl
+    recipe_data['image'] = recipe.image
+    recipe_data['prep_mins'] = recipe.prep_mins
+    recipe_data['cooking_mins'] = recipe.cooking_mins
+    recipe_data['ready_mins'] = recipe.ready_mins
+
+    recipe_data['ingredients'] = [{'ingredient_id': ingredient.ingredient_id,
+                                   'name': ingredient.name,
+                                   'amount': ingredient.amount,
+                                   'unit': ingredient.unit}
+                                  for ingredient in recipe.ingredients]
+
+    steps = sorted(recipe.instructions, key=lambda instruction: instruction.step_num)
+    recipe_data['instructions'] = [step.step_instruction for step in steps]
+
+    recipe_data['equipment'] = {equipment.equipment: equipment.equipment
+                                for equipment in recipe.equipment}
+
+    recipe_data['missing_ingredients'] = [{'name': ingredient.name,
+                                           'amount': ingredient.amount,
+                                           'unit': ingredient.unit}
+                                          for ingredient in recipe.ingredients
+                                          if ingredient.ingredient_id not in used_ingredient_ids]
 
-    return recipe_details
+    return recipe_data
 
 
 
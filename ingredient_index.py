@@ -0,0 +1,134 @@
+"""In-memory ingredient catalog: prefix index for autocomplete and fuzzy resolver.
+
+Built once from the ingredients table (or data/top-1k-ingredients.csv when the
+table is empty) and rebuilt in the background when the table changes; the old
+index keeps answering until the new one is swapped in."""
+
+import bisect
+import csv
+import os
+import threading
+import time
+
+import crud
+from ingredient_resolver import IngredientResolver, normalize
+
+
+INGREDIENTS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'data', 'top-1k-ingredients.csv')
+
+# check ingredients table for changes at most this often
+REFRESH_SECS = 60
+
+
+def load_csv_ingredients(path=INGREDIENTS_CSV):
+    """Return list of (ingredient_id, name) tuples from a name;id csv file."""
+
+    with open(path, newline='') as file:
+        return [(int(ingredient_id), name)
+                for name, ingredient_id in csv.reader(file, delimiter=';')]
+
+
+class PrefixIndex:
+    """Immutable sorted arrays of name keys searched with bisect.
+
+    Names starting with the prefix come first, then names with a later word
+    starting with it, so 'sau' finds 'sausage' before 'soy sauce'."""
+
+    def __init__(self, ingredients):
+        self.size = len(ingredients)
+        # (key, ingredient_id, name) for whole names, and for each later word of a name
+        names, words = [], []
+        for ingredient_id, name in ingredients:
+            name_words = normalize(name).split(' ')
+            names.append((' '.join(name_words), ingredient_id, name))
+            for i in range(1, len(name_words)):
+                words.append((' '.join(name_words[i:]), ingredient_id, name))
+        names.sort()
+        words.sort()
+
+        self._names = names
+        self._name_keys = [key for key, _, _ in names]
+        self._words = words
+        self._word_keys = [key for key, _, _ in words]
+
+    def suggest(self, prefix, k=10):
+        """Return up to k (ingredient_id, name) tuples with a word starting with prefix."""
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        suggestions = {}
+        for keys, entries in ((self._name_keys, self._names), (self._word_keys, self._words)):
+            i = bisect.bisect_left(keys, prefix)
+            while i < len(keys) and len(suggestions) < k and keys[i].startswith(prefix):
+                _, ingredient_id, name = entries[i]
+                suggestions.setdefault(ingredient_id, name)
+                i += 1
+
+        return list(suggestions.items())
+
+
+class IngredientCatalog:
+    """Process-wide autocomplete and resolver over the ingredients table."""
+
+    def __init__(self, app, refresh_secs=REFRESH_SECS):
+        self.app = app
+        self.refresh_secs = refresh_secs
+        self.index = PrefixIndex([])
+        self.resolver = IngredientResolver([])
+        self._version = None
+        self._checked_at = None
+        self._rebuilding = threading.Lock()
+
+    def load(self):
+        """Build index from the ingredients table, falling back to the csv file."""
+
+        with self._rebuilding:
+            version = crud.get_ingredients_version()
+            ingredients = crud.get_ingredients() or load_csv_ingredients()
+            # swap in whole new indexes, requests never see a half built one
+            self.index = PrefixIndex(ingredients)
+            self.resolver = IngredientResolver(ingredients)
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def rebuild_async(self):
+        """Rebuild index on a background thread, if not already rebuilding."""
+
+        def rebuild():
+            with self.app.app_context():
+                self.load()
+
+        if not self._rebuilding.locked():
+            threading.Thread(target=rebuild, daemon=True).start()
+
+    def refresh_if_changed(self):
+        """Load index on first use; rebuild in the background if the table changed."""
+
+        if self._checked_at is None:
+            self.load()
+            return
+
+        if time.monotonic() - self._checked_at < self.refresh_secs:
+            return
+
+        self._checked_at = time.monotonic()
+        if crud.get_ingredients_version() != self._version:
+            self.rebuild_async()
+
+    def suggest(self, prefix, k=10):
+        """Return up to k {'ingredient_id', 'name'} suggestions for prefix."""
+
+        self.refresh_if_changed()
+
+        return [{'ingredient_id': ingredient_id, 'name': name}
+                for ingredient_id, name in self.index.suggest(prefix, k)]
+
+    def resolve_many(self, tokens):
+        """Return list of (ingredient_id, name, score) or None, one per ingredient token."""
+
+        self.refresh_if_changed()
+
+        return self.resolver.resolve_many(tokens)
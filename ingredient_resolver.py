@@ -0,0 +1,114 @@
+"""Resolve free-text ingredient tokens to canonical ingredients.
+
+Typos, plurals and odd spacing ('tomatos', ' Eggs') are matched against the
+ingredient list with a precomputed character n-gram index and Dice similarity,
+with an LRU memo for tokens seen before.
+
+A fuzzy match only fixes spelling: it must have the same number of words as
+the token and each word must be close to the typed one, so a correct name
+that isn't in the list ('salmon', 'garlic cloves', 'basil leaves') is kept
+as typed instead of becoming a different ingredient ('salmon fillet')."""
+
+import difflib
+import functools
+
+
+# lowest similarity accepted as a match
+MIN_SCORE = 0.65
+
+# lowest similarity of each typed word to the matched name's word
+MIN_WORD_SCORE = 0.75
+
+
+def normalize(name):
+    """Return lowercased name with single spaces."""
+
+    return ' '.join(name.lower().split())
+
+
+def ngrams(text, n=3):
+    """Return set of character n-grams of text padded with a space on each side."""
+
+    padded = f' {text} '
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def same_words(key, name, min_word_score=MIN_WORD_SCORE):
+    """Return True if name has as many words as key, each a spelling of key's word."""
+
+    key_words, name_words = key.split(' '), name.split(' ')
+    return (len(key_words) == len(name_words)
+            and all(typed == word or difflib.SequenceMatcher(None, typed, word).ratio() >= min_word_score
+                    for typed, word in zip(key_words, name_words)))
+
+
+class IngredientResolver:
+    """Map ingredient tokens to (ingredient_id, name, score), or None when nothing is close."""
+
+    def __init__(self, ingredients, n=3, min_score=MIN_SCORE, memo_size=4096):
+        self.n = n
+        self.min_score = min_score
+
+        # normalized name -> (ingredient_id, name), for exact matches
+        self._exact = {}
+        # (ingredient_id, name, number of n-grams) per ingredient
+        self._ingredients = []
+        # n-gram -> indexes into _ingredients of names containing it
+        self._postings = {}
+
+        for ingredient_id, name in ingredients:
+            key = normalize(name)
+            self._exact[key] = (ingredient_id, name)
+            grams = ngrams(key, n)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(len(self._ingredients))
+            self._ingredients.append((ingredient_id, name, len(grams)))
+
+        # memo per resolver, so a rebuilt resolver starts with an empty memo
+        self._memo = functools.lru_cache(maxsize=memo_size)(self._resolve)
+
+    def resolve(self, token):
+        """Return (ingredient_id, name, score) of closest ingredient, or None."""
+
+        return self._memo(normalize(token))
+
+    def _resolve(self, key):
+        if not key:
+            return None
+
+        # exact name, or exact name with a plural ending dropped, added or fixed
+        for candidate in (key, key[:-1] if key.endswith('s') else None,
+                          key[:-2] if key.endswith('es') else None, key + 's',
+                          key[:-1] + 'es' if key.endswith('s') else None,
+                          key[:-2] + 'ies' if key.endswith('ys') else None):
+            if candidate in self._exact:
+                ingredient_id, name = self._exact[candidate]
+                return (ingredient_id, name, 1.0 if candidate == key else 0.99)
+
+        grams = ngrams(key, self.n)
+        shared = {}
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        ranked = []
+        for i, count in shared.items():
+            num_grams = self._ingredients[i][2]
+            # Dice coefficient of the two n-gram sets
+            score = 2 * count / (len(grams) + num_grams)
+            if score >= self.min_score:
+                # ties go to the name closest in length
+                ranked.append((score, -abs(num_grams - len(grams)), i))
+
+        for score, _, i in sorted(ranked, reverse=True):
+            ingredient_id, name, _ = self._ingredients[i]
+            if same_words(key, normalize(name)):
+                return (ingredient_id, name, score)
+
+        return None
+
+    def resolve_many(self, tokens):
+        """Return list of resolve() results, one per token."""
+
+        resolve = self.resolve
+        return [resolve(token) for token in tokens]
@@ -0,0 +1,247 @@
+"""Per-request instrumentation exported as Prometheus text.
+
+Each request records its SQL statement count and time (from SQLAlchemy engine
+events), time spent calling Spoonacular and Twilio, response size and total
+time, all labelled by route. Requests slower than SLOW_REQUEST_MS are logged
+with the SQL they ran."""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# upper bounds of histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+
+slow_log = logging.getLogger('fridg.slow_requests')
+
+
+# ***** Metrics registry *****
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Histograms by name and labels, plus gauges read when rendered."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (help, buckets, {labels tuple: Histogram})
+        self._histograms = {}
+        # name -> (help, function returning a number or list of (labels dict, number))
+        self._gauges = {}
+
+    def histogram(self, name, help, buckets):
+        """Declare a histogram."""
+
+        self._histograms.setdefault(name, (help, buckets, {}))
+
+    def observe(self, name, value, **labels):
+        _, buckets, series = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def gauge(self, name, help, read):
+        """Declare a gauge whose value(s) read() returns at render time."""
+
+        self._gauges[name] = (help, read)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+
+        lines = []
+        with self._lock:
+            for name, (help, buckets, series) in self._histograms.items():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(key + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(key)} {histogram.sum:g}')
+                    lines.append(f'{name}_count{_labels(key)} {histogram.count}')
+
+        for name, (help, read) in self._gauges.items():
+            try:
+                values = read()
+            except Exception as error:
+                slow_log.warning('could not read gauge %s: %s', name, error)
+                continue
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            if not isinstance(values, list):
+                values = [({}, values)]
+            for labels, value in values:
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    """Return {a="1",b="2"} label string, or '' when there are no labels."""
+
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+metrics = Metrics()
+metrics.histogram('fridg_request_seconds', 'Time to handle a request.', SECONDS_BUCKETS)
+metrics.histogram('fridg_request_sql_statements', 'SQL statements run per request.', COUNT_BUCKETS)
+metrics.histogram('fridg_request_db_seconds', 'Time spent in SQL per request.', SECONDS_BUCKETS)
+metrics.histogram('fridg_request_upstream_seconds', 'Time spent calling an upstream API per request.', SECONDS_BUCKETS)
+metrics.histogram('fridg_response_bytes', 'Response body size.', BYTES_BUCKETS)
+metrics.histogram('fridg_upstream_call_seconds', 'Time of each upstream API call, in or out of requests.', SECONDS_BUCKETS)
+
+
+# ***** Request tracking *****
+
+class RequestStats:
+    """What one request has done so far."""
+
+    def __init__(self, keep_statements):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0
+        # service -> seconds
+        self.upstream = {}
+        # (seconds, statement) when the slow request log is on
+        self.logged_statements = [] if keep_statements else None
+
+
+# stats of the request each thread is handling; streamed responses run SQL after the view returns
+_current = threading.local()
+
+
+def _stats():
+    return getattr(_current, 'stats', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_started
+    stats = _stats()
+    if stats is None:
+        return
+
+    stats.statements += 1
+    stats.db_seconds += seconds
+    if stats.logged_statements is not None and len(stats.logged_statements) < MAX_LOGGED_STATEMENTS:
+        stats.logged_statements.append((seconds, statement))
+
+
+@contextmanager
+def timed(service):
+    """Time a call to an upstream service (spoonacular, twilio)."""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.observe('fridg_upstream_call_seconds', seconds, service=service)
+        stats = _stats()
+        if stats is not None:
+            stats.upstream[service] = stats.upstream.get(service, 0) + seconds
+
+
+def init_app(app, slow_request_ms=None):
+    """Record metrics for every request app handles.
+
+    slow_request_ms defaults to the SLOW_REQUEST_MS environment variable, 0 turns the log off."""
+
+    if slow_request_ms is None:
+        slow_request_ms = float(os.environ.get('SLOW_REQUEST_MS', 0))
+
+    # all engines, including ones created after this
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_request_stats():
+        _current.stats = RequestStats(keep_statements=bool(slow_request_ms))
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = _stats()
+        if stats is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method = request.method
+
+        def finish(size):
+            _current.stats = None
+            _record(stats, route, method, response.status_code, size, slow_request_ms)
+
+        if response.is_streamed:
+            # body (and its SQL) is produced after this hook, record once it's sent
+            response.response = _counting(response.response, finish)
+        else:
+            finish(response.calculate_content_length() or 0)
+
+        return response
+
+
+def _counting(chunks, finish):
+    """Yield chunks of a streamed body, then call finish with its size."""
+
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        finish(size)
+
+
+def _record(stats, route, method, status, size, slow_request_ms):
+    seconds = time.perf_counter() - stats.started
+
+    metrics.observe('fridg_request_seconds', seconds, route=route, method=method)
+    metrics.observe('fridg_request_sql_statements', stats.statements, route=route, method=method)
+    metrics.observe('fridg_request_db_seconds', stats.db_seconds, route=route, method=method)
+    metrics.observe('fridg_response_bytes', size, route=route, method=method)
+    for service, upstream_seconds in stats.upstream.items():
+        metrics.observe('fridg_request_upstream_seconds', upstream_seconds,
+                        route=route, method=method, service=service)
+
+    if slow_request_ms and seconds * 1000 >= slow_request_ms:
+        statements = '\n'.join(f'  {statement_seconds * 1000:.1f} ms  {" ".join(statement.split())}'
+                               for statement_seconds, statement in stats.logged_statements)
+        slow_log.warning('slow request %s %s: %d in %.0f ms, %d statements in %.0f ms, upstream %s\n%s',
+                         method, route, status, seconds * 1000, stats.statements, stats.db_seconds * 1000,
+                         {service: round(s * 1000) for service, s in stats.upstream.items()}, statements)
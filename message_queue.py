@@ -0,0 +1,258 @@
+"""Background sender for queued text messages (shopping lists).
+
+Routes queue messages in the outbound_messages table and return right away.
+A pool of worker threads claims due messages, combines messages going to the
+same number into one SMS, sends them with a reused transport client, retries
+failures with backoff, and records each message's delivery status."""
+
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import instrumentation
+from model import db, Outbound_Message
+
+
+log = logging.getLogger(__name__)
+
+# longest body Twilio accepts for one message
+MAX_BODY_CHARS = 1600
+
+# message a worker is sending; attempts includes the current one
+ClaimedMessage = namedtuple('ClaimedMessage', ['message_id', 'to_number', 'body', 'attempts'])
+
+
+# ***** Transports *****
+
+class TransportError(Exception):
+    """Sending a message failed."""
+
+
+class TwilioTransport:
+    """Send messages with one Twilio client shared by all workers."""
+
+    def __init__(self, account_sid, auth_token, from_number):
+        # import here so the fake transport works without twilio installed
+        from twilio.rest import Client
+
+        self.client = Client(account_sid, auth_token)
+        self.from_number = from_number
+
+    def send(self, to_number, body):
+        """Send a message, return provider's message sid."""
+
+        try:
+            with instrumentation.timed('twilio'):
+                message = self.client.messages.create(to=to_number, from_=self.from_number, body=body)
+        except Exception as error:
+            raise TransportError(str(error)) from error
+
+        return message.sid
+
+
+class FakeTransport:
+    """Pretend to send messages, for tests and benchmarks without network access.
+
+    Each send takes latency seconds and fails with probability failure_rate."""
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # (to_number, body) of every message sent
+        self.sent = []
+        self.failed = 0
+
+    def send(self, to_number, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            if self._random.random() < self.failure_rate:
+                self.failed += 1
+                raise TransportError('fake transport failure')
+            self.sent.append((to_number, body))
+
+        return f'SM{uuid.uuid4().hex}'
+
+
+# ***** Workers *****
+
+class MessageWorkerPool:
+    """Worker threads sending queued messages from the outbound_messages table."""
+
+    def __init__(self, app, transport, num_workers=2, batch_size=20, poll_interval=1.0,
+                 max_attempts=5, backoff=2.0, stale_after=300):
+        self.app = app
+        self.transport = transport
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # messages stuck in 'sending' this long (worker died) are queued again
+        self.stale_after = stale_after
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        # workers in this process take turns claiming
+        self._claim_lock = threading.Lock()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start worker threads, once."""
+
+        with self._start_lock:
+            if self._threads:
+                return
+
+            with self.app.app_context():
+                self.requeue_stale()
+
+            self._stopping.clear()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f'message-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        """Wake up idle workers after queueing a message."""
+
+        self._wakeup.set()
+
+    def stop(self, timeout=5):
+        """Stop workers after their current batch."""
+
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    sent = self.run_once()
+                except Exception as error:
+                    log.exception('message worker error: %s', error)
+                    db.session.rollback()
+                    sent = 0
+                finally:
+                    db.session.remove()
+
+                # keep draining while there's work, otherwise wait to be notified
+                if not sent:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+
+    def run_once(self):
+        """Claim one batch of due messages and send it. Return number of messages handled."""
+
+        messages = self._claim()
+
+        # one SMS per number for everything going to the same phone
+        by_number = {}
+        for message in messages:
+            by_number.setdefault(message.to_number, []).append(message)
+
+        for to_number, group in by_number.items():
+            for chunk in _chunks_by_length(group):
+                self._send(to_number, chunk)
+
+        return len(messages)
+
+    def _claim(self):
+        """Mark a batch of due queued messages as sending and return them as ClaimedMessages."""
+
+        with self._claim_lock:
+            # SKIP LOCKED lets workers in other processes claim different rows
+            rows = (Outbound_Message.query
+                    .filter(Outbound_Message.status == 'queued',
+                            Outbound_Message.next_attempt_at <= datetime.utcnow())
+                    .order_by(Outbound_Message.message_id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all())
+
+            # plain copies, so nothing is reloaded after commit expires the rows
+            messages = [ClaimedMessage(row.message_id, row.to_number, row.body, row.attempts + 1)
+                        for row in rows]
+
+            now = datetime.utcnow()
+            for row in rows:
+                row.status = 'sending'
+                row.claimed_at = now
+                row.attempts += 1
+            db.session.commit()
+
+        return messages
+
+    def _send(self, to_number, messages):
+        """Send messages to one number as one SMS and record the outcome."""
+
+        body = '\n\n'.join(message.body for message in messages)
+
+        try:
+            sid = self.transport.send(to_number, body)
+        except TransportError as error:
+            retry_ids = [message.message_id for message in messages
+                         if message.attempts < self.max_attempts]
+            failed_ids = [message.message_id for message in messages
+                          if message.attempts >= self.max_attempts]
+            next_attempt_at = datetime.utcnow() + self._retry_delay(max(message.attempts for message in messages))
+
+            _update(retry_ids, status='queued', next_attempt_at=next_attempt_at, error=str(error))
+            _update(failed_ids, status='failed', error=str(error))
+        else:
+            _update([message.message_id for message in messages],
+                    status='sent', sent_at=datetime.utcnow(), provider_sid=sid, error=None)
+
+        # record each SMS's outcome right away, so a crash can't resend it
+        db.session.commit()
+
+    def _retry_delay(self, attempts):
+        """Return jittered exponential backoff before the next attempt."""
+
+        return timedelta(seconds=self.backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5))
+
+    def requeue_stale(self):
+        """Queue again messages left in 'sending' by a worker that died."""
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        (Outbound_Message.query
+         .filter(Outbound_Message.status == 'sending', Outbound_Message.claimed_at < cutoff)
+         .update({'status': 'queued'}, synchronize_session=False))
+        db.session.commit()
+
+
+def _update(message_ids, **values):
+    """Set column values on messages by id, without committing."""
+
+    if message_ids:
+        (Outbound_Message.query
+         .filter(Outbound_Message.message_id.in_(message_ids))
+         .update(values, synchronize_session=False))
+
+
+def _chunks_by_length(messages):
+    """Split messages into groups whose combined body fits in one SMS."""
+
+    chunk, length = [], 0
+    for message in messages:
+        # two characters for the blank line between bodies
+        added = len(message.body) + (2 if chunk else 0)
+        if chunk and length + added > MAX_BODY_CHARS:
+            yield chunk
+            chunk, length = [], 0
+            added = len(message.body)
+        chunk.append(message)
+        length += added
+    if chunk:
+        yield chunk
@@ -0,0 +1,273 @@
+"""Versioned schema migrations for databases that already have data.
+
+    python migrations.py                  # apply pending migrations
+    python migrations.py --status         # list applied and pending migrations
+    python migrations.py --explain        # check hot queries use indexes
+
+Applied versions are recorded in the schema_migrations table. On Postgres
+indexes are built with CREATE INDEX CONCURRENTLY, so tables stay writable
+while a migration runs. Fresh databases made with db.create_all() already
+have everything; running the migrations there only records them.
+
+Migration 1 deletes duplicate accounts (copied to merged_users first) and
+migration 2 duplicate saves of the same recipe, so back up before running
+them on a database seeded with duplicates."""
+
+import argparse
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import event, inspect, text
+
+from model import db, Saved_Recipe
+
+
+Migration = namedtuple('Migration', ['version', 'name', 'apply'])
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register function as a migration. It's called with the engine."""
+
+    def register(apply):
+        MIGRATIONS.append(Migration(version, name, apply))
+        return apply
+
+    return register
+
+
+# ***** Helpers *****
+
+def create_index(engine, name, table, columns, unique=False):
+    """Create an index if it doesn't exist, without blocking writes on Postgres."""
+
+    unique_sql = 'UNIQUE ' if unique else ''
+    columns_sql = ', '.join(columns)
+
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(f'CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns_sql})')
+        return
+
+    # CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        # a failed concurrent build leaves an invalid index that IF NOT EXISTS would keep
+        invalid = conn.execute(text('SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                                    'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'),
+                               name=name).first()
+        if invalid:
+            conn.execute(f'DROP INDEX CONCURRENTLY {name}')
+        conn.execute(f'CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns_sql})')
+
+
+def has_table(conn, table):
+    return conn.dialect.has_table(conn, table)
+
+
+# ***** Migrations *****
+
+@migration(1, 'unique index on users.email')
+def unique_user_email(engine):
+    """Merge accounts sharing an email into the oldest one, then make email unique.
+
+    The newer accounts' saved recipes and messages move to the oldest account
+    and their users rows are deleted, so their passwords and phone numbers
+    stop working. The deleted rows are copied to the merged_users table
+    first, with the user_id they were merged into, so they can be restored
+    by hand."""
+
+    with engine.begin() as conn:
+        duplicates = conn.execute('SELECT count(*) FROM users WHERE user_id NOT IN '
+                                  '(SELECT min(user_id) FROM users GROUP BY email)').scalar()
+        if duplicates:
+            conn.execute('CREATE TABLE IF NOT EXISTS merged_users ('
+                         'user_id INTEGER PRIMARY KEY, kept_user_id INTEGER NOT NULL, email VARCHAR NOT NULL, '
+                         'password VARCHAR NOT NULL, phone VARCHAR, merged_at TIMESTAMP NOT NULL)')
+            conn.execute(text('INSERT INTO merged_users (user_id, kept_user_id, email, password, phone, merged_at) '
+                              'SELECT users.user_id, (SELECT min(kept.user_id) FROM users AS kept '
+                              'WHERE kept.email = users.email), users.email, users.password, users.phone, :merged_at '
+                              'FROM users WHERE users.user_id NOT IN (SELECT min(user_id) FROM users GROUP BY email)'),
+                         merged_at=datetime.utcnow())
+
+        for table in ('saved_recipes', 'outbound_messages'):
+            if has_table(conn, table):
+                conn.execute(f'UPDATE {table} SET user_id = ('
+                             f'SELECT min(kept.user_id) FROM users AS kept JOIN users AS owner ON owner.email = kept.email '
+                             f'WHERE owner.user_id = {table}.user_id) '
+                             f'WHERE {table}.user_id NOT IN (SELECT min(users.user_id) FROM users GROUP BY users.email)')
+        conn.execute('DELETE FROM users WHERE user_id NOT IN (SELECT min(user_id) FROM users GROUP BY email)')
+
+    create_index(engine, 'ix_users_email', 'users', ['email'], unique=True)
+
+
+@migration(2, 'unique index on saved_recipes (user_id, recipe_id)')
+def unique_saved_recipe(engine):
+    with engine.begin() as conn:
+        # keep the first save of each recipe
+        conn.execute('DELETE FROM saved_recipes WHERE saved_id NOT IN '
+                     '(SELECT min(saved_id) FROM saved_recipes GROUP BY user_id, recipe_id)')
+
+    create_index(engine, 'ix_saved_recipes_user_id_recipe_id', 'saved_recipes',
+                 ['user_id', 'recipe_id'], unique=True)
+
+
+@migration(3, 'indexes on recipe_id of recipe child tables and recipe_ingredients.ingredient_id')
+def recipe_child_indexes(engine):
+    for table in ('recipe_ingredients', 'instructions', 'equipment'):
+        create_index(engine, f'ix_{table}_recipe_id', table, ['recipe_id'])
+    create_index(engine, 'ix_recipe_ingredients_ingredient_id', 'recipe_ingredients', ['ingredient_id'])
+
+
+@migration(4, 'users.data_version for ETags of saved recipe reads')
+def user_data_version(engine):
+    with engine.begin() as conn:
+        if 'data_version' not in {column['name'] for column in inspect(conn).get_columns('users')}:
+            # constant default, so postgres doesn't rewrite the table
+            conn.execute('ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+
+
+# ***** Runner *****
+
+def ensure_migrations_table(engine):
+    with engine.begin() as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS schema_migrations ('
+                     'version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)')
+
+
+def applied_versions(engine):
+    """Return set of applied migration versions."""
+
+    ensure_migrations_table(engine)
+    with engine.connect() as conn:
+        return {version for version, in conn.execute('SELECT version FROM schema_migrations')}
+
+
+def migrate(engine=None, verbose=False):
+    """Create missing tables, then apply pending migrations in order. Return versions applied."""
+
+    engine = engine or db.engine
+
+    # tables added since the database was created (no-op for existing ones)
+    db.Model.metadata.create_all(bind=engine)
+
+    done = applied_versions(engine)
+    applied = []
+    for version, name, apply in sorted(MIGRATIONS):
+        if version in done:
+            continue
+        if verbose:
+            print(f'applying {version}: {name}')
+        apply(engine)
+        with engine.begin() as conn:
+            conn.execute(text('INSERT INTO schema_migrations (version, name, applied_at) '
+                              'VALUES (:version, :name, :applied_at)'),
+                         version=version, name=name, applied_at=datetime.utcnow())
+        applied.append(version)
+
+    return applied
+
+
+# ***** Index usage check *****
+
+def hot_queries(user_id, recipe_id):
+    """Return list of (description, statement, parameters) run by the hot crud lookups."""
+
+    import crud
+
+    email = crud.get_identity(user_id).email
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    lookups = [('get_login', lambda: crud.get_login(email)),
+               ('get_identity', lambda: crud.get_identity(user_id)),
+               ('get_data_version', lambda: crud.get_data_version(user_id)),
+               ('get_a_saved_recipe', lambda: crud.get_a_saved_recipe(recipe_id, user_id)),
+               ('get_saved_recipe_ids', lambda: crud.get_saved_recipe_ids(user_id)),
+               ('get_saved_recipe_page', lambda: crud.get_saved_recipe_page(user_id)),
+               ('get_saved_recipe_columns', lambda: crud.get_saved_recipe_columns(recipe_id, user_id)),
+               ('get_recipe_columns', lambda: crud.get_recipe_columns(recipe_id)),
+               ('get_recipe_children_columns', lambda: crud.get_recipe_children_columns(recipe_id)),
+               ('get_recipe_summary_rows', lambda: crud.get_recipe_summary_rows([recipe_id])),
+               ('get_recipe', lambda: crud.get_recipe(recipe_id))]
+
+    queries = []
+    for description, lookup in lookups:
+        db.session.expire_all()
+        statements.clear()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            lookup()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        for i, (statement, parameters) in enumerate(statements):
+            queries.append((f'{description} #{i + 1}', statement, parameters))
+
+    db.session.rollback()
+    return queries
+
+
+def full_scans(engine, statement, parameters):
+    """Return list of plan lines that read a whole table instead of using an index."""
+
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            # tiny tables are cheaper to scan; ask whether an index *can* be used
+            conn.execute('SET enable_seqscan = off')
+            plan = [line for line, in conn.execute('EXPLAIN ' + statement, parameters)]
+            conn.execute('RESET enable_seqscan')
+            return [line.strip() for line in plan if 'Seq Scan' in line]
+
+        plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        # 'SCAN users' reads every row; 'SEARCH users USING INDEX' doesn't
+        return [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line
+                and 'CONSTANT ROW' not in line]
+
+
+def check_index_usage(user_id, recipe_id, engine=None):
+    """Return list of (description, full scan plan lines) for hot queries that don't use an index.
+
+    user_id and recipe_id should be a user and one of their saved recipes."""
+
+    engine = engine or db.engine
+
+    problems = []
+    for description, statement, parameters in hot_queries(user_id, recipe_id):
+        scans = full_scans(engine, statement, parameters)
+        if scans:
+            problems.append((description, scans))
+
+    return problems
+
+
+if __name__ == '__main__':
+    from server import app
+    from model import connect_to_db
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='database uri (default DATABASE_URL or postgresql:///recipes)')
+    parser.add_argument('--status', action='store_true', help='list migrations and exit')
+    parser.add_argument('--explain', action='store_true', help='check hot queries use indexes and exit')
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db)
+    with app.app_context():
+        if args.status:
+            done = applied_versions(db.engine)
+            for version, name, _ in sorted(MIGRATIONS):
+                print(f'{"applied" if version in done else "pending"}  {version}: {name}')
+
+        elif args.explain:
+            saved = db.session.query(Saved_Recipe.recipe_id, Saved_Recipe.user_id).first()
+            if saved is None:
+                raise SystemExit('need at least one saved recipe to check')
+            problems = check_index_usage(saved.user_id, saved.recipe_id)
+            for description, scans in problems:
+                print(f'{description}: {"; ".join(scans)}')
+            print('all hot queries use indexes' if not problems else f'{len(problems)} queries scan whole tables')
+
+        else:
+            applied = migrate(verbose=True)
+            print(f'applied {len(applied)} migrations' if applied else 'database is up to date')
@@ -1,9 +1,14 @@
 """Models for ingredient recipe app"""
 
-from flask_sqlalchemy import SQLAlchemy
+import os
+from datetime import datetime
 
-# Instance of SQLAlchemy
-db = SQLAlchemy()
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+import db_routing
+
+# Instance of SQLAlchemy, sending reads from @read_only routes to replicas
+db = db_routing.RoutingSQLAlchemy()
 
 
 class User(db.Model):
@@ -14,12 +19,14 @@ class User(db.Model):
     user_id = db.Column(db.Integer,
                          autoincrement=True,
                          primary_key=True)
-    email = db.Column(db.String, nullable=False)
+    email = db.Column(db.String, nullable=False, unique=True, index=True)
     password = db.Column(db.String, nullable=False)
     phone = db.Column(db.String(12), nullable=False)
+    # bumped by every write to the user's saved recipes, ETags of their reads come from it
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # list of user's saved recipes
-    saved_recipes = db.relationship('Saved_Recipe', lazy='joined')
+    saved_recipes = db.relationship('Saved_Recipe', lazy='select')
 
     def __repr__(self):
         return f'<User user_id={self.user_id} email={self.email}>'
@@ -48,10 +55,14 @@ class Saved_Recipe(db.Model):
     rating = db.Column(db.Integer)
     comment = db.Column(db.String)
 
+    # each recipe saved once per user; also serves lookups by user_id alone
+    __table_args__ = (db.Index('ix_saved_recipes_user_id_recipe_id',
+                               'user_id', 'recipe_id', unique=True),)
+
     # recipe that was saved
-    recipe = db.relationship('Recipe', lazy='joined')
+    recipe = db.relationship('Recipe', lazy='select')
     # user who saved the recipe
-    user = db.relationship('User', lazy='joined')
+    user = db.relationship('User', lazy='select')
 
     def __repr__(self):
         return f'<User\'s selected recipes recipe={self.recipe_id} user={self.user_id} is_favorite={self.favorite}>'
@@ -84,13 +95,13 @@ class Recipe(db.Model):
     ready_mins = db.Column(db.Integer)
 
     # list of recipe's ingredients
-    ingredients = db.relationship('Recipe_Ingredient', lazy='joined')
+    ingredients = db.relationship('Recipe_Ingredient', lazy='select')
     # list of recipe's instructions by steps (length is number of steps)
-    instructions = db.relationship('Instructions', lazy='joined')
+    instructions = db.relationship('Instructions', lazy='select', order_by='Instructions.step_num')
     # list of instances this recipe is saved by many different users
-    saved_recipe_users = db.relationship('Saved_Recipe', lazy='joined')
+    saved_recipe_users = db.relationship('Saved_Recipe', lazy='select')
     # list of recipe's equipment(s)
-    equipment = db.relationship('Equipment', lazy='joined')
+    equipment = db.relationship('Equipment', lazy='select')
 
 
     def __repr__(self):
@@ -119,14 +130,15 @@ class Recipe_Ingredient(db.Model):
                          autoincrement=True,
                          primary_key=True)
     recipe_id = db.Column(db.Integer,
-                          db.ForeignKey('recipes.recipe_id'))
-    ingredient_id = db.Column(db.Integer)
+                          db.ForeignKey('recipes.recipe_id'),
+                          index=True)
+    ingredient_id = db.Column(db.Integer, index=True)
     amount = db.Column(db.Float(precision=2))
     unit = db.Column(db.String)
     name = db.Column(db.String)
 
     # the recipe the ingredient is part of
-    recipe = db.relationship('Recipe', lazy='joined')
+    recipe = db.relationship('Recipe', lazy='select')
 
     def __repr__(self):
         return f'<Recipe Ingredient recipe={self.recipe_id} ingredient={self.name}>'
@@ -149,13 +161,14 @@ class Instructions(db.Model):
                          autoincrement=True,
                          primary_key=True)
     recipe_id = db.Column(db.Integer,
-                          db.ForeignKey('recipes.recipe_id'))
+                          db.ForeignKey('recipes.recipe_id'),
+                          index=True)
     step_num = db.Column(db.Integer)
     step_instruction = db.Column(db.String)
 
 
     # recipe the instructions are for
-    recipe = db.relationship('Recipe', lazy='joined')
+    recipe = db.relationship('Recipe', lazy='select')
 
     def __repr__(self):
         return f'<Instructions recipe={self.recipe_id} step={self.step_num}>'
@@ -176,11 +189,12 @@ class Equipment(db.Model):
                          autoincrement=True,
                          primary_key=True)
     recipe_id = db.Column(db.Integer,
-                          db.ForeignKey('recipes.recipe_id'))
+                          db.ForeignKey('recipes.recipe_id'),
+                          index=True)
     equipment = db.Column(db.String)
 
     # recipe the equipment is part of
-    recipe = db.relationship('Recipe', lazy='joined')
+    recipe = db.relationship('Recipe', lazy='select')
 
     def __repr__(self):
         return f'<Equipment recipe={self.recipe_id} equipment={self.equipment}>'
@@ -191,13 +205,154 @@ class Equipment(db.Model):
                 'equipment': self.equipment}
     
 
-def connect_to_db(flask_app, db_uri='postgresql:///recipes', echo=True):
+class Ingredient(db.Model):
+    """An ingredient users can search by (top 1k ingredients list)."""
+
+    __tablename__ = 'ingredients'
+
+    ingredient_id = db.Column(db.Integer,
+                              primary_key=True,
+                              autoincrement=False)
+    name = db.Column(db.String)
+
+    def __repr__(self):
+        return f'<Ingredient ingredient_id={self.ingredient_id} name={self.name}>'
+
+    def as_dict(self):
+        return {'ingredient_id': self.ingredient_id,
+                'name': self.name}
+
+
+class Outbound_Message(db.Model):
+    """A text message queued to be sent by the message workers."""
+
+    __tablename__ = 'outbound_messages'
+
+    message_id = db.Column(db.Integer,
+                           autoincrement=True,
+                           primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.user_id'))
+    to_number = db.Column(db.String(16), nullable=False)
+    body = db.Column(db.String, nullable=False)
+    # queued -> sending -> sent, or back to queued for a retry, or failed
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # when a worker last claimed the message for sending
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    # message sid from the SMS provider
+    provider_sid = db.Column(db.String)
+    error = db.Column(db.String)
+
+    # workers look for due queued messages
+    __table_args__ = (db.Index('ix_outbound_messages_status_next_attempt_at',
+                               'status', 'next_attempt_at'),)
+
+    def __repr__(self):
+        return f'<Outbound_Message message_id={self.message_id} to={self.to_number} status={self.status}>'
+
+    def as_dict(self):
+        return {'message_id': self.message_id,
+                'status': self.status,
+                'attempts': self.attempts,
+                'created_at': self.created_at,
+                'sent_at': self.sent_at,
+                'error': self.error}
+
+
+# ***** Load profiles *****
+# Relationships load lazily by default. Queries pick the cheapest profile they
+# need instead of every query joining the whole graph:
+#   identity - only the columns needed to identify the row
+#   summary  - row's own columns (plus recipe card columns for saved recipes)
+#   full     - everything needed to render recipe details; collections are
+#              loaded with one SELECT ... IN per collection, never joined,
+#              so rows don't multiply as ingredients x instructions x equipment
+
+_RECIPE_SUMMARY_COLUMNS = (Recipe.recipe_id, Recipe.title, Recipe.image, Recipe.servings,
+                           Recipe.sourceUrl, Recipe.cooking_mins, Recipe.prep_mins,
+                           Recipe.ready_mins)
+
+LOAD_PROFILES = {
+    Recipe: {
+        'identity': (load_only(Recipe.recipe_id),),
+        'summary': (load_only(*_RECIPE_SUMMARY_COLUMNS),),
+        'full': (selectinload(Recipe.ingredients),
+                 selectinload(Recipe.instructions),
+                 selectinload(Recipe.equipment)),
+    },
+    Saved_Recipe: {
+        'identity': (load_only(Saved_Recipe.saved_id, Saved_Recipe.recipe_id,
+                               Saved_Recipe.user_id, Saved_Recipe.favorite),),
+        # many-to-one join adds no rows
+        'summary': (joinedload(Saved_Recipe.recipe).load_only(*_RECIPE_SUMMARY_COLUMNS),),
+        'full': (joinedload(Saved_Recipe.recipe).selectinload(Recipe.ingredients),
+                 joinedload(Saved_Recipe.recipe).selectinload(Recipe.instructions),
+                 joinedload(Saved_Recipe.recipe).selectinload(Recipe.equipment)),
+    },
+    User: {
+        'identity': (load_only(User.user_id, User.email),),
+        'summary': (),
+        'full': (selectinload(User.saved_recipes).joinedload(Saved_Recipe.recipe).selectinload(Recipe.ingredients),
+                 selectinload(User.saved_recipes).joinedload(Saved_Recipe.recipe).selectinload(Recipe.instructions),
+                 selectinload(User.saved_recipes).joinedload(Saved_Recipe.recipe).selectinload(Recipe.equipment)),
+    },
+}
+
+
+def load_profile(model, name):
+    """Return tuple of query options for a model's named load profile."""
+
+    return LOAD_PROFILES[model][name]
+
+
+def connect_to_db(flask_app, db_uri=None, echo=False, pool_size=None, max_overflow=None,
+                  pool_recycle=None, pool_pre_ping=True, statement_timeout_ms=None, replica_uris=None):
+    """Connect app to the primary db and any read replicas.
+
+    Settings not given come from DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE, DB_STATEMENT_TIMEOUT_MS and DB_REPLICA_URLS (comma separated)."""
+
+    env = os.environ
+    if db_uri is None:
+        db_uri = env.get('DATABASE_URL', 'postgresql:///recipes')
+    if replica_uris is None:
+        replica_uris = [uri for uri in env.get('DB_REPLICA_URLS', '').split(',') if uri]
+
+    engine_options = {'pool_pre_ping': pool_pre_ping}
+    # sqlite gets its pool from Flask-SQLAlchemy, queue pool settings don't apply
+    if not db_uri.startswith('sqlite'):
+        # an explicit 0 is a setting too, only None falls back to the environment
+        if pool_size is None:
+            pool_size = int(env.get('DB_POOL_SIZE', 10))
+        if max_overflow is None:
+            max_overflow = int(env.get('DB_MAX_OVERFLOW', 20))
+        if pool_recycle is None:
+            pool_recycle = int(env.get('DB_POOL_RECYCLE', 1800))
+        engine_options['pool_size'] = pool_size
+        engine_options['max_overflow'] = max_overflow
+        engine_options['pool_recycle'] = pool_recycle
+
+    if statement_timeout_ms is None:
+        statement_timeout_ms = int(env.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout_ms and db_uri.startswith('postgres'):
+        # set for every connection, so a runaway query can't hold a connection forever
+        engine_options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    flask_app.config['SQLALCHEMY_BINDS'] = db_routing.replica_binds(replica_uris)
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
     flask_app.config['SQLALCHEMY_ECHO'] = echo
     flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
     db.app = flask_app
     db.init_app(flask_app)
+    if 'db_routing' not in flask_app.extensions:
+        db_routing.init_app(flask_app)
+        flask_app.extensions['db_routing'] = True
 
     print('Connected to the db!')
 
@@ -205,9 +360,8 @@ if __name__ == '__main__':
     from server import app
     import os
 
-    # Call connect_to_db(app, echo=False) if your program output gets
-    # too annoying; this will tell SQLAlchemy not to print out every
-    # query it executes.
+    # Call connect_to_db(app, echo=True) to have SQLAlchemy print out
+    # every query it executes.
 
     # Drop and create db
     os.system('dropdb recipes')
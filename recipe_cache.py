@@ -0,0 +1,111 @@
+"""Process-wide cache of rendered recipe documents.
+
+Recipes never change once saved from Spoonacular, so their JSON (details and
+recipe card summary) is rendered once and kept in a size-bounded LRU keyed by
+(kind, recipe_id). Per-user fields like favorite are added at response time.
+Unsaving a recipe leaves it in the catalog, so nothing needs invalidating."""
+
+import collections
+import os
+import threading
+
+
+# kinds of document cached per recipe
+DETAILS = 'details'
+SUMMARY = 'summary'
+
+
+class RecipeDocumentCache:
+    """LRU of encoded JSON documents, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (kind, recipe_id) -> bytes, least recently used first
+        self._documents = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return cached document, or None."""
+
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                self.misses += 1
+                return None
+            self._documents.move_to_end(key)
+            self.hits += 1
+            return document
+
+    def put(self, key, document):
+        """Cache document, evicting least recently used ones to stay under max_bytes."""
+
+        # one huge document shouldn't empty the cache
+        if len(document) > self.max_bytes // 8:
+            return
+
+        with self._lock:
+            old = self._documents.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._documents[key] = document
+            self.bytes += len(document)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._documents.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """Return cached document, or load() it and cache it. load may return None (not found)."""
+
+        document = self.get(key)
+        if document is None:
+            document = load()
+            if document is not None:
+                self.put(key, document)
+        return document
+
+    def get_many(self, kind, recipe_ids, load_many):
+        """Return dictionary of recipe_id to document for recipe_ids.
+
+        load_many(missing_ids) returns a dictionary of documents for the ids not cached."""
+
+        documents = {}
+        missing = []
+        for recipe_id in recipe_ids:
+            document = self.get((kind, recipe_id))
+            if document is None:
+                missing.append(recipe_id)
+            else:
+                documents[recipe_id] = document
+
+        if missing:
+            loaded = load_many(missing)
+            for recipe_id, document in loaded.items():
+                self.put((kind, recipe_id), document)
+            documents.update(loaded)
+
+        return documents
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return dictionary of cache counters and memory use."""
+
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._documents),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions}
+
+
+cache = RecipeDocumentCache(max_bytes=int(os.environ.get('RECIPE_CACHE_MAX_BYTES', 32 * 1024 * 1024)))
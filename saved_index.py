@@ -0,0 +1,68 @@
+"""Per-user index of saved recipe ids, for cheap "is this recipe saved?" checks."""
+
+import collections
+import threading
+import time
+
+import batch
+import crud
+
+
+class SavedRecipeIndex:
+    """LRU cache of each user's {recipe_id: favorite} membership dictionary.
+
+    Entries are dropped when the user saves, favorites, or removes a recipe
+    (after the commit, for batches), and expire after ttl seconds so writes
+    handled by other workers show up."""
+
+    def __init__(self, max_users=10000, ttl=60):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user_id -> (loaded_at, {recipe_id: favorite}), least recently used first
+        self._users = collections.OrderedDict()
+        # user_id -> number of invalidations, so a load that raced one isn't stored
+        self._generations = {}
+
+    def get(self, user_id):
+        """Return dictionary of user's saved recipe_ids to favorite flag."""
+
+        if batch.in_batch():
+            # see the batch's own uncommitted saves, and don't keep them past a rollback
+            return crud.get_saved_recipe_ids(user_id)
+
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._users.move_to_end(user_id)
+                return entry[1]
+            generation = self._generations.get(user_id, 0)
+
+        saved = crud.get_saved_recipe_ids(user_id)
+
+        with self._lock:
+            # invalidated while loading, saved may be missing the change
+            if self._generations.get(user_id, 0) != generation:
+                return saved
+            self._users[user_id] = (time.monotonic(), saved)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+        return saved
+
+    def is_saved(self, user_id, recipe_id):
+        """Return True if user saved recipe."""
+
+        return recipe_id in self.get(user_id)
+
+    def invalidate(self, user_id):
+        """Forget user's cached saved recipes after they change."""
+
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+
+# one index per process, shared by all requests
+index = SavedRecipeIndex()
@@ -0,0 +1,220 @@
+"""Shared response cache for Spoonacular's complexSearch.
+
+Keyed on the normalized ingredient set plus the other request parameters, with
+TTL and LRU eviction, a pluggable backend (in-process or a SQLite file shared
+by all workers), and single-flight coalescing of concurrent identical misses."""
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# ***** Cache keys *****
+
+def normalize_ingredients(ingredients_str):
+    """Return sorted, lowercased, de-duplicated list of comma-separated ingredients.
+
+    'egg, milk' and 'Milk,egg' both become ['egg', 'milk']."""
+
+    return sorted({' '.join(ingredient.lower().split())
+                   for ingredient in ingredients_str.split(',')
+                   if ingredient.strip()})
+
+
+def make_key(payload):
+    """Return cache key for a complexSearch payload.
+
+    The api key is left out so rotating it doesn't empty the cache."""
+
+    params = {param: value for param, value in payload.items() if param != 'apiKey'}
+    params['includeIngredients'] = normalize_ingredients(params.get('includeIngredients', ''))
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+# ***** Backends *****
+
+class MemoryBackend:
+    """In-process LRU cache, only shared by threads of this worker."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """LRU cache in a SQLite file, shared by every worker on the host.
+
+    last_used is only rewritten when it's more than touch_interval seconds
+    old, so most hits are a plain read instead of a write that takes the
+    file's write lock. Eviction order is accurate to touch_interval."""
+
+    def __init__(self, path, max_entries=1000, touch_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        # sqlite connections can't be shared across threads
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS search_cache ('
+                     'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                     'expires_at REAL NOT NULL, last_used REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS search_cache_last_used '
+                     'ON search_cache (last_used)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute('SELECT value, expires_at, last_used FROM search_cache WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at, last_used = row
+        if expires_at < now:
+            with conn:
+                conn.execute('DELETE FROM search_cache WHERE key = ?', (key,))
+            return None
+        if now - last_used > self.touch_interval:
+            with conn:
+                conn.execute('UPDATE search_cache SET last_used = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(value), now + ttl, now))
+            # evict least recently used entries over the limit
+            conn.execute('DELETE FROM search_cache WHERE key IN '
+                         '(SELECT key FROM search_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                         (self.max_entries,))
+
+    def __len__(self):
+        return self._conn().execute('SELECT count(*) FROM search_cache').fetchone()[0]
+
+
+# ***** Cache *****
+
+class _Call:
+    """An upstream request in flight that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """TTL cache in front of a fetch function, coalescing concurrent misses."""
+
+    def __init__(self, backend, ttl=6 * 60 * 60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        # key -> _Call for upstream requests in flight
+        self._calls = {}
+
+    def get_or_fetch(self, key, fetch):
+        """Return cached value for key, or call fetch() once for all concurrent callers."""
+
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fetch()
+            self.backend.set(key, call.value, self.ttl)
+            return call.value
+        except Exception as error:
+            # failures are not cached, waiting callers see the same error
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Return dictionary of cache counters."""
+
+        lookups = self.hits + self.misses + self.coalesced
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_ratio': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                'entries': len(self.backend),
+                'backend': type(self.backend).__name__}
+
+
+def cache_from_env():
+    """Create cache configured by SEARCH_CACHE_* environment variables."""
+
+    max_entries = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 1000))
+    ttl = int(os.environ.get('SEARCH_CACHE_TTL', 6 * 60 * 60))
+
+    if os.environ.get('SEARCH_CACHE_BACKEND', 'memory') == 'sqlite':
+        path = os.environ.get('SEARCH_CACHE_PATH', 'search_cache.sqlite3')
+        backend = SQLiteBackend(path, max_entries=max_entries)
+    else:
+        backend = MemoryBackend(max_entries=max_entries)
+
+    return ResponseCache(backend, ttl=ttl)
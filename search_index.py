@@ -0,0 +1,121 @@
+"""Local ingredient search over recipes already stored in the db.
+
+Inverted index of ingredient_id -> recipe_ids, built from recipe_ingredients
+and kept up to date as recipes are added to the db. Recipes stay in the
+catalog when users unsave them, so nothing is ever removed."""
+
+import heapq
+import threading
+import time
+
+from model import db, Recipe_Ingredient
+
+
+# rebuild from db at most this often, so recipes added by other workers show up
+REBUILD_SECS = 300
+
+
+class IngredientSearchIndex:
+    """Inverted index from ingredient_id to the recipe_ids that use it."""
+
+    def __init__(self, rebuild_secs=REBUILD_SECS):
+        self.rebuild_secs = rebuild_secs
+        self._lock = threading.Lock()
+        # one build at a time, so a cold start doesn't run the query once per request
+        self._build_lock = threading.Lock()
+        # ingredient_id -> set of recipe_ids using that ingredient
+        self._postings = {}
+        # recipe_id -> set of the recipe's ingredient_ids
+        self._recipes = {}
+        # lowercased ingredient name -> ingredient_id
+        self._names = {}
+        self._built_at = None
+
+    def build(self):
+        """(Re)build the whole index from the recipe_ingredients table."""
+
+        rows = db.session.query(Recipe_Ingredient.recipe_id,
+                                Recipe_Ingredient.ingredient_id,
+                                Recipe_Ingredient.name).all()
+
+        postings, recipes, names = {}, {}, {}
+        for recipe_id, ingredient_id, name in rows:
+            postings.setdefault(ingredient_id, set()).add(recipe_id)
+            recipes.setdefault(recipe_id, set()).add(ingredient_id)
+            if name:
+                names[name.strip().lower()] = ingredient_id
+
+        # swap in new index all at once so searches never see a half built index
+        with self._lock:
+            self._postings, self._recipes, self._names = postings, recipes, names
+            self._built_at = time.monotonic()
+
+    def ensure_built(self):
+        """Build index on first use, and rebuild when older than rebuild_secs."""
+
+        if not self._stale():
+            return
+
+        if self._built_at is None:
+            # nothing to search yet, wait for the thread building it
+            with self._build_lock:
+                if self._built_at is None:
+                    self.build()
+        elif self._build_lock.acquire(blocking=False):
+            # others keep searching the old index while this thread rebuilds
+            try:
+                if self._stale():
+                    self.build()
+            finally:
+                self._build_lock.release()
+
+    def _stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at > self.rebuild_secs
+
+    def add_recipe(self, recipe_id, ingredients):
+        """Add a recipe's ingredients (list of dicts like parse_API_recipe_details) to index."""
+
+        with self._lock:
+            ingredient_ids = self._recipes.setdefault(recipe_id, set())
+            for ingredient in ingredients:
+                ingredient_id = ingredient['ingredient_id']
+                ingredient_ids.add(ingredient_id)
+                self._postings.setdefault(ingredient_id, set()).add(recipe_id)
+                if ingredient.get('name'):
+                    self._names[ingredient['name'].strip().lower()] = ingredient_id
+
+    def resolve_names(self, names):
+        """Return set of known ingredient_ids for a list of ingredient names."""
+
+        return {self._names[name.strip().lower()]
+                for name in names
+                if name.strip().lower() in self._names}
+
+    def search(self, ingredient_ids, number=10):
+        """Return up to number (recipe_id, used_ids, missing_ids) tuples.
+
+        Ranked like Spoonacular's max-used-ingredients sort: most of the given
+        ingredients used first, then fewest missing ingredients."""
+
+        ingredient_ids = set(ingredient_ids)
+
+        with self._lock:
+            # count how many of the given ingredients each candidate recipe uses
+            used_counts = {}
+            for ingredient_id in ingredient_ids:
+                for recipe_id in self._postings.get(ingredient_id, ()):
+                    used_counts[recipe_id] = used_counts.get(recipe_id, 0) + 1
+
+            ranked = heapq.nsmallest(number, used_counts,
+                                     key=lambda recipe_id: (-used_counts[recipe_id],
+                                                            len(self._recipes[recipe_id]) - used_counts[recipe_id],
+                                                            recipe_id))
+
+            return [(recipe_id,
+                     self._recipes[recipe_id] & ingredient_ids,
+                     self._recipes[recipe_id] - ingredient_ids)
+                    for recipe_id in ranked]
+
+
+# one index per process, shared by all requests
+index = IngredientSearchIndex()
@@ -7,6 +7,7 @@ import csv
 
 # Import dabase model, crud, and server
 import crud
+import migrations
 import model
 import server
 
@@ -19,6 +20,8 @@ model.connect_to_db(server.app)
 
 # Create tables from classes inherited from db.model
 model.db.create_all()
+# record schema version, tables already have every migration's indexes
+migrations.migrate()
 
 # read and open ingredients csv
 file = open('data/top-1k-ingredients.csv', newline='')
@@ -30,4 +33,4 @@ ingredients_data = {row[1]:row[0] for row in data}
 # loop over ingredients dictionary
 for ingredient in ingredients_data:
     # create an ingredient and save to db
-    crud.create_ingredient(ingredient_id=ingredient, name=ingredients_data[ingredient])
+    crud.create_ingredient(ingredient_id=int(ingredient), name=ingredients_data[ingredient])
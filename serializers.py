@@ -0,0 +1,119 @@
+"""JSON for recipes, saved recipes and thoughts, built straight from column rows.
+
+Rows come from crud's column queries (get_saved_recipe_columns,
+get_recipe_columns, get_recipe_children_columns, get_recipe_summary_rows), so
+no ORM objects or as_dict() copies are made. Cached documents are spliced into
+responses as RawJSON without decoding them. Encoding uses orjson when it's
+installed and the standard library json module otherwise."""
+
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_bytes(obj):
+    """Return obj encoded as compact UTF-8 JSON."""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def dumps(obj):
+    """Return obj encoded as a compact JSON string."""
+
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def json_response(obj, status=200):
+    """Return Response with obj as its JSON body, like jsonify."""
+
+    return Response(dumps_bytes(obj), status=status, mimetype='application/json')
+
+
+class RawJSON(bytes):
+    """Already encoded JSON, inserted as is by dumps_object."""
+
+
+def dumps_object(fields):
+    """Return JSON object bytes of a dictionary whose values may be RawJSON."""
+
+    return b'{' + b','.join(dumps_bytes(key) + b':' + (value if isinstance(value, RawJSON) else dumps_bytes(value))
+                            for key, value in fields.items()) + b'}'
+
+
+def dumps_array(items):
+    """Return JSON array bytes of a list whose items may be RawJSON."""
+
+    return b'[' + b','.join(item if isinstance(item, RawJSON) else dumps_bytes(item) for item in items) + b']'
+
+
+def extend_object(document, fields):
+    """Return RawJSON of an encoded JSON object with fields added at the end."""
+
+    if not fields:
+        return RawJSON(document)
+    extra = dumps_bytes(fields)
+    if document == b'{}':
+        return RawJSON(extra)
+    return RawJSON(document[:-1] + b',' + extra[1:])
+
+
+# ***** Rows to dictionaries *****
+
+def recipe_details(recipe_row, ingredient_rows, step_rows, equipment_rows):
+    """Return a recipe's details dictionary.
+
+    recipe_row has crud.RECIPE_COLUMNS's fields; the other rows come from
+    crud.get_recipe_children_columns."""
+
+    return {'recipe_id': recipe_row.recipe_id,
+            'title': recipe_row.title,
+            'image': recipe_row.image,
+            'servings': recipe_row.servings,
+            'sourceUrl': recipe_row.sourceUrl,
+            'cooking_mins': recipe_row.cooking_mins,
+            'prep_mins': recipe_row.prep_mins,
+            'ready_mins': recipe_row.ready_mins,
+            'ingredients': [{'rec_ing_id': rec_ing_id, 'recipe_id': recipe_id, 'ingredient_id': ingredient_id,
+                             'amount': amount, 'unit': unit, 'name': name}
+                            for rec_ing_id, recipe_id, ingredient_id, amount, unit, name in ingredient_rows],
+            'instructions': [step for step, in step_rows],
+            'equipment': {equipment: equipment for equipment, in equipment_rows}}
+
+
+def stars(rating):
+    """Return rating as the list of stars the frontend checks, 3 -> [1, 2, 3]."""
+
+    return list(range(1, rating + 1)) if rating else []
+
+
+def thoughts(saved_row):
+    """Return a user's thoughts on a saved recipe; rating becomes a list of stars."""
+
+    return {'saved_id': saved_row.saved_id,
+            'recipe_id': saved_row.recipe_id,
+            'user_id': saved_row.user_id,
+            'favorite': saved_row.favorite,
+            'tried': saved_row.tried,
+            'rating': stars(saved_row.rating),
+            'comment': saved_row.comment}
+
+
+def recipe_summary(row):
+    """Return dictionary of a recipe summary row, for recipe cards (favorite is added per user)."""
+
+    return {'recipe_id': row.recipe_id,
+            'title': row.title,
+            'image': row.image,
+            'servings': row.servings,
+            'prep_mins': row.prep_mins,
+            'cooking_mins': row.cooking_mins,
+            'ready_mins': row.ready_mins}
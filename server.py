@@ -1,23 +1,35 @@
 """Server for recipes based on fridge ingredients app."""
 
 # importing flask library
-from flask import (Flask, render_template, request, flash, session, redirect, jsonify)
+from flask import (Flask, Response, render_template, request, flash, session, redirect, jsonify, stream_with_context, g)
 # from flask_debugtoolbar import DebugToolbarExtension
 
 import os # to access api key
-import requests # make http requests to api
+import functools
+import hmac
 import json
-from pprint import pprint
+import logging
 
 # import jinja 2 to make it throw errors for undefined variables
 from jinja2 import StrictUndefined
 
 from model import connect_to_db, db
+from db_routing import read_only, pool_stats
 import crud # operations for db
+import assets
+import batch
 import helper_functions
-
-# import twilio SDK
-from twilio.rest import Client
+import search_index
+import search_cache
+import saved_index
+import spoonacular
+import message_queue
+import catalog_warmer
+import compression
+import ingredient_index
+import instrumentation
+import serializers
+import recipe_cache
 
 
 # instance of Flask class, store as app
@@ -26,12 +38,77 @@ app = Flask(__name__)
 app.secret_key = "secretkey"
 app.jinja_env.undefined = StrictUndefined
 
+# route debug logging is off unless LOG_LEVEL=DEBUG (or running server.py directly)
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'WARNING'))
+
+# per-route SQL, upstream and response size metrics for /metrics
+instrumentation.init_app(app)
+# gzip/brotli for /api; after_request hooks run last-registered first, so metrics count compressed bytes
+compression.init_app(app)
+
 # Spoonacular API key
 API_KEY = os.environ["SPOONACULAR_KEY"]
 # Twilio account SID
 TWILIO_SID = os.environ["TWILIO_SID"]
 # Twilio Auth Token
 TWILIO_TOKEN = os.environ["TWILIO_TOKEN"]
+# Twilio number shopping lists are sent from
+TWILIO_FROM = os.environ.get("TWILIO_FROM", "+14158180714")
+
+# scrapers send it as "Authorization: Bearer <token>"; without it /metrics only answers localhost
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# number of recipes returned per search
+SEARCH_RESULTS_NUMBER = 10
+# only ask Spoonacular when local catalog has fewer matching recipes than this
+LOCAL_SEARCH_MIN_RESULTS = int(os.environ.get('LOCAL_SEARCH_MIN_RESULTS', SEARCH_RESULTS_NUMBER))
+# saved recipes per page of /api/saved_recipes
+SAVED_RECIPES_PAGE_SIZE = 50
+SAVED_RECIPES_MAX_PAGE_SIZE = 500
+# recipes per /api/save_recipes request
+SAVE_RECIPES_MAX = 200
+
+# pooled client for Spoonacular, SPOONACULAR_BASE_URL can point at spoonacular_stub.py
+SPOONACULAR = spoonacular.SpoonacularClient(API_KEY, base_url=os.environ.get('SPOONACULAR_BASE_URL', spoonacular.BASE_URL),
+                                            pool_size=int(os.environ.get('SPOONACULAR_POOL_SIZE', 20)))
+
+# workers sending queued shopping lists with one reused Twilio client, started on first use
+MESSAGE_WORKERS = message_queue.MessageWorkerPool(
+    app, message_queue.TwilioTransport(TWILIO_SID, TWILIO_TOKEN, TWILIO_FROM),
+    num_workers=int(os.environ.get('MESSAGE_WORKERS', 2)))
+
+# workers adding recipes from Spoonacular search results to the local catalog, started on first use
+CATALOG_WARMER = catalog_warmer.CatalogWarmer(
+    app, num_workers=int(os.environ.get('CATALOG_WARMER_WORKERS', 1)),
+    max_queue=int(os.environ.get('CATALOG_WARMER_QUEUE', 1000)))
+
+# ingredient names for search box autocomplete and resolving typed ingredients
+INGREDIENTS = ingredient_index.IngredientCatalog(app)
+
+# cache of parsed complexSearch results, shared by all requests
+SEARCH_CACHE = search_cache.cache_from_env()
+
+instrumentation.metrics.gauge('fridg_search_cache_hit_ratio', 'Search cache hit ratio since start.',
+                              lambda: SEARCH_CACHE.stats()['hit_ratio'])
+instrumentation.metrics.gauge('fridg_search_cache_entries', 'Entries in the search cache.',
+                              lambda: SEARCH_CACHE.stats()['entries'])
+instrumentation.metrics.gauge('fridg_outbound_messages', 'Queued text messages by status.',
+                              lambda: [({'status': status}, count)
+                                       for status, count in crud.count_messages_by_status().items()])
+instrumentation.metrics.gauge('fridg_recipe_cache_hit_ratio', 'Recipe document cache hit ratio since start.',
+                              lambda: recipe_cache.cache.stats()['hit_ratio'])
+instrumentation.metrics.gauge('fridg_recipe_cache_bytes', 'Size of documents in the recipe document cache.',
+                              lambda: recipe_cache.cache.stats()['bytes'])
+instrumentation.metrics.gauge('fridg_recipe_cache_entries', 'Documents in the recipe document cache.',
+                              lambda: recipe_cache.cache.stats()['entries'])
+instrumentation.metrics.gauge('fridg_catalog_warmer_queue_depth', 'Search result recipes waiting to be added to the catalog.',
+                              CATALOG_WARMER.depth)
+instrumentation.metrics.gauge('fridg_catalog_warmer_dropped', 'Search result recipes dropped since start, queue was full.',
+                              lambda: CATALOG_WARMER.stats()['dropped'])
+instrumentation.metrics.gauge('fridg_catalog_warmer_added', 'Recipes added to the catalog from search results since start.',
+                              lambda: CATALOG_WARMER.stats()['added'])
+instrumentation.metrics.gauge('fridg_db_pool_connections', 'Connections in each db engine pool by state.',
+                              lambda: pool_stats(db, app))
 
 
 @app.route('/', defaults={'path': ''})
@@ -39,34 +116,59 @@ TWILIO_TOKEN = os.environ["TWILIO_TOKEN"]
 def catch_all(path):
     """Catch all URL routes that don't match specific path."""
 
-    return render_template('root.html')
+    return render_template('root.html', bundle_url=assets.bundle_url())
 
 
 @app.route('/')
 def homepage():
     """Show homepage."""
 
-    return render_template("root.html")
+    return render_template("root.html", bundle_url=assets.bundle_url())
+
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    """Serve a built frontend file, cached forever since its name has its content hash."""
+
+    return assets.send_asset(filename)
+
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Return request metrics in Prometheus text format.
+
+    Route latencies and slow query text aren't public: callers need
+    METRICS_TOKEN, or to be on the same host when it isn't set."""
+
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return Response('metrics need a token\n', status=403, mimetype='text/plain')
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return Response('metrics are only served to localhost without METRICS_TOKEN\n', status=403, mimetype='text/plain')
+
+    return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 
 @app.route('/api/login', methods=["POST"])
 def process_login():
 
-    print('in login route')
+    app.logger.debug('in login route')
     # unencode from JSON
     data = request.get_json()
     # # print(data)
     email = data['email']
     password = data['password']
 
-    # function to check if email exists in db
-    existing_user = crud.get_user_by_email(email=email)
+    # only the columns needed to check the password
+    existing_user = crud.get_login(email=email)
 
     # check if email exists in db, if so also check correct password
     if existing_user and password == existing_user.password:
-        # create session for user
+        # create session for user, the signed user_id saves looking the user up on every request
         session['email'] = email
+        session['user_id'] = existing_user.user_id
         # set new message
         message = 'Valid user. Successfully logged in.'
         success = True
@@ -85,7 +187,7 @@ def process_login():
 def create_account():
     """Create new account and store in db."""
 
-    print('\nin create account route\n')
+    app.logger.debug('in create account route')
     # unencode from JSON
     data = request.get_json()
     email = data['email']
@@ -93,13 +195,14 @@ def create_account():
     phone = '+1' + data['phone']
 
     # function to check if email exists in db
-    existing_user = crud.get_user_by_email(email=email)
+    existing_user = crud.get_login(email=email)
 
     # if no return from db for this email
     if existing_user == None:
-        new_user = crud.create_user(email=email, password=password, phone=phone)
+        new_user_id = crud.create_user(email=email, password=password, phone=phone)
         # create session for user
         session['email'] = email
+        session['user_id'] = new_user_id
         message = 'Successfully created new account!'
         success = True
 
@@ -115,9 +218,9 @@ def create_account():
 @app.route('/api/check_session')
 def check_if_logged_in():
     """Check if active session/logged in user."""
-    print('\nin checking session route\n')
+    app.logger.debug('in checking session route')
 
-    if session.get('email'):
+    if current_user_id() != None:
         return jsonify({'in_session': True})
     else:
         return jsonify({'in_session': False})
@@ -126,9 +229,10 @@ def check_if_logged_in():
 @app.route('/api/logout')
 def process_logout():
     """Remove user's session after logout."""
-    print('in logout route')
+    app.logger.debug('in logout route')
 
     session.pop('email', None)
+    session.pop('user_id', None)
 
     return jsonify({'message': 'Logged out!'})
 
@@ -138,66 +242,213 @@ def process_logout():
 def search_results():
     """Make API request for search results."""
 
-    print("route is hit through js")
+    app.logger.debug("route is hit through js")
     # unencode from JSON
     data = request.get_json()
     # User's input is a string of comma-separated list of ingredients 
     input_ingredients_str = data['ingredients']
-    print(input_ingredients_str)
+    app.logger.debug('%s', input_ingredients_str)
+
+    # map typed ingredients to canonical ones ('tomatos' -> 'tomatoes'), keep unknown ones as typed
+    tokens = [token for token in input_ingredients_str.split(',') if token.strip()]
+    resolved = INGREDIENTS.resolve_many(tokens)
+    ingredient_names = [match[1] if match else token.strip()
+                        for token, match in zip(tokens, resolved)]
+    resolved_ids = {match[0] for match in resolved if match}
+
+    # search recipes already in our db first
+    recipe_results = search_local_recipes(ingredient_names, resolved_ids)
+    if len(recipe_results) >= LOCAL_SEARCH_MIN_RESULTS:
+        app.logger.debug('answered search from local recipes')
+        return jsonify(recipe_results)
 
-    # spoonacular's api url
-    url = "https://api.spoonacular.com/recipes/complexSearch"
     # api parameters
-    payload = {"apiKey": API_KEY, 
-               "includeIngredients": input_ingredients_str,
+    payload = {"includeIngredients": ",".join(ingredient_names),
                "addRecipeInformation": True,
                "sort": "max-used-ingredients",
                "instructionsRequired": True,
                "fillIngredients": True,
-               "number": 10,
+               "number": SEARCH_RESULTS_NUMBER,
                } 
-    # make http request to spoonacular's complexSearch API
-    res = requests.get(url, params=payload)
-    # convert json into python dictionary -> API is a List of dictionaries
-    data = res.json()
-    # list of recipes (which are dictionaries about recipe details)
-    recipes_complex_data = data['results']
-
-    recipe_results = []
-    # parse only details we need from api endpoint
-    for recipe in recipes_complex_data:
-        recipe_data = helper_functions.parse_API_recipe_details(recipe)
-        recipe_results.append(recipe_data)
-    pprint(recipe_results)
+
+    def fetch_results():
+        # make http request to spoonacular's complexSearch API
+        # list of recipes (which are dictionaries about recipe details)
+        recipes_complex_data = SPOONACULAR.complex_search(payload)
+
+        # parse only details we need from api endpoint
+        return [helper_functions.parse_API_recipe_details(recipe)
+                for recipe in recipes_complex_data]
+
+    try:
+        # same ingredients in any order/case/spacing share one cached upstream call
+        recipe_results = SEARCH_CACHE.get_or_fetch(search_cache.make_key(payload), fetch_results)
+    except spoonacular.SpoonacularError as error:
+        # upstream down or rate limited, answer with whatever we found locally
+        app.logger.warning('spoonacular search failed: %s', error)
+    else:
+        # keep upstream recipes in the local catalog, off the request path
+        CATALOG_WARMER.ensure_started()
+        CATALOG_WARMER.offer(recipe_results)
+    app.logger.debug('%s', recipe_results)
 
     return jsonify(recipe_results)
 
 
+def current_user_id():
+    """Return logged in user's id from the signed session cookie, or None, without a query."""
+
+    if 'user_id' not in session and session.get('email'):
+        # sessions that logged in before user_id was kept in them
+        login = crud.get_login(session['email'])
+        if login == None:
+            session.pop('email')
+            return None
+        session['user_id'] = login.user_id
+
+    return session.get('user_id')
+
+
+def current_user():
+    """Return logged in user's (user_id, email, phone) row, or None.
+
+    Loaded with one column query, once per request (or batch)."""
+
+    user_id = current_user_id()
+    if user_id == None:
+        return None
+
+    # by user_id, so a login inside a batch isn't answered with the previous user
+    users = g.setdefault('users_by_id', {})
+    if user_id not in users:
+        users[user_id] = crud.get_identity(user_id)
+    return users[user_id]
+
+
+def user_data_etag(view):
+    """Answer If-None-Match with 304 while the user's saved recipes haven't changed.
+
+    The ETag is the user's data_version, bumped by every write to their saved
+    recipes, so a match is answered before anything else is loaded. Browsers
+    keep the response but must revalidate it (private, no-cache)."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = current_user_id()
+        # batched operations have no validators to check
+        if user_id == None or batch.in_batch():
+            return view(*args, **kwargs)
+
+        # read before the view loads anything, so a write in between only makes the ETag stale
+        version = crud.get_data_version(user_id)
+        if version == None:
+            return view(*args, **kwargs)
+        etag = f'{user_id}.{version}'
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
+
+
+def render_recipe_details(recipe_id):
+    """Return recipe's details document as JSON bytes, or None if there's no such recipe."""
+
+    recipe_row = crud.get_recipe_columns(recipe_id)
+    if recipe_row == None:
+        return None
+
+    return serializers.dumps_bytes(serializers.recipe_details(recipe_row, *crud.get_recipe_children_columns(recipe_id)))
+
+
+def render_recipe_summaries(recipe_ids):
+    """Return dictionary of recipe_id to recipe card document as JSON bytes."""
+
+    return {row.recipe_id: serializers.dumps_bytes(serializers.recipe_summary(row))
+            for row in crud.get_recipe_summary_rows(recipe_ids)}
+
+
+def search_local_recipes(ingredient_names, ingredient_ids=()):
+    """Search recipes in db using the inverted ingredient index.
+
+    Ingredients are given by name and/or by already resolved ingredient_id.
+    Returns list of recipes in the same shape as parse_API_recipe_details."""
+
+    search_index.index.ensure_built()
+
+    ingredient_ids = set(ingredient_ids) | search_index.index.resolve_names(ingredient_names)
+    if not ingredient_ids:
+        return []
+
+    ranked = search_index.index.search(ingredient_ids, number=SEARCH_RESULTS_NUMBER)
+    recipes = {recipe.recipe_id: recipe
+               for recipe in crud.get_recipes_by_ids([recipe_id for recipe_id, _, _ in ranked])}
+
+    # keep index's ranking order, skip any recipe removed since index was built
+    return [helper_functions.parse_db_search_result(recipes[recipe_id], used_ids)
+            for recipe_id, used_ids, _ in ranked
+            if recipe_id in recipes]
+
+
+
+@app.route('/api/ingredients/autocomplete')
+def autocomplete_ingredients():
+    """Return ingredient name suggestions for what user has typed so far."""
+
+    prefix = request.args.get('q', '')
+    k = max(1, min(request.args.get('k', 10, type=int), 50))
+
+    return jsonify({'suggestions': INGREDIENTS.suggest(prefix, k)})
+
+
+
+@app.route('/api/search_cache_stats')
+def search_cache_stats():
+    """Return search cache hit/miss/coalesced counters."""
+
+    return jsonify(SEARCH_CACHE.stats())
+
+
+@app.route('/api/recipe_cache_stats')
+def recipe_cache_stats():
+    """Return recipe document cache hit ratio and memory use."""
+
+    return jsonify(recipe_cache.cache.stats())
+
+
 
 @app.route('/api/check_results', methods=["POST"])
+@read_only
 def check_if_saved_recipe():
     """Checked if recipes saved, if yes then add a key indicating. """
 
-    print('\nin check if saved recipes route\n')
+    app.logger.debug('in check if saved recipes route')
     data = request.get_json()
     recipes_list = data['results_list']
 
-    if session.get('email') == None:
+    user_id = current_user_id()
+    if user_id == None:
         # if not logged in or in session, then all recipes show as not saved
         for recipe in recipes_list:
             recipe['is_saved'] = False
-        pprint(recipes_list)
+        app.logger.debug('%s', recipes_list)
 
         return jsonify({'checked_recipes': recipes_list, 'success': True, 'message': 'You need to create an account to see saved recipes!'})
 
-    users_saved_recipes = crud.get_saved_recipes(session.get('email'))
-    # set of saved recipe ids
-    saved_ids = {saved['saved_id'] for saved in users_saved_recipes}
+    # dictionary of saved recipe ids to favorite flag
+    saved_ids = saved_index.index.get(user_id)
 
-    # iterate through list of recipes, if recipe id is in set of saved ids, is_saved is true
+    # iterate through list of recipes, if recipe id is in saved ids, is_saved is true
     for recipe in recipes_list:
         recipe_id = recipe['recipe_id']
         recipe['is_saved'] = recipe_id in saved_ids
+        recipe['is_favorite'] = saved_ids.get(recipe_id, False)
 
     return jsonify({'checked_recipes': recipes_list, 'success': True, 'message': 'Checked results for any saved recipes!'})
 
@@ -207,52 +458,29 @@ def check_if_saved_recipe():
 def add_recipe_to_db():
     """Add selected recipe to recipes table in db."""
 
-    pprint('in recipe_to_db route')
+    app.logger.debug('in recipe_to_db route')
     # unencode from JSON
     data = request.get_json()
     recipe_details = data['recipe_details']
     recipe_id = recipe_details['recipe_id']
-    pprint(recipe_details)
+    app.logger.debug('%s', recipe_details)
     # must log in to save a recipe
-    if session.get('email') == None:
+    if current_user_id() == None:
         return jsonify({'success': False, 'message': 'You need to create an account to save a recipe!'})
 
     # find if recipe already exists in db
     existing_recipe = crud.quick_get_recipe(recipe_id)
 
     if existing_recipe != None:
-        print('\nrecipe already in db')
+        app.logger.debug('recipe already in db')
         return jsonify({'success': True, 'message': 'Recipe already in db, procdeed to saving'})
 
-    print('\n new recipe, adding to db \n')
-    title = recipe_details['title']
-    image = recipe_details['image']
-    servings = recipe_details['servings']
-    sourceUrl = recipe_details['sourceUrl']
-    cooking_mins = recipe_details['cooking_mins']
-    prep_mins = recipe_details['prep_mins']
-    ready_mins = recipe_details['ready_mins']
-    # add recipe's title, image, and servings to recipes table in db
-    crud.create_recipe(recipe_id=recipe_id, title=title, image=image, servings=servings, sourceUrl=sourceUrl, cooking_mins=cooking_mins, prep_mins=prep_mins, ready_mins=ready_mins)
-
-    # add each individual ingredient of recipe to db.
-    for ingredient in recipe_details['ingredients']:
-        ingredient_id = ingredient['ingredient_id']
-        name = ingredient['name']
-        amount = ingredient['amount']
-        unit = ingredient['unit']
-        crud.add_recipe_ingredient(recipe=recipe_id, ingredient_id=ingredient_id, amount=amount, unit=unit, name=name)
-
-    # add each instructions step and string to db
-    for i, instruction in enumerate(recipe_details['instructions']):
-        # set step_num by adding 1 to indices
-        step_num = i + 1
-        step_instruction = instruction
-        crud.add_instructions(recipe=recipe_id, step_num=step_num, step_instruction=step_instruction)
-
-    # add each key of equipment to db
-    for equipment in recipe_details['equipment']:
-        crud.add_equipment(recipe=recipe_id, equipment=equipment)
+    app.logger.debug('new recipe, adding to db')
+    # add recipe with its ingredients, instructions, and equipment in one transaction
+    crud.create_recipe_with_details(recipe_details)
+
+    # new recipe is searchable locally right away; its document is cached on first read
+    batch.after_commit(lambda: search_index.index.add_recipe(recipe_id, recipe_details['ingredients']))
 
     return jsonify({'success': True, 'message': 'Recipe added to db!'})
 
@@ -264,88 +492,157 @@ def add_recipe_to_saved():
 
     Only logged in users can save one recipe at a time (one recipe_id passed in POST request body)."""
 
-    print('\n\nin save_a_recipe route')
+    app.logger.debug('in save_a_recipe route')
     # unencode from JSON
     data = request.get_json()
     recipe_id = data['recipe_id']
-    users_saved_recipes = crud.get_saved_recipes(session['email'])
+    user_id = current_user_id()
+    # must log in to save a recipe
+    if user_id == None:
+        return jsonify({'success': False, 'message': 'You need to create an account to save a recipe!'})
 
-    # if user's saved recipes db has data
-    if len(users_saved_recipes) > 0:
-        # iterate and check if recipe already saved
-        for saved in users_saved_recipes:
-            if saved['recipe_id'] == recipe_id:
-                print('recipe already saved')
-                message = 'Recipe already exists in user\'s saved list'
-                return jsonify({'success': True, 'message': message})
+    # check if recipe already saved
+    if saved_index.index.is_saved(user_id, recipe_id):
+        app.logger.debug('recipe already saved')
+        message = 'Recipe already exists in user\'s saved list'
+        return jsonify({'success': True, 'message': message})
 
     # if selected recipe NOT in saved, or user's saved recipes is empty
-    print('\nselected recipe NOT in db, or user\'s saved recipes is empty\n')
-    user = crud.get_user_by_email(session.get('email'))
-    crud.save_a_recipe(user=user.user_id, recipe=recipe_id, is_favorite=False)
+    app.logger.debug('selected recipe NOT in db, or user\'s saved recipes is empty')
+    crud.save_a_recipe(user=user_id, recipe=recipe_id, is_favorite=False)
+    batch.after_commit(lambda: saved_index.index.invalidate(user_id))
     message = 'Recipe saved to saved_recipes!'
 
     return jsonify({'success': True, 'message': message})
 
 
 
+@app.route('/api/save_recipes', methods=["POST"])
+def save_recipes():
+    """Add many recipes to db (if they're new) and to user's saved recipes at once.
+
+    Takes a list of recipe details, like a whole page of search results."""
+
+    app.logger.debug('in save_recipes route')
+    data = request.get_json()
+    recipe_details_list = data['recipe_details']
+
+    user_id = current_user_id()
+    # must log in to save a recipe
+    if user_id == None:
+        return jsonify({'success': False, 'message': 'You need to create an account to save a recipe!'})
+
+    if len(recipe_details_list) > SAVE_RECIPES_MAX:
+        return jsonify({'success': False, 'message': f'Save at most {SAVE_RECIPES_MAX} recipes at a time.'})
+
+    added, saved = crud.save_recipes(user_id, recipe_details_list)
+
+    def update_caches():
+        # new recipes are searchable locally right away
+        for recipe_details in recipe_details_list:
+            if recipe_details['recipe_id'] in added:
+                search_index.index.add_recipe(recipe_details['recipe_id'], recipe_details['ingredients'])
+        saved_index.index.invalidate(user_id)
+
+    batch.after_commit(update_caches)
+
+    return jsonify({'success': True, 'added': len(added), 'saved': saved,
+                    'message': f'{saved} recipes saved to saved_recipes!'})
+
+
+
 @app.route('/api/favorite_a_recipe', methods=["POST"])
 def favorite_a_recipe():
     """Favorite a saved recipe."""
 
-    print('\nin favorited route\n')
+    app.logger.debug('in favorited route')
     # unencode from JSON
     data = request.get_json()
     recipe_id = data['recipe_id']
-    crud.favorite_a_recipe(recipe_id, session.get('email'))
+    user_id = current_user_id()
+    if user_id == None:
+        return jsonify({'success': False, 'message': 'You need to create an account to favorite a recipe!'}), 401
+
+    favorited = crud.favorite_a_recipe(recipe_id, user_id)
+    if favorited == None:
+        return jsonify({'success': False, 'message': 'Recipe is not in your saved recipes!'}), 404
+    if favorited:
+        batch.after_commit(lambda: saved_index.index.invalidate(user_id))
 
     return jsonify({'success': True,'message': 'successfully favorited this recipe!'})
 
 
 
 @app.route('/api/saved_recipe_details/<recipe_id>')
+@read_only
+@user_data_etag
 def get_saved_recipe_details(recipe_id):
     """Return details of one saved recipe given id."""
 
-    print('\nin one saved recipe details\n')
+    app.logger.debug('in one saved recipe details')
 
-    if session.get('email') == None:
-        print('in session == none')
+    user_id = current_user_id()
+    if user_id == None:
+        app.logger.debug('in session == none')
         return jsonify({'recipe_details': [], 'success': False, 'message': 'You need to create an account to see a saved recipe\'s details!'})
 
-    email = session.get('email')
-    # get recipe as saved recipe for 'favorite' data
-    saved_recipe = crud.get_a_saved_recipe(recipe_id, email).as_dict()
-    # represent recipe details as dictionary
-    recipe_details = helper_functions.parse_db_recipe_details(saved_recipe['recipe'])
-    # add 'favorite' boolean data to details
-    recipe_details['favorite'] = saved_recipe['favorite']
+    # user's own fields of the saved recipe
+    saved_recipe = crud.get_saved_recipe_columns(recipe_id, user_id)
+    if saved_recipe == None:
+        return serializers.json_response({'recipe_details': [], 'success': False, 'message': 'Recipe is not in your saved recipes!'})
 
-    return jsonify({'recipe_details': recipe_details, 'message': 'returning a saved recipe\'s details'})
+    # recipe itself is the same for everyone, rendered once and cached
+    document = recipe_cache.cache.get_or_load((recipe_cache.DETAILS, saved_recipe.recipe_id),
+                                              lambda: render_recipe_details(saved_recipe.recipe_id))
+    # add user's 'favorite', tried, rating and comment to details
+    recipe_details = serializers.extend_object(document, {'favorite': saved_recipe.favorite,
+                                                          'tried': saved_recipe.tried,
+                                                          'rating': serializers.stars(saved_recipe.rating),
+                                                          'comment': saved_recipe.comment})
+
+    return Response(serializers.dumps_object({'recipe_details': recipe_details,
+                                              'message': 'returning a saved recipe\'s details'}),
+                    mimetype='application/json')
 
 
 
 @app.route('/api/saved_recipes')
+@read_only
+@user_data_etag
 def get_saved_recipes():
-    """Get all of user's saved and favorited recipes."""
+    """Get one page of user's saved and favorited recipes, as summaries.
+
+    Pass next_cursor from a page as ?cursor= to get the next page; next_cursor
+    is null on the last page. Full details come from /api/saved_recipe_details."""
+
+    app.logger.debug('in get saved recipes route')
 
-    print('\nin get saved recipes route\n')
+    user_id = current_user_id()
+    if user_id == None:
+        return jsonify({'saved_recipes': [], 'next_cursor': None, 'success': False, 'message': 'You need to create an account to see saved recipes!'})
 
-    if session.get('email') == None:
-        return jsonify({'saved_recipes': [], 'success': False, 'message': 'You need to create an account to see saved recipes!'})
+    after_saved_id = request.args.get('cursor', type=int)
+    if request.args.get('cursor') and after_saved_id is None:
+        return jsonify({'saved_recipes': [], 'next_cursor': None, 'success': False, 'message': 'cursor must be a next_cursor from an earlier page'}), 400
+    limit = max(1, min(request.args.get('limit', SAVED_RECIPES_PAGE_SIZE, type=int), SAVED_RECIPES_MAX_PAGE_SIZE))
 
-    # get a list of saved_recipe objects for existing user
-    users_saved_recipes = crud.get_saved_recipes(session.get('email'))
+    # fetch one extra row to know if there's a next page
+    saved_rows = crud.get_saved_recipe_page(user_id, after_saved_id, limit + 1)
+    next_cursor = str(saved_rows[limit - 1].saved_id) if len(saved_rows) > limit else None
+    saved_rows = saved_rows[:limit]
 
-    saved_recipes = []
-    for saved in users_saved_recipes:
-        recipe_details = helper_functions.parse_db_recipe_details(saved['recipe'])
-        recipe_details['favorite'] = saved['favorite']
-        saved_recipes.append(recipe_details)
+    # recipe cards from the cache, one query for any not cached yet
+    summaries = recipe_cache.cache.get_many(recipe_cache.SUMMARY, [row.recipe_id for row in saved_rows],
+                                            render_recipe_summaries)
 
-    pprint(saved_recipes)
+    def generate():
+        # stream the list row by row, so memory doesn't grow with the page
+        yield b'{"saved_recipes": ['
+        for i, row in enumerate(row for row in saved_rows if row.recipe_id in summaries):
+            yield (b',' if i else b'') + serializers.extend_object(summaries[row.recipe_id], {'favorite': row.favorite})
+        yield b'], "next_cursor": ' + serializers.dumps_bytes(next_cursor) + b', "message": "list of user\'s saved recipes!"}'
 
-    return jsonify({'saved_recipes': saved_recipes, 'message': 'list of user\'s saved recieps!'})
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 
@@ -353,89 +650,131 @@ def get_saved_recipes():
 def remove_from_saved():
     """Remove recipe from user's saved recipes list."""
 
-    print('\nin remove recipe route\n')
+    app.logger.debug('in remove recipe route')
 
     data = request.get_json()
     recipe_id = data['recipe_id']
-    email = session.get('email')
-    # remove_recipe returns boolean True
-    removed = crud.remove_recipe(recipe_id, email)
-    # success is boolean
-    success = removed
+    user_id = current_user_id()
+    # remove_recipe returns False if the recipe wasn't saved
+    removed = crud.remove_recipe(recipe_id, user_id)
+    batch.after_commit(lambda: saved_index.index.invalidate(user_id))
+
+    return jsonify({'success': removed, 'message': 'Recipe removed from saved' if removed else 'Recipe is not in your saved recipes!'})
+
+
+@app.route('/api/batch', methods=["POST"])
+def run_batch():
+    """Run several API calls in one round trip and one transaction.
+
+    See batch.py for the request format. Returns each operation's status and
+    body, in order."""
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'body must be an object with a list of operations'}), 400
+
+    try:
+        results = batch.run(app, data.get('operations'))
+    except batch.BatchError as error:
+        return jsonify({'success': False, 'message': str(error)}), 400
+    except Exception:
+        app.logger.exception('batch failed, rolled back')
+        return jsonify({'success': False, 'message': 'A batched operation failed, nothing was saved.'}), 500
+    finally:
+        # no index load in the batch's transaction can outlive it
+        user_id = current_user_id()
+        if user_id != None:
+            saved_index.index.invalidate(user_id)
+
+    return Response(serializers.dumps_object({'results': serializers.RawJSON(_results_json(results)), 'success': True}),
+                    mimetype='application/json')
+
+
+def _results_json(results):
+    # operations' JSON bodies go into the response without decoding them
+    return serializers.dumps_array([serializers.RawJSON(serializers.dumps_object(result)) for result in results])
 
-    return jsonify({'success': success, 'message': 'Recipe removed from saved'})
 
 
 @app.route('/api/shopping-list', methods=["POST"])
 def send_shopping_list():
-    """Send shopping list of ingredients to user's phone via Twilio API."""
+    """Queue shopping list of ingredients to be sent to user's phone via Twilio API.
 
-    # pass phone as string to 'to=' in message
-    email = session.get('email')
-    phone = crud.get_user_phone(email)
+    Returns right away with a message_id to poll for delivery status."""
+
+    user = current_user()
+    if user == None:
+        return jsonify({'success': False, 'message': 'You need to create an account to send a shopping list!'})
+    if not user.phone:
+        return jsonify({'success': False, 'message': 'Add a phone number to your account to get shopping lists!'})
 
     data = request.get_json()
     list_items = data['shopping_list']
     recipe_title = data['recipe_title']
     shopping_list = "\n".join(list_items.keys())
-    
-    client = Client(TWILIO_SID, TWILIO_TOKEN)
 
-    # "+15599403988"
-    message = client.messages.create(
-        to="+15599403988",
-        from_="+14158180714",
-        body=f'{recipe_title} shopping list:\n'
-             f'{shopping_list}'
-             )
+    message_id = crud.queue_message(to_number=user.phone,
+                                    body=f'{recipe_title} shopping list:\n'
+                                         f'{shopping_list}',
+                                    user_id=user.user_id)
+
+    MESSAGE_WORKERS.ensure_started()
+    MESSAGE_WORKERS.notify()
+
+    return jsonify({'success': True, 'message_id': message_id, 'message': 'Shopping list is on its way to your phone!'})
 
-    print(message.sid)
 
-    return jsonify({'success': True, 'message': 'Shopping list sent to your phone!'})
+@app.route('/api/shopping-list/<message_id>')
+def get_shopping_list_status(message_id):
+    """Return delivery status of a queued shopping list."""
+
+    user_id = current_user_id()
+    message = crud.get_message(message_id, user_id) if user_id != None else None
+
+    if message == None:
+        return jsonify({'success': False, 'message': 'No such shopping list.'})
+
+    return jsonify({'success': True, 'status': message.as_dict()})
 
 
 @app.route('/api/user_thoughts/<recipe_id>')
+@read_only
+@user_data_etag
 def get_user_thoughts(recipe_id):
     """Get a user's thoughts on a saved recipe from db."""
 
-    email = session.get('email')
-    saved_recipe_thoughts = crud.get_a_saved_recipe(recipe_id, email).as_dict()
+    saved_recipe = crud.get_saved_recipe_columns(recipe_id, current_user_id())
+    if saved_recipe == None:
+        return serializers.json_response({'thoughts': None, 'success': False, 'message': 'Recipe is not in your saved recipes!'})
 
-    del saved_recipe_thoughts['recipe']
-    del saved_recipe_thoughts['user']
+    saved_recipe_thoughts = serializers.thoughts(saved_recipe)
+    app.logger.debug('user thoughts %s', saved_recipe_thoughts)
 
-    if saved_recipe_thoughts['rating'] != None:
-        saved_recipe_thoughts['rating'] = list(range(1, saved_recipe_thoughts['rating'] + 1))
-    else:
-        saved_recipe_thoughts['rating'] = []
-    print('\nuser thoughts', saved_recipe_thoughts)
-
-    return jsonify({'thoughts': saved_recipe_thoughts, 'message': 'retrieved user\'s food for thought!'})
+    return serializers.json_response({'thoughts': saved_recipe_thoughts, 'message': 'retrieved user\'s food for thought!'})
 
 
 @app.route('/api/update_user_thoughts', methods=["POST"])
 def update_user_thoughts():
     """Update a user's thoughts on a saved recipe."""
-    print('\nin user thought to db route\n')
+    app.logger.debug('in user thought to db route')
     data = request.get_json()
     tried_str = (data.get('tried'))
     rating = data.get('rating')
     comment = data.get('comment')
     recipe_id = data.get('recipe_id')
 
-    email = session.get('email')
-    saved_recipe = crud.get_a_saved_recipe(recipe_id, email)
-
-    if tried_str != None:
-        tried = bool(tried_str)
-        crud.update_tried(saved_recipe=saved_recipe, tried=tried)
-        print(tried)
+    user_id = current_user_id()
+    if user_id == None:
+        return jsonify({'success': False, 'message': 'You need to create an account to save your thoughts!'}), 401
 
-    if rating != None:
-        crud.update_rating(saved_recipe=saved_recipe, rating=rating)
+    saved_recipe = crud.get_a_saved_recipe(recipe_id, user_id)
+    if saved_recipe == None:
+        return jsonify({'success': False, 'message': 'Recipe is not in your saved recipes!'}), 404
 
-    if comment != None:
-        crud.update_comment(saved_recipe=saved_recipe, comment=comment)
+    crud.update_thoughts(saved_recipe,
+                         tried=bool(tried_str) if tried_str != None else None,
+                         rating=rating,
+                         comment=comment)
 
     return jsonify({'success': True, 'message': 'updated user\'s food for thought!'})
 
@@ -444,6 +783,12 @@ def update_user_thoughts():
 if __name__ == '__main__':
     # Connect to db first, then app can access it.
     app.debug = True
+    # running the app owns logging; imported, it leaves the host's config alone
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'))
+    app.logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
     connect_to_db(app)
+    # load autocomplete index before serving
+    with app.app_context():
+        INGREDIENTS.load()
     # DebugToolbarExtension(app)
     app.run(host='0.0.0.0')
@@ -0,0 +1,117 @@
+"""HTTP client for Spoonacular's API.
+
+One keep-alive connection pool per process, connect/read timeouts on every
+call, retries with jittered backoff on 429/5xx, and concurrent fan-out for
+requests that need many recipes at once."""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+
+BASE_URL = 'https://api.spoonacular.com'
+
+# upstream statuses worth retrying: rate limited or server side trouble
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class SpoonacularError(Exception):
+    """Spoonacular request failed: after all retries, with a status not worth retrying, or with a bad body.
+
+    Messages never include the request URL, which carries the api key."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        # upstream HTTP status, None for network errors and bad bodies
+        self.status = status
+
+
+class SpoonacularClient:
+    """Pooled, timeout-aware Spoonacular client, safe to share across threads."""
+
+    def __init__(self, api_key, base_url=BASE_URL, pool_size=20,
+                 connect_timeout=3.05, read_timeout=10, max_retries=3,
+                 backoff=0.25, max_backoff=4, max_workers=8):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_workers = max_workers
+
+        # reuse connections (and TLS sessions) across requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, path, params=None, timeout=None):
+        """GET an API path and return decoded JSON, retrying transient failures.
+
+        timeout is a (connect, read) tuple overriding the client's default."""
+
+        params = dict(params or {}, apiKey=self.api_key)
+        url = self.base_url + path
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                with instrumentation.timed('spoonacular'):
+                    res = self.session.get(url, params=params, timeout=timeout or self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                # requests' messages include the url, so only keep the kind of error
+                failure, status = type(error).__name__, None
+            else:
+                if res.status_code not in RETRY_STATUSES:
+                    return self._decode(res, path)
+                failure, status = f'status {res.status_code}', res.status_code
+                retry_after = res.headers.get('Retry-After')
+
+            if attempt == self.max_retries:
+                break
+            time.sleep(self._delay(attempt, retry_after))
+
+        raise SpoonacularError(f'{path} failed after {self.max_retries + 1} attempts: {failure}', status)
+
+    def _decode(self, res, path):
+        """Return decoded JSON of a final response; 4xx (402 quota used up, 401 bad key) and bad bodies raise."""
+
+        if res.status_code >= 400:
+            raise SpoonacularError(f'{path} failed: status {res.status_code}', res.status_code)
+        try:
+            return res.json()
+        except ValueError:
+            raise SpoonacularError(f'{path} returned invalid JSON', res.status_code) from None
+
+    def _delay(self, attempt, retry_after=None):
+        """Return seconds to wait before next attempt (full jitter exponential backoff)."""
+
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def complex_search(self, params):
+        """Return list of recipes from complexSearch."""
+
+        return self.get('/recipes/complexSearch', params)['results']
+
+    def recipe_information(self, recipe_id):
+        """Return one recipe's full information."""
+
+        return self.get(f'/recipes/{recipe_id}/information', {'includeNutrition': False})
+
+    def recipes_information(self, recipe_ids):
+        """Return full information for many recipes, fetched concurrently, in the given order."""
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.recipe_information, recipe_ids))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,151 @@
+"""Local stand-in for Spoonacular's API, for offline tests and benchmarks.
+
+Serves complexSearch and recipe information responses in Spoonacular's shape,
+with optional response delay and injected failures.
+
+    python spoonacular_stub.py --port 8765 --delay 0.2
+
+then run the server with SPOONACULAR_BASE_URL=http://localhost:8765."""
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_recipe(recipe_id, ingredients=('egg', 'milk')):
+    """Return a recipe in Spoonacular's complexSearch/information shape."""
+
+    extended = [{'id': zlib.crc32(name.encode()) % 100000,
+                 'name': name,
+                 'amount': 1.0 + i,
+                 'measures': {'us': {'unitShort': 'cup'}}}
+                for i, name in enumerate(list(ingredients) + ['salt', 'butter'])]
+
+    steps = [{'number': step,
+              'step': f'Step {step} of recipe {recipe_id}.',
+              'equipment': [{'name': 'frying pan'}] if step == 1 else [{'name': 'bowl'}]}
+             for step in range(1, 5)]
+
+    return {'id': recipe_id,
+            'title': f'Stub recipe {recipe_id}',
+            'servings': 2,
+            'sourceUrl': f'https://example.com/recipes/{recipe_id}',
+            'image': f'https://example.com/recipes/{recipe_id}.jpg',
+            'preparationMinutes': 10,
+            'cookingMinutes': 20,
+            'readyInMinutes': 30,
+            'extendedIngredients': extended,
+            'analyzedInstructions': [{'name': '', 'steps': steps}],
+            'missedIngredients': [{'name': ingredient['name'],
+                                   'amount': ingredient['amount'],
+                                   'unitShort': 'cup'}
+                                  for ingredient in extended[len(ingredients):]]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer Spoonacular API paths with fake recipes."""
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        with stub.lock:
+            stub.requests.append((url.path, params))
+            fail = stub.failures > 0
+            if fail:
+                stub.failures -= 1
+
+        if stub.delay:
+            time.sleep(stub.delay)
+
+        if fail:
+            return self._send(stub.failure_status, {'status': 'failure'})
+
+        parts = url.path.strip('/').split('/')
+        if url.path == '/recipes/complexSearch':
+            ingredients = [name.strip() for name in params.get('includeIngredients', '').split(',')
+                           if name.strip()]
+            number = int(params.get('number', 10))
+            # same ingredients always give the same recipe ids
+            first_id = zlib.crc32(','.join(sorted(ingredients)).encode()) % 1000000
+            results = [fake_recipe(first_id + i, ingredients) for i in range(number)]
+            return self._send(200, {'results': results, 'offset': 0,
+                                    'number': number, 'totalResults': number})
+
+        if len(parts) == 3 and parts[0] == 'recipes' and parts[2] == 'information':
+            return self._send(200, fake_recipe(int(parts[1])))
+
+        self._send(404, {'status': 'failure', 'message': 'not found'})
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # keep test and benchmark output quiet
+        pass
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # concurrency benchmarks open hundreds of connections at once
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on slow responses (timeouts) are expected
+        pass
+
+
+class StubServer:
+    """Stub Spoonacular server running on a background thread.
+
+        with StubServer(delay=0.1) as stub:
+            client = SpoonacularClient('key', base_url=stub.url)"""
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0, failures=0, failure_status=503):
+        self.delay = delay
+        # fail this many requests, then answer normally
+        self.failures = failures
+        self.failure_status = failure_status
+        # (path, params) of every request received
+        self.requests = []
+        self.lock = threading.Lock()
+
+        self.httpd = _HTTPServer((host, port), StubHandler)
+        self.httpd.stub = self
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before each response')
+    args = parser.parse_args()
+
+    stub = StubServer(args.host, args.port, delay=args.delay)
+    print(f'Stub Spoonacular API on {stub.url}')
+    stub.httpd.serve_forever()
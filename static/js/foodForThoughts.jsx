@@ -132,7 +132,7 @@ function FoodForThoughtsContainer(props) {
   const [comment, setComment] = React.useState('');
   // update state of each section from db data or set as default nulls
   React.useEffect(() => {
-    fetch(`/api/user_thoughts/${id}`)
+    fetch(`/api/user_thoughts/${id}`, {cache: 'no-cache', credentials: 'include'})
     .then(res => res.json())
     .then(data => {
       setTried(data.thoughts.tried);
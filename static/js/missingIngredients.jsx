@@ -42,9 +42,27 @@ function MissingIngredientsList(props) {
 function ShoppingListBtn(props) {
   const {loggedIn} = React.useContext(AuthContext);
   const [alert, showAlert] = React.useState(false);
+  const [status, setStatus] = React.useState('queued');
+
+  // poll queued shopping list until it's sent or has failed
+  const pollStatus = (messageId) => {
+    fetch(`/api/shopping-list/${messageId}`, {credentials: 'include'})
+    .then(res => res.json())
+    .then(data => {
+      if (!data.success) {
+        return;
+      }
+      setStatus(data.status.status);
+      if (data.status.status === 'queued' || data.status.status === 'sending') {
+        setTimeout(() => pollStatus(messageId), 1000);
+      }
+    });
+  };
+
   // if logged in, button will send shopping list to user's phone
   // not logged in, prompts login modal
   const handleClick = () => {
+      setStatus('queued');
       fetch('/api/shopping-list', {
         method: 'POST',
         body: JSON.stringify({shopping_list: props.shoppingList,
@@ -52,7 +70,16 @@ function ShoppingListBtn(props) {
         headers: {'Content-Type': 'application/json'},
         credentials: 'include'
       })
+      .then(res => res.json())
+      .then(data => pollStatus(data.message_id));
     };
+
+  const STATUS_MESSAGES = {
+    queued: 'Sending shopping list to your phone...',
+    sending: 'Sending shopping list to your phone...',
+    sent: 'Shopping List sent to your phone!',
+    failed: 'Sorry, we could not send your shopping list. Try again later.'
+  };
   // not logged in renders modal window prompting log in
   // logged in renders button to server and send text
   const SHOPPING_BTN = {
@@ -66,8 +93,8 @@ function ShoppingListBtn(props) {
 
   return (
     <div className="shopping-list-btn">
-      <Alert variant='info' show={alert} onClose={() => {showAlert(false)}} dismissible>
-        Shopping List sent to your phone!
+      <Alert variant={status === 'failed' ? 'danger' : 'info'} show={alert} onClose={() => {showAlert(false)}} dismissible>
+        {STATUS_MESSAGES[status]}
       </Alert>
 
       {SHOPPING_BTN[loggedIn]}
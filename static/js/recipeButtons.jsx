@@ -26,8 +26,12 @@ function ActionBtn(props) {
   const [buttonText, setButtonText] = React.useState(initialText);
 
   const handleClick = () => {
-    props.action();
-    setButtonText(props.updateText)
+    // only show the update once the action worked
+    Promise.resolve(props.action()).then(ok => {
+      if (ok !== false) {
+        setButtonText(props.updateText)
+      }
+    });
   };
 
   return (
@@ -131,27 +135,13 @@ function SearchResultButton(props) {
   // isSaved is boolean passed from parent component
   let isSaved = props.buttonStatus;
 
-  const addRecipeToSaved = () => {
-    fetch('/api/save_a_recipe', 
-            {method: 'POST',
-              body: JSON.stringify({recipe_id: props.recipeId}),
-              headers: { 'Content-Type': 'application/json'},
-              credentials:'include'
-            })
-  };
-
-  const addRecipeToDb = () => {
-    fetch('/api/add_recipe', 
-            {method: 'POST',
-              body: JSON.stringify({recipe_details: props.recipeDetails}), 
-              headers: { 'Content-Type': 'application/json'},
-              credentials:'include'
-            })
-    .then(res => res.json())
-    .then(data => {if (data.success) {addRecipeToSaved()}
-                  }
-          )
-  };
+  // add recipe to db (if it's new) and save it in one round trip
+  const addRecipeToDb = () => (
+    batchFetch([{path: '/api/add_recipe', body: {recipe_details: props.recipeDetails}},
+                {path: '/api/save_a_recipe', body: {recipe_id: props.recipeId}}])
+    .then(data => data.success !== false
+                  && data.results.every(result => result.status === 200 && result.body.success !== false))
+  );
 
   return (
     <div className='search-results-btn-container button'>
@@ -170,14 +160,15 @@ function SearchResultButton(props) {
 function SavedRecipesButton(props) {
   let isFavorite = props.buttonStatus;
 
-  const favoriteThisRecipe = () => {
+  const favoriteThisRecipe = () => (
     fetch('/api/favorite_a_recipe', 
             {method: 'POST',
               body: JSON.stringify({recipe_id: props.recipeId}),
               headers: { 'Content-Type': 'application/json'},
               credentials:'include'
             })
-  };
+    .then(res => res.ok)
+  );
 
   return (
     <div className='saved-recipes-btn-container button'>
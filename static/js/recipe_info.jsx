@@ -110,7 +110,7 @@ function RecipeIngredients(props) {
     <div className='recipe-ingredients'>
         <label>Ingredients: </label>
           <ul>
-            {props.ingredients.map((ingredient) => 
+            {(props.ingredients || []).map((ingredient) => 
                 <Ingredient key={props.ingredients.indexOf(ingredient)}
                             amount={ingredient.amount}
                             unit={ingredient.unit}
@@ -149,7 +149,7 @@ function RecipeInstructions(props) {
     <div className='recipe-instructions'>
       <label>Instructions: </label>
         <ol>
-          {props.instructions.map((instruction) => 
+          {(props.instructions || []).map((instruction) => 
             <li key={props.instructions.indexOf(instruction)}>
               {instruction}
             </li>
@@ -234,11 +234,12 @@ function RecipeDetails(props) {
   // if logged-in, fetch data for details and button status from server
   React.useEffect(() => {
     if (fromPath === 'saved-recipes') {
-      fetch(`/api/saved_recipe_details/${id}`)
+      // saved details include favorite; revalidated with the ETag, unchanged ones come back 304
+      fetch(`/api/saved_recipe_details/${id}`, {cache: 'no-cache', credentials: 'include'})
         .then(res => res.json())
         .then(data => {
           setDetails(data.recipe_details);
-          setButtonStatus(data.favorite)
+          setButtonStatus(data.recipe_details.favorite)
           })
     } else {
       fetch('/api/check_results',
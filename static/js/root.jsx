@@ -10,6 +10,19 @@ const useHistory = ReactRouterDOM.useHistory;
 const useLocation = ReactRouterDOM.useLocation;
 const useParams = ReactRouterDOM.useParams;
 
+// run several api calls in one round trip, resolves to {success, results, message}
+// results is a list of {id, status, body}, cut short at an operation that failed
+// {'$ref': id} in a body is replaced by the body an earlier call returned
+const batchFetch = (operations) => (
+  fetch('/api/batch', {
+    method: 'POST',
+    body: JSON.stringify({operations: operations}),
+    headers: { 'Content-Type': 'application/json'},
+    credentials:'include'
+  })
+  .then(res => res.json())
+);
+
 
 function Homepage(props) {
   let history = useHistory();
@@ -78,11 +91,20 @@ function SavedRecipes(props) {
   // retrieve list of user's saved recipes
   React.useEffect(() => {
     console.log('useeffect in saved recipes');
-    fetch('/api/saved_recipes')
-    .then(res => res.json())
-    .then(savedData => {
-      setSavedList(savedData.saved_recipes); 
-    })
+    // fetch library page by page, showing each page as it arrives
+    const fetchPage = (cursor, loaded) => {
+      // revalidate the cached page with its ETag, unchanged pages come back 304
+      fetch('/api/saved_recipes' + (cursor ? `?cursor=${cursor}` : ''), {cache: 'no-cache', credentials: 'include'})
+      .then(res => res.json())
+      .then(savedData => {
+        const savedSoFar = loaded.concat(savedData.saved_recipes);
+        setSavedList(savedSoFar);
+        if (savedData.next_cursor) {
+          fetchPage(savedData.next_cursor, savedSoFar);
+        }
+      })
+    };
+    fetchPage(null, []);
   }, [removed]);
   // console.log('saved list of recipes', savedList);
   const handleRemove = () => {
@@ -116,23 +138,8 @@ function SavedRecipes(props) {
 
 
 function SearchResults(props) {
-  // resultsList is data from Spoonacular's API.
-  const resultsList = props.resultsList;
-  const [checkedRecipes, updateCheckedRecipes] = React.useState([]);
-  // check search results for any user's saved recipes
-  React.useEffect(() => {
-    console.log('in check results use effect');
-    fetch('/api/check_results', {
-      method: 'POST',
-      body: JSON.stringify({results_list: resultsList}),
-      headers: { 'Content-Type': 'application/json'},
-      credentials:'include'
-    })
-    .then(res => res.json())
-    .then(data => {
-      updateCheckedRecipes(data.checked_recipes);
-    });
-  }, [resultsList]);
+  // resultsList is search results, already checked for user's saved recipes in the search's batch
+  const checkedRecipes = props.resultsList;
 
   console.log('results', checkedRecipes);
 
@@ -166,16 +173,36 @@ function SearchResults(props) {
 function SearchBar(props) {
   let history = useHistory();
   const [ingredients, setIngredients] = React.useState('');
+  const [suggestions, setSuggestions] = React.useState([]);
+
+  // suggest ingredient names for the last comma-separated ingredient typed
+  const handleChange = (e) => {
+    const typed = e.target.value;
+    setIngredients(typed);
+
+    const tokens = typed.split(',');
+    const lastToken = tokens.pop().trim();
+    if (lastToken.length < 2) {
+      setSuggestions([]);
+      return;
+    }
+    const typedBefore = tokens.length ? tokens.join(',') + ', ' : '';
+    fetch(`/api/ingredients/autocomplete?q=${encodeURIComponent(lastToken)}&k=8`)
+    .then(res => res.json())
+    .then(data => setSuggestions(data.suggestions.map(suggestion => typedBefore + suggestion.name)));
+  };
 
   const searchRecipes = () => {
-    fetch('/api/search_results', {
-      method: 'POST',
-      body: JSON.stringify({ingredients: ingredients}),
-      headers: { 'Content-Type': 'application/json'},
-      credentials:'include'
+    // search and check results for user's saved recipes in one round trip
+    batchFetch([{id: 'search', path: '/api/search_results', body: {ingredients: ingredients}},
+                {path: '/api/check_results', body: {results_list: {'$ref': 'search'}}}])
+    .then((data) => {
+      if (data.success === false || data.results[1].status !== 200) {
+        props.setData([]);
+      } else {
+        props.setData(data.results[1].body.checked_recipes);
+      }
     })
-    .then((response) => response.json())
-    .then((data) => props.setData(data))
     .then(setIngredients(''));
 
     history.push("/search-results");
@@ -186,10 +213,14 @@ function SearchBar(props) {
       <label> What's in your fridge? </label> 
       <FormControl type='text'
              className='search-bar'
-             onChange={(e) => {setIngredients(e.target.value)}}
+             onChange={handleChange}
              value={ingredients}
+             list='ingredient-suggestions'
              placeholder='e.g. beef, potato'>
       </FormControl>
+      <datalist id='ingredient-suggestions'>
+        {suggestions.map((suggestion) => <option key={suggestion} value={suggestion} />)}
+      </datalist>
 
       <Button id='search-bar-btn' onClick={searchRecipes} variant='outline-info'>
         Let's get cookin!
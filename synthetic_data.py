@@ -0,0 +1,129 @@
+"""Generate synthetic users, recipes and saved recipes for benchmarks.
+
+    python synthetic_data.py --rows 100000 --db sqlite:///bench.sqlite3
+
+Recipes use ingredients from data/top-1k-ingredients.csv, so local search,
+autocomplete and the resolver see realistic names and ids."""
+
+import argparse
+import random
+
+from model import db, User, Saved_Recipe, Recipe, Recipe_Ingredient, Instructions, Equipment, Ingredient
+from ingredient_index import load_csv_ingredients
+
+
+EQUIPMENT = ['frying pan', 'oven', 'bowl', 'whisk', 'pot', 'baking sheet', 'blender',
+             'knife', 'cutting board', 'saucepan', 'grill', 'slow cooker']
+
+# rows written per INSERT batch
+BATCH_ROWS = 5000
+
+PASSWORD = 'password'
+
+
+def plan(rows):
+    """Return counts of users, recipes and saves per user adding up to about rows rows.
+
+    Each recipe is about 23 rows: itself, 10 ingredients, 8 steps, 3 equipment,
+    plus its share of saved recipes."""
+
+    recipes = max(10, rows // 23)
+    users = max(5, recipes // 20)
+    saves_per_user = min(recipes, 30)
+
+    return users, recipes, saves_per_user
+
+
+def user_email(i):
+    return f'user{i}@example.com'
+
+
+def generate(rows, seed=0):
+    """Fill an empty db with about rows synthetic rows. Return (users, recipes, saves_per_user)."""
+
+    rand = random.Random(seed)
+    ingredients = load_csv_ingredients()
+    users, recipes, saves_per_user = plan(rows)
+
+    _insert(Ingredient, ({'ingredient_id': ingredient_id, 'name': name}
+                         for ingredient_id, name in ingredients))
+
+    _insert(User, ({'user_id': i, 'email': user_email(i), 'password': PASSWORD,
+                    'phone': f'+1555{i:07d}'}
+                   for i in range(1, users + 1)))
+    if db.engine.dialect.name == 'postgresql':
+        # ids were given explicitly, move sequence past them for new accounts
+        db.session.execute("SELECT setval(pg_get_serial_sequence('users', 'user_id'), max(user_id)) FROM users")
+        db.session.commit()
+
+    _insert(Recipe, ({'recipe_id': recipe_id,
+                      'title': f'Synthetic recipe {recipe_id}',
+                      'image': f'https://example.com/recipes/{recipe_id}.jpg',
+                      'servings': rand.randint(1, 8),
+                      'sourceUrl': f'https://example.com/recipes/{recipe_id}',
+                      'cooking_mins': rand.randint(5, 90),
+                      'prep_mins': rand.randint(5, 30),
+                      'ready_mins': rand.randint(10, 120)}
+                     for recipe_id in range(1, recipes + 1)))
+
+    def recipe_ingredients():
+        for recipe_id in range(1, recipes + 1):
+            for ingredient_id, name in rand.sample(ingredients, rand.randint(6, 14)):
+                yield {'recipe_id': recipe_id, 'ingredient_id': ingredient_id, 'name': name,
+                       'amount': round(rand.uniform(0.25, 4), 2), 'unit': rand.choice(['cup', 'tbsp', 'g', ''])}
+
+    def instructions():
+        for recipe_id in range(1, recipes + 1):
+            for step_num in range(1, rand.randint(4, 12) + 1):
+                yield {'recipe_id': recipe_id, 'step_num': step_num,
+                       'step_instruction': f'Step {step_num}: stir everything together and cook until done.'}
+
+    def equipment():
+        for recipe_id in range(1, recipes + 1):
+            for name in rand.sample(EQUIPMENT, rand.randint(1, 5)):
+                yield {'recipe_id': recipe_id, 'equipment': name}
+
+    def saved_recipes():
+        for user_id in range(1, users + 1):
+            for recipe_id in rand.sample(range(1, recipes + 1), saves_per_user):
+                yield {'user_id': user_id, 'recipe_id': recipe_id, 'favorite': rand.random() < 0.2,
+                       'tried': rand.random() < 0.5, 'rating': rand.randint(1, 5), 'comment': 'Tasty!'}
+
+    _insert(Recipe_Ingredient, recipe_ingredients())
+    _insert(Instructions, instructions())
+    _insert(Equipment, equipment())
+    _insert(Saved_Recipe, saved_recipes())
+
+    return users, recipes, saves_per_user
+
+
+def _insert(model, rows):
+    """Insert rows from an iterable with executemany batches, committing each batch."""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_ROWS:
+            db.session.execute(model.__table__.insert(), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(model.__table__.insert(), batch)
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    from server import app
+    from model import connect_to_db
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--db', default='postgresql:///recipes_bench')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db, echo=False)
+    with app.app_context():
+        db.create_all()
+        users, recipes, saves_per_user = generate(args.rows, args.seed)
+    print(f'{users} users, {recipes} recipes, {saves_per_user} saved recipes per user')
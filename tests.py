@@ -1,12 +1,1014 @@
+import gzip
+import os
+import re
+import tempfile
+import threading
+import time
+
+# server reads api keys at import
+os.environ.setdefault('SPOONACULAR_KEY', 'test-key')
+os.environ.setdefault('TWILIO_SID', 'test-sid')
+os.environ.setdefault('TWILIO_TOKEN', 'test-token')
+
 from unittest import TestCase
+import server
 from server import app
-from model import connect_to_db, db
-from flask import session
+from model import connect_to_db, db, User, Recipe, Saved_Recipe, Ingredient, Outbound_Message
 from flask_debugtoolbar import DebugToolbarExtension
-import pdb
 
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError
+
+import assets
+import catalog_warmer
+import crud
+import helper_functions
+import ingredient_index
+import message_queue
+import migrations
+import recipe_cache
+import saved_index
+import search_cache
+import search_index
+from db_routing import pool_stats
+from ingredient_resolver import IngredientResolver
+from spoonacular import SpoonacularClient, SpoonacularError
+from spoonacular_stub import StubServer
+
+
+connect_to_db(app, 'sqlite://', echo=False)
+
+
+def example_recipe(recipe_id, num_ingredients=5, num_steps=4, num_equipment=2):
+    """Return recipe details shaped like parse_API_recipe_details."""
+
+    return {'recipe_id': recipe_id,
+            'title': f'Recipe {recipe_id}',
+            'image': f'https://img.example/{recipe_id}.jpg',
+            'servings': 2,
+            'sourceUrl': f'https://example.com/{recipe_id}',
+            'cooking_mins': 20,
+            'prep_mins': 10,
+            'ready_mins': 30,
+            'ingredients': [{'ingredient_id': 1000 + i, 'name': f'ingredient {i}',
+                             'amount': 1.5, 'unit': 'cup'}
+                            for i in range(num_ingredients)],
+            'instructions': [f'step {step}' for step in range(num_steps)],
+            'equipment': {f'tool {i}': f'tool {i}' for i in range(num_equipment)}}
+
+
+class QueryCounter:
+    """Count SQL statements, and rows each SELECT returns, run inside the block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def rows(self):
+        """Total rows fetched by the recorded SELECTs (re-run as counts)."""
+
+        total = 0
+        for statement, parameters in self.statements:
+            if statement.lstrip().upper().startswith('SELECT'):
+                total += self.engine.execute(f'SELECT count(*) FROM ({statement})',
+                                             parameters).scalar()
+        return total
+
+
+class DbTestCase(TestCase):
+    """Fresh in-memory db in a pushed app context, with cook@example.com as user 1 logged in on self.client.
+
+    Subclasses turn off create_user or log_in when they need to set those up themselves."""
+
+    create_user = True
+    log_in = True
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+        if self.create_user:
+            crud.create_user('cook@example.com', 'password', '+15555555555')
+
+        self.client = app.test_client()
+        if self.log_in:
+            with self.client.session_transaction() as sess:
+                sess['email'] = 'cook@example.com'
+                sess['user_id'] = 1
+
+    def tearDown(self):
+        saved_index.index.invalidate(1)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+
+
+class LoadProfileTests(DbTestCase):
+    """Hot crud calls load only what they need, without cartesian joins."""
+
+    def setUp(self):
+        super().setUp()
+        self.user_id = 1
+        for recipe_id in (1, 2, 3):
+            crud.create_recipe_with_details(example_recipe(recipe_id))
+            crud.save_a_recipe(self.user_id, recipe_id, False)
+        db.session.expire_all()
+
+    def assertQueries(self, func, statements, rows):
+        db.session.expire_all()
+        with QueryCounter(db.engine) as counter:
+            func()
+        self.assertEqual(counter.count, statements)
+        self.assertEqual(counter.rows, rows)
+
+    def test_get_saved_recipes(self):
+        # saved recipes + recipe, then one query each for ingredients, instructions, equipment
+        self.assertQueries(lambda: crud.get_saved_recipes(self.user_id),
+                           statements=4, rows=3 + 3 * 5 + 3 * 4 + 3 * 2)
+
+    def test_get_a_saved_recipe(self):
+        # only the saved row: update_user_thoughts sets its own columns
+        self.assertQueries(lambda: crud.get_a_saved_recipe(2, self.user_id).saved_id,
+                           statements=1, rows=1)
+
+    def test_get_recipe(self):
+        self.assertQueries(lambda: crud.get_recipe(2), statements=4, rows=1 + 5 + 4 + 2)
+
+    def test_quick_get_recipe(self):
+        self.assertQueries(lambda: crud.quick_get_recipe(2), statements=1, rows=1)
+
+    def test_get_login(self):
+        self.assertQueries(lambda: crud.get_login('cook@example.com').password,
+                           statements=1, rows=1)
+
+
+
+class SavedRecipeIndexTests(DbTestCase):
+    """Saved checks answer from the per-user membership index."""
+
+    def setUp(self):
+        super().setUp()
+        for recipe_id in (101, 102):
+            crud.create_recipe_with_details(example_recipe(recipe_id))
+        crud.save_a_recipe(1, 102, False)
+
+    def check(self, *recipe_ids):
+        res = self.client.post('/api/check_results',
+                               json={'results_list': [{'recipe_id': recipe_id} for recipe_id in recipe_ids]})
+        return {recipe['recipe_id']: recipe['is_saved'] for recipe in res.get_json()['checked_recipes']}
+
+    def test_check_results_by_recipe_id(self):
+        self.assertEqual(self.check(101, 102), {101: False, 102: True})
+
+    def test_save_invalidates_index(self):
+        self.assertEqual(self.check(101), {101: False})
+        self.client.post('/api/save_a_recipe', json={'recipe_id': 101})
+        self.assertEqual(self.check(101), {101: True})
+
+    def test_load_racing_invalidate_not_stored(self):
+        index = saved_index.SavedRecipeIndex()
+        load = crud.get_saved_recipe_ids
+
+        def load_then_save(user_id):
+            saved = load(user_id)
+            # another request saves a recipe after this one read the old rows
+            crud.save_a_recipe(1, 101, False)
+            index.invalidate(user_id)
+            return saved
+
+        crud.get_saved_recipe_ids = load_then_save
+        try:
+            self.assertEqual(index.get(1), {102: False})
+        finally:
+            crud.get_saved_recipe_ids = load
+        self.assertEqual(index.get(1), {101: False, 102: False})
+
+
+
+class SearchIndexTests(DbTestCase):
+    """Local search ranks stored recipes by the searched ingredients they use."""
+
+    def setUp(self):
+        super().setUp()
+        for recipe_id, ingredient_ids in ((1, [1, 2, 3]), (2, [1, 2]), (3, [1, 4, 5, 6])):
+            recipe = example_recipe(recipe_id)
+            recipe['ingredients'] = [{'ingredient_id': ingredient_id, 'name': f'Ingredient {ingredient_id}',
+                                      'amount': 1, 'unit': 'cup'}
+                                     for ingredient_id in ingredient_ids]
+            crud.create_recipe_with_details(recipe)
+        self.index = search_index.IngredientSearchIndex()
+        self.index.ensure_built()
+
+    def test_ranked_by_used_then_missing(self):
+        results = self.index.search({1, 2})
+
+        self.assertEqual([recipe_id for recipe_id, _, _ in results], [2, 1, 3])
+        self.assertEqual(results[1], (1, {1, 2}, {3}))
+        self.assertEqual(len(self.index.search({1, 2}, number=1)), 1)
+
+    def test_resolve_names(self):
+        self.assertEqual(self.index.resolve_names([' ingredient 4', 'INGREDIENT 5', 'unknown']), {4, 5})
+
+    def test_add_recipe(self):
+        self.index.add_recipe(4, [{'ingredient_id': 7, 'name': 'ingredient 7'}])
+
+        self.assertEqual(self.index.search({7}), [(4, {7}, set())])
+        self.assertEqual(self.index.resolve_names(['ingredient 7']), {7})
+
+    def test_concurrent_first_use_builds_once(self):
+        index = search_index.IngredientSearchIndex()
+        builds = []
+        build = index.build
+
+        def slow_build():
+            builds.append(1)
+            time.sleep(0.05)
+            build()
+
+        index.build = slow_build
+        threads = [threading.Thread(target=index.ensure_built) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(builds), 1)
+
+    def test_parse_db_search_result(self):
+        recipe = crud.get_recipes_by_ids([1])[0]
+        result = helper_functions.parse_db_search_result(recipe, {1, 2})
+
+        self.assertEqual(result['recipe_id'], 1)
+        self.assertEqual([ingredient['ingredient_id'] for ingredient in result['ingredients']], [1, 2, 3])
+        self.assertEqual(result['missing_ingredients'], [{'name': 'Ingredient 3', 'amount': 1, 'unit': 'cup'}])
+        self.assertEqual(result['instructions'], ['step 0', 'step 1', 'step 2', 'step 3'])
+
+
+
+class SerializerTests(DbTestCase):
+    """Saved recipe routes build their JSON from column rows."""
+
+    def setUp(self):
+        super().setUp()
+        crud.create_recipe_with_details(example_recipe(7, num_ingredients=2, num_steps=2, num_equipment=1))
+        crud.save_a_recipe(1, 7, True)
+        crud.update_thoughts(crud.get_a_saved_recipe(7, 1), rating=3)
+        recipe_cache.cache.clear()
+
+    def test_saved_recipe_details(self):
+        details = self.client.get('/api/saved_recipe_details/7').get_json()['recipe_details']
+
+        self.assertEqual(details['title'], 'Recipe 7')
+        self.assertEqual(details['instructions'], ['step 0', 'step 1'])
+        self.assertEqual(details['equipment'], {'tool 0': 'tool 0'})
+        self.assertEqual([ingredient['name'] for ingredient in details['ingredients']],
+                         ['ingredient 0', 'ingredient 1'])
+        self.assertTrue(details['favorite'])
+
+    def test_user_thoughts(self):
+        thoughts = self.client.get('/api/user_thoughts/7').get_json()['thoughts']
+
+        self.assertEqual(thoughts['rating'], [1, 2, 3])
+        self.assertEqual(thoughts['recipe_id'], 7)
+
+    def test_recipe_document_cached(self):
+        self.client.get('/api/saved_recipe_details/7')
+        with QueryCounter(db.engine) as counter:
+            details = self.client.get('/api/saved_recipe_details/7').get_json()['recipe_details']
+        # only the user's data_version and own fields are read
+        self.assertEqual(counter.count, 2)
+        # same stars shape as user_thoughts
+        self.assertEqual((details['title'], details['rating']), ('Recipe 7', [1, 2, 3]))
+
+    def test_saved_recipes_pages(self):
+        crud.create_recipe_with_details(example_recipe(8))
+        crud.save_a_recipe(1, 8, False)
+
+        first = self.client.get('/api/saved_recipes?limit=1').get_json()
+        second = self.client.get(f'/api/saved_recipes?limit=1&cursor={first["next_cursor"]}').get_json()
+        self.assertEqual([recipe['recipe_id'] for recipe in first['saved_recipes'] + second['saved_recipes']], [7, 8])
+        self.assertIsNone(second['next_cursor'])
+
+        res = self.client.get('/api/saved_recipes?cursor=abc')
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(res.get_json()['success'])
+
+    def test_other_users_etag_survives_remove(self):
+        crud.create_user('other@example.com', 'password', '+15555555556')
+        crud.save_a_recipe(2, 7, False)
+        other = app.test_client()
+        with other.session_transaction() as sess:
+            sess['user_id'] = 2
+        first = other.get('/api/saved_recipes')
+        etag = first.headers['ETag']
+        # read the streamed body, so its request context is popped now
+        self.assertEqual(len(first.get_json()['saved_recipes']), 1)
+
+        self.client.post('/api/remove_recipe', json={'recipe_id': 7})
+        # user 2's saves didn't change, so their cached page is still right
+        self.assertEqual(other.get('/api/saved_recipes', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(len(other.get('/api/saved_recipes').get_json()['saved_recipes']), 1)
+        self.assertEqual(self.client.get('/api/saved_recipes').get_json()['saved_recipes'], [])
+
+    def test_remove_keeps_recipe_in_catalog(self):
+        crud.create_user('other@example.com', 'password', '+15555555556')
+        crud.save_a_recipe(2, 7, False)
+
+        res = self.client.post('/api/remove_recipe', json={'recipe_id': 7}).get_json()
+        self.assertTrue(res['success'])
+        self.assertEqual(crud.get_saved_recipe_ids(1), {})
+        # the other user's save and the catalog row are untouched
+        self.assertEqual(crud.get_saved_recipe_ids(2), {7: False})
+        self.assertEqual(Recipe.query.count(), 1)
+        self.assertFalse(self.client.post('/api/remove_recipe', json={'recipe_id': 7}).get_json()['success'])
+
+    def test_unchanged_reads_not_modified(self):
+        first = self.client.get('/api/user_thoughts/7')
+        etag = first.headers['ETag']
+        self.assertIn('no-cache', first.headers['Cache-Control'])
+
+        with QueryCounter(db.engine) as counter:
+            res = self.client.get('/api/user_thoughts/7', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        # only data_version is read
+        self.assertEqual(counter.count, 1)
+
+        self.client.post('/api/update_user_thoughts', json={'recipe_id': 7, 'comment': 'more salt'})
+        res = self.client.get('/api/user_thoughts/7', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.get_json()['thoughts']['comment'], 'more salt')
+
+    def test_favorite(self):
+        version = crud.get_data_version(1)
+        # already a favorite, nothing changes
+        self.assertTrue(self.client.post('/api/favorite_a_recipe', json={'recipe_id': 7}).get_json()['success'])
+        self.assertEqual(crud.get_data_version(1), version)
+
+        res = self.client.post('/api/favorite_a_recipe', json={'recipe_id': 8})
+        self.assertEqual(res.status_code, 404)
+        self.assertIsNone(crud.favorite_a_recipe(8, 1))
+
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        self.assertEqual(self.client.post('/api/favorite_a_recipe', json={'recipe_id': 7}).status_code, 401)
+
+    def test_update_thoughts_in_one_commit(self):
+        with QueryCounter(db.engine) as counter:
+            res = self.client.post('/api/update_user_thoughts',
+                                   json={'recipe_id': 7, 'tried': True, 'rating': 5, 'comment': 'more salt'})
+        self.assertTrue(res.get_json()['success'])
+        # saved row, its update, one data_version bump
+        self.assertEqual(counter.count, 3)
+        thoughts = self.client.get('/api/user_thoughts/7').get_json()['thoughts']
+        self.assertEqual((thoughts['tried'], thoughts['rating'], thoughts['comment']), (True, [1, 2, 3, 4, 5], 'more salt'))
+
+        res = self.client.post('/api/update_user_thoughts', json={'recipe_id': 8, 'rating': 5})
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(res.get_json()['success'])
+
+
+
+class SessionIdentityTests(DbTestCase):
+    """Logged in requests identify the user from the session's user_id, without reading users."""
+
+    log_in = False
+
+    def setUp(self):
+        super().setUp()
+        crud.create_recipe_with_details(example_recipe(1))
+        crud.save_a_recipe(1, 1, False)
+
+    def test_login_keeps_user_id(self):
+        self.client.post('/api/login', json={'email': 'cook@example.com', 'password': 'password'})
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess['user_id'], 1)
+
+        with QueryCounter(db.engine) as counter:
+            thoughts = self.client.get('/api/user_thoughts/1').get_json()['thoughts']
+        self.assertEqual(thoughts['recipe_id'], 1)
+        # data_version for the ETag, then the saved recipe; no identity lookup
+        self.assertEqual(counter.count, 2)
+        self.assertNotIn('users.email', ' '.join(statement for statement, _ in counter.statements))
+
+    def test_logged_out_shopping_list(self):
+        res = self.client.post('/api/shopping-list', json={'shopping_list': {'egg': True}, 'recipe_title': 'Omelette'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(res.get_json()['success'])
+
+    def test_email_only_session_gets_user_id(self):
+        with self.client.session_transaction() as sess:
+            sess['email'] = 'cook@example.com'
+
+        self.assertTrue(self.client.get('/api/check_session').get_json()['in_session'])
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess['user_id'], 1)
+
+
+
+class BatchTests(DbTestCase):
+    """Batched operations share one transaction and see each other's results."""
+
+    def batch(self, *operations):
+        return self.client.post('/api/batch', json={'operations': list(operations)})
+
+    def test_save_then_check(self):
+        res = self.batch({'path': '/api/add_recipe', 'body': {'recipe_details': example_recipe(5)}},
+                         {'id': 'save', 'path': '/api/save_a_recipe', 'body': {'recipe_id': 5}},
+                         {'path': '/api/check_results', 'body': {'results_list': [{'recipe_id': 5}]}})
+        results = res.get_json()['results']
+
+        self.assertEqual([result['status'] for result in results], [200, 200, 200])
+        self.assertTrue(results[1]['body']['success'])
+        self.assertTrue(results[2]['body']['checked_recipes'][0]['is_saved'])
+        self.assertEqual(Saved_Recipe.query.count(), 1)
+
+    def test_failed_operation_rolls_back_batch(self):
+        res = self.batch({'path': '/api/add_recipe', 'body': {'recipe_details': example_recipe(5)}},
+                         {'path': '/api/save_a_recipe', 'body': {'recipe_id': 5}},
+                         # the db can't store a list as the comment, so the view fails
+                         {'path': '/api/update_user_thoughts', 'body': {'recipe_id': 5, 'comment': ['salt']}})
+
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual((Recipe.query.count(), Saved_Recipe.query.count()), (0, 0))
+        # caches only hear about committed writes
+        self.assertNotIn((recipe_cache.DETAILS, 5), recipe_cache.cache._documents)
+        self.assertNotIn(5, search_index.index._recipes)
+
+    def test_malformed_batch_is_a_client_error(self):
+        bad_bodies = [[{'path': '/api/check_session'}],
+                      {'operations': ['/api/check_session']},
+                      {'operations': [{'path': '/metrics'}]},
+                      {'operations': [{'path': '/api/check_results', 'body': {'results_list': {'$ref': 'search'}}}]}]
+        for body in bad_bodies:
+            res = self.client.post('/api/batch', json=body)
+            self.assertEqual(res.status_code, 400, body)
+            self.assertFalse(res.get_json()['success'])
+
+    def test_logged_out_batch(self):
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        res = self.batch({'path': '/api/check_session'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(None, saved_index.index._generations)
+
+    def test_view_error_is_a_server_error(self):
+        # a bug in a view isn't blamed on the request
+        res = self.batch({'path': '/api/add_recipe', 'body': {'recipe_details': example_recipe(5)}},
+                         {'path': '/api/check_results', 'body': {'results_list': [[]]}})
+
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(Recipe.query.count(), 0)
+
+
+
+class SaveRecipesTests(DbTestCase):
+    """Saving many recipes adds only the missing ones with a fixed number of statements."""
+
+    def setUp(self):
+        super().setUp()
+        crud.create_recipe_with_details(example_recipe(1))
+        crud.create_recipe_with_details(example_recipe(2))
+        crud.save_a_recipe(1, 2, False)
+
+    def test_save_recipes(self):
+        page = [example_recipe(recipe_id) for recipe_id in range(1, 11)]
+        with QueryCounter(db.engine) as counter:
+            res = self.client.post('/api/save_recipes', json={'recipe_details': page}).get_json()
+
+        self.assertEqual((res['added'], res['saved']), (8, 9))
+        self.assertEqual(crud.get_saved_recipe_ids(1), {recipe_id: False for recipe_id in range(1, 11)})
+        self.assertEqual(len(crud.get_recipe_children_columns(10)[0]), 5)
+        # existing recipes, 8 recipe rows (no RETURNING on sqlite), children, saves, data_version
+        self.assertEqual(counter.count, 14)
+
+    def test_create_recipe_twice(self):
+        self.assertTrue(crud.create_recipe_with_details(example_recipe(11)))
+        self.assertFalse(crud.create_recipe_with_details(example_recipe(11)))
+        self.assertEqual(len(crud.get_recipe_children_columns(11)[0]), 5)
+
+    def test_child_insert_error_raised(self):
+        insert_children = crud._insert_recipe_children
+
+        def fail(recipe_details_list):
+            raise IntegrityError('INSERT INTO recipe_ingredients', {}, Exception('constraint failed'))
+
+        crud._insert_recipe_children = fail
+        try:
+            with self.assertRaises(IntegrityError):
+                crud.create_recipe_with_details(example_recipe(11))
+        finally:
+            crud._insert_recipe_children = insert_children
+        # not reported as saved by someone else, and the recipe row is rolled back
+        self.assertIsNone(Recipe.query.get(11))
+
+
+
+class CatalogWarmerTests(DbTestCase):
+    """Search result recipes are added to the catalog from a bounded queue."""
+
+    def setUp(self):
+        super().setUp()
+        crud.create_recipe_with_details(example_recipe(1))
+
+    def test_adds_new_recipes_once(self):
+        warmer = catalog_warmer.CatalogWarmer(app)
+        results = [example_recipe(recipe_id) for recipe_id in (1, 2, 3)]
+
+        self.assertEqual(warmer.offer(results), 3)
+        self.assertEqual(warmer.run_once(), 2)
+        self.assertEqual(Recipe.query.count(), 3)
+        self.assertEqual(len(crud.get_recipe_children_columns(3)[1]), 4)
+        # same search again doesn't queue them again
+        self.assertEqual(warmer.offer(results), 0)
+
+    def test_full_queue_drops(self):
+        warmer = catalog_warmer.CatalogWarmer(app, max_queue=2)
+
+        self.assertEqual(warmer.offer([example_recipe(recipe_id) for recipe_id in (2, 3, 4)]), 2)
+        self.assertEqual(warmer.stats(), {'queue_depth': 2, 'added': 0, 'dropped': 1})
+
+
+
+class MessageQueueTests(DbTestCase):
+    """Queued messages are sent by the worker pool, combined per number and retried."""
+
+    def setUp(self):
+        super().setUp()
+        self.transport = message_queue.FakeTransport()
+        self.pool = message_queue.MessageWorkerPool(app, self.transport, max_attempts=2, backoff=0)
+
+    def status(self, message_id):
+        return Outbound_Message.query.get(message_id).status
+
+    def test_sends_combined_per_number(self):
+        first = crud.queue_message('+15555555555', 'eggs')
+        second = crud.queue_message('+15555555555', 'milk')
+
+        self.assertEqual(self.pool.run_once(), 2)
+        self.assertEqual(self.transport.sent, [('+15555555555', 'eggs\n\nmilk')])
+        db.session.expire_all()
+        self.assertEqual((self.status(first), self.status(second)), ('sent', 'sent'))
+
+    def test_retries_then_fails(self):
+        message_id = crud.queue_message('+15555555555', 'eggs')
+
+        self.transport.failure_rate = 1
+        self.pool.run_once()
+        db.session.expire_all()
+        self.assertEqual(self.status(message_id), 'queued')
+
+        # out of attempts
+        self.pool.run_once()
+        db.session.expire_all()
+        self.assertEqual(self.status(message_id), 'failed')
+        self.assertEqual((self.transport.failed, self.transport.sent), (2, []))
+
+    def test_transient_failure_sent_on_retry(self):
+        message_id = crud.queue_message('+15555555555', 'eggs')
+
+        self.transport.failure_rate = 1
+        self.pool.run_once()
+        self.transport.failure_rate = 0
+        self.pool.run_once()
+
+        db.session.expire_all()
+        self.assertEqual(self.status(message_id), 'sent')
+        self.assertEqual(self.transport.sent, [('+15555555555', 'eggs')])
+
+    def test_long_bodies_split(self):
+        for item in 'abc':
+            crud.queue_message('+15555555555', item * 700)
+
+        self.assertEqual(self.pool.run_once(), 3)
+        # two fit in one SMS with the blank line between them, the third goes alone
+        self.assertEqual([len(body) for number, body in self.transport.sent], [1402, 700])
+        self.assertTrue(all(len(body) <= message_queue.MAX_BODY_CHARS for number, body in self.transport.sent))
+
+
+
+class AssetTests(TestCase):
+    """The built bundle is served precompressed, with immutable cache headers."""
+
+    def setUp(self):
+        self.dist_dir = assets.DIST_DIR
+        assets.DIST_DIR = tempfile.mkdtemp()
+        self.name = assets.build(compile=lambda source: source)
+
+    def tearDown(self):
+        assets.DIST_DIR = self.dist_dir
+
+    def test_root_page_loads_bundle(self):
+        page = app.test_client().get('/').get_data(as_text=True)
+
+        self.assertIn(f'<script src="/assets/{self.name}"></script>', page)
+        self.assertNotIn('babel', page)
+
+    def test_picks_encoding(self):
+        client = app.test_client()
+        plain = client.get(f'/assets/{self.name}', headers={'Accept-Encoding': 'identity'})
+        gzipped = client.get(f'/assets/{self.name}', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.get_data()), plain.get_data())
+        self.assertIn('immutable', gzipped.headers['Cache-Control'])
+        self.assertEqual(gzipped.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(client.get('/assets/missing.js').status_code, 404)
+
+
+
+class CompressionTests(DbTestCase):
+    """Large /api responses are gzipped for browsers that accept it, streamed ones chunk by chunk."""
+
+    def setUp(self):
+        super().setUp()
+        crud.save_recipes(1, [example_recipe(recipe_id) for recipe_id in range(1, 21)])
+
+    def get_both(self, *args, **kwargs):
+        plain = self.client.open(*args, **kwargs)
+        gzipped = self.client.open(*args, headers={'Accept-Encoding': 'gzip'}, **kwargs)
+        return plain, gzipped
+
+    def test_large_json_gzipped(self):
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        plain, gzipped = self.get_both('/api/check_results', method='POST',
+                                       json={'results_list': [example_recipe(recipe_id) for recipe_id in range(20)]})
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzipped.headers['Vary'], 'Accept-Encoding')
+        self.assertLess(len(gzipped.get_data()), len(plain.get_data()) / 5)
+        self.assertEqual(gzip.decompress(gzipped.get_data()), plain.get_data())
+
+        small = self.client.get('/api/check_session', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(small.headers.get('Content-Encoding'))
+
+    def test_streamed_response_gzipped(self):
+        plain, gzipped = self.get_both('/api/saved_recipes')
+
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.get_data()), plain.get_data())
+        self.assertEqual(len(plain.get_json()['saved_recipes']), 20)
+
+
+
+class ReplicaRoutingTests(DbTestCase):
+    """Read-only routes read from a replica until the browser session writes."""
+
+    create_user = False
+
+    def setUp(self):
+        app.config['SQLALCHEMY_BINDS'] = {'replica_0': 'sqlite://'}
+        super().setUp()
+        self.replica = db.get_engine(app, bind='replica_0')
+        db.Model.metadata.create_all(bind=self.replica)
+
+        # replica has a saved recipe the primary doesn't
+        for engine in (db.engine, self.replica):
+            engine.execute(User.__table__.insert(), user_id=1, email='cook@example.com',
+                           password='password', phone='+15555555555')
+            engine.execute(Recipe.__table__.insert(), [{'recipe_id': 101, 'title': 'a'},
+                                                       {'recipe_id': 102, 'title': 'b'}])
+        self.replica.execute(Saved_Recipe.__table__.insert(), user_id=1, recipe_id=101)
+
+    def tearDown(self):
+        db.Model.metadata.drop_all(bind=self.replica)
+        super().tearDown()
+        app.config['SQLALCHEMY_BINDS'] = {}
+
+    def check(self, *recipe_ids):
+        res = self.client.post('/api/check_results',
+                               json={'results_list': [{'recipe_id': recipe_id} for recipe_id in recipe_ids]})
+        return {recipe['recipe_id']: recipe['is_saved'] for recipe in res.get_json()['checked_recipes']}
+
+    def test_reads_go_to_replica_until_a_write(self):
+        self.assertEqual(self.check(101, 102), {101: True, 102: False})
+
+        self.client.post('/api/save_a_recipe', json={'recipe_id': 102})
+        # primary only has the new save, the write made this session sticky
+        self.assertEqual(self.check(101, 102), {101: False, 102: True})
+
+
+
+class MigrationTests(DbTestCase):
+    """Migrations bring an index-less database up to date; hot queries then use indexes."""
+
+    INDEXES = ['ix_users_email', 'ix_saved_recipes_user_id_recipe_id', 'ix_recipe_ingredients_recipe_id',
+               'ix_recipe_ingredients_ingredient_id', 'ix_instructions_recipe_id', 'ix_equipment_recipe_id']
+
+    create_user = False
+
+    def setUp(self):
+        super().setUp()
+        crud.create_recipe_with_details(example_recipe(1))
+
+    def tearDown(self):
+        db.engine.execute('DROP TABLE IF EXISTS schema_migrations')
+        db.engine.execute('DROP TABLE IF EXISTS merged_users')
+        super().tearDown()
+
+    def test_hot_queries_use_indexes(self):
+        crud.create_user('cook@example.com', 'password', '+15555555555')
+        crud.save_a_recipe(1, 1, False)
+
+        self.assertEqual(migrations.check_index_usage(1, 1), [])
+
+    def test_migrate_old_schema(self):
+        # database as seeded from recipes.sql: no indexes, duplicate accounts and saves
+        for index in self.INDEXES:
+            db.engine.execute(f'DROP INDEX {index}')
+        for user_id in (1, 2):
+            db.engine.execute(User.__table__.insert(), user_id=user_id, email='cook@example.com',
+                              password='password', phone='+15555555555')
+        for user_id in (1, 2, 1):
+            db.engine.execute(Saved_Recipe.__table__.insert(), user_id=user_id, recipe_id=1)
+        self.assertNotEqual(migrations.check_index_usage(1, 1), [])
+        db.engine.execute('ALTER TABLE users DROP COLUMN data_version')
+
+        self.assertEqual(migrations.migrate(), [1, 2, 3, 4])
+        self.assertEqual(migrations.migrate(), [])
+
+        self.assertEqual(db.engine.execute('SELECT user_id, recipe_id FROM saved_recipes').fetchall(), [(1, 1)])
+        # the merged account is kept aside
+        self.assertEqual(db.engine.execute('SELECT user_id, kept_user_id, email FROM merged_users').fetchall(),
+                         [(2, 1, 'cook@example.com')])
+        self.assertEqual(migrations.check_index_usage(1, 1), [])
+        # saving twice is a no-op now
+        self.assertFalse(crud.save_a_recipe(1, 1, False))
+
+
+
+class IngredientCatalogTests(DbTestCase):
+    """Autocomplete suggests ingredients with a word starting with what was typed."""
+
+    def setUp(self):
+        super().setUp()
+        self.add_ingredients((1, 'sausage'), (2, 'soy sauce'), (3, 'sauerkraut'), (4, 'salt'), (5, 'garlic salt'))
+        self.catalog = ingredient_index.IngredientCatalog(app)
+        self.catalog.load()
+
+    def add_ingredients(self, *ingredients):
+        db.session.add_all(Ingredient(ingredient_id=ingredient_id, name=name) for ingredient_id, name in ingredients)
+        db.session.commit()
+
+    def test_name_starts_before_word_starts(self):
+        self.assertEqual(self.catalog.index.suggest('sau'), [(3, 'sauerkraut'), (1, 'sausage'), (2, 'soy sauce')])
+        self.assertEqual(self.catalog.index.suggest(' SALT'), [(4, 'salt'), (5, 'garlic salt')])
+        self.assertEqual(self.catalog.index.suggest('alt'), [])
+        self.assertEqual(self.catalog.index.suggest(''), [])
+
+    def test_k_limits_suggestions(self):
+        self.assertEqual(self.catalog.index.suggest('s', k=2), [(4, 'salt'), (3, 'sauerkraut')])
+
+    def test_rebuilt_in_background_when_table_changes(self):
+        self.catalog.refresh_secs = 0
+        self.add_ingredients((6, 'saffron'))
+
+        # answered from the old index while the new one builds
+        self.assertEqual(self.catalog.suggest('saf'), [])
+        deadline = time.monotonic() + 5
+        while self.catalog._version != crud.get_ingredients_version() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.catalog.suggest('saf'), [{'ingredient_id': 6, 'name': 'saffron'}])
+
+    def test_autocomplete_route(self):
+        catalog, server.INGREDIENTS = server.INGREDIENTS, self.catalog
+        try:
+            suggestions = self.client.get('/api/ingredients/autocomplete?q=sa&k=2').get_json()['suggestions']
+        finally:
+            server.INGREDIENTS = catalog
+
+        self.assertEqual(suggestions, [{'ingredient_id': 4, 'name': 'salt'},
+                                       {'ingredient_id': 3, 'name': 'sauerkraut'}])
+
+
+
+class IngredientResolverTests(TestCase):
+    """Typed ingredients are matched to the catalog by spelling only."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.resolver = IngredientResolver(ingredient_index.load_csv_ingredients())
+
+    def resolved_name(self, token):
+        match = self.resolver.resolve(token)
+        return match and match[1]
+
+    def test_typos_fixed(self):
+        self.assertEqual(self.resolved_name('brocoli'), 'broccoli')
+        self.assertEqual(self.resolved_name(' Brown  Sugr'), 'brown sugar')
+        self.assertEqual(self.resolved_name('chiken breast'), 'chicken breasts')
+
+    def test_plurals_matched(self):
+        self.assertEqual(self.resolver.resolve('onions'), (11282, 'onion', 0.99))
+        self.assertEqual(self.resolved_name('tomatos'), 'tomatoes')
+        self.assertEqual(self.resolved_name('bell peppers'), 'bell pepper')
+
+    def test_correct_names_kept_as_typed(self):
+        # each is close to a different ingredient in the list
+        for token in ('salmon', 'garlic cloves', 'basil leaves', 'heavy cream', 'egg'):
+            self.assertIsNone(self.resolver.resolve(token), token)
+
+
+
+class SearchCacheTests(TestCase):
+    """complexSearch responses are cached by normalized request, with TTL, LRU and single-flight misses."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.sqlite3')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_ignores_order_case_and_api_key(self):
+        key = search_cache.make_key({'includeIngredients': 'egg, Milk', 'number': 10, 'apiKey': 'a'})
+
+        self.assertEqual(search_cache.make_key({'includeIngredients': 'milk,  egg,egg,', 'number': 10, 'apiKey': 'b'}), key)
+        self.assertNotEqual(search_cache.make_key({'includeIngredients': 'egg, milk', 'number': 20}), key)
+
+    def test_expired_entries_missed(self):
+        for backend in (search_cache.MemoryBackend(), search_cache.SQLiteBackend(self.path)):
+            backend.set('old', [1], ttl=-1)
+            backend.set('new', [2], ttl=60)
+            self.assertIsNone(backend.get('old'))
+            self.assertEqual(backend.get('new'), [2])
+
+    def test_least_recently_used_evicted(self):
+        for backend in (search_cache.MemoryBackend(max_entries=2),
+                        search_cache.SQLiteBackend(self.path, max_entries=2, touch_interval=0)):
+            backend.set('a', [1], ttl=60)
+            backend.set('b', [2], ttl=60)
+            backend.get('a')
+            backend.set('c', [3], ttl=60)
+            self.assertEqual(len(backend), 2)
+            self.assertIsNone(backend.get('b'))
+            self.assertEqual(backend.get('a'), [1])
+
+    def test_sqlite_hits_skip_recent_touch(self):
+        backend = search_cache.SQLiteBackend(self.path)
+        backend.set('a', [1], ttl=60)
+        conn = backend._conn()
+        writes = conn.total_changes
+
+        self.assertEqual(backend.get('a'), [1])
+        self.assertEqual(conn.total_changes, writes)
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = search_cache.ResponseCache(search_cache.MemoryBackend())
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return ['result']
+
+        threads = [threading.Thread(target=lambda: cache.get_or_fetch('key', fetch)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while cache.coalesced < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.misses, cache.coalesced), (1, 1))
+        self.assertEqual(cache.get_or_fetch('key', fetch), ['result'])
+        self.assertEqual(cache.hits, 1)
+
+
+
+class SpoonacularClientTests(TestCase):
+    """Client retries, times out, and fans out against the local stub server."""
+
+    def test_retries_server_errors(self):
+        with StubServer(failures=2) as stub:
+            client = SpoonacularClient('key', base_url=stub.url, backoff=0.01)
+            results = client.complex_search({'includeIngredients': 'egg', 'number': 3})
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(stub.requests[0][1]['apiKey'], 'key')
+
+    def test_gives_up_after_max_retries(self):
+        with StubServer(failures=10, failure_status=429) as stub:
+            client = SpoonacularClient('key', base_url=stub.url, max_retries=2, backoff=0.01)
+            with self.assertRaises(SpoonacularError):
+                client.complex_search({'includeIngredients': 'egg'})
+
+        self.assertEqual(len(stub.requests), 3)
+
+    def test_quota_error_not_retried(self):
+        with StubServer(failures=1, failure_status=402) as stub:
+            client = SpoonacularClient('secret-key', base_url=stub.url, backoff=0.01)
+            with self.assertRaises(SpoonacularError) as raised:
+                client.complex_search({'includeIngredients': 'egg'})
+
+        self.assertEqual(raised.exception.status, 402)
+        self.assertEqual(len(stub.requests), 1)
+        self.assertNotIn('secret-key', str(raised.exception))
+        self.assertIsNone(raised.exception.__cause__)
+
+    def test_search_falls_back_to_local_results_on_quota_error(self):
+        with StubServer(failures=1, failure_status=402) as stub:
+            spoonacular_client, server.SPOONACULAR = server.SPOONACULAR, SpoonacularClient('key', base_url=stub.url)
+            try:
+                with app.app_context():
+                    db.create_all()
+                    res = app.test_client().post('/api/search_results', json={'ingredients': 'quota test'})
+                    db.drop_all()
+            finally:
+                server.SPOONACULAR = spoonacular_client
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), [])
+
+    def test_read_timeout(self):
+        with StubServer(delay=0.5) as stub:
+            client = SpoonacularClient('key', base_url=stub.url, read_timeout=0.1,
+                                       max_retries=0)
+            with self.assertRaises(SpoonacularError):
+                client.recipe_information(1)
+
+    def test_fan_out_keeps_order(self):
+        with StubServer(delay=0.2) as stub:
+            client = SpoonacularClient('key', base_url=stub.url, max_workers=8)
+            start = time.perf_counter()
+            recipes = client.recipes_information(range(1, 9))
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([recipe['id'] for recipe in recipes], list(range(1, 9)))
+        # eight 0.2s requests run concurrently, not back to back
+        self.assertLess(elapsed, 1.0)
+
+
+
+class InstrumentationTests(DbTestCase):
+    """Requests record per-route SQL counts shown on /metrics."""
+
+    log_in = False
+
+    def test_metrics_count_sql_per_route(self):
+        client = self.client
+        client.post('/api/login', json={'email': 'cook@example.com', 'password': 'password'})
+        metrics = client.get('/metrics').get_data(as_text=True)
+
+        # other tests log in too; every login ran exactly one statement
+        series = '{method="POST",route="/api/login"'
+        logins = re.search(f'fridg_request_sql_statements_count{series}}} (\\d+)', metrics).group(1)
+        self.assertIn(f'fridg_request_sql_statements_bucket{series},le="0"}} 0', metrics)
+        self.assertIn(f'fridg_request_sql_statements_bucket{series},le="1"}} {logins}', metrics)
+        self.assertIn('# TYPE fridg_search_cache_hit_ratio gauge', metrics)
+
+    def test_metrics_not_public(self):
+        self.assertEqual(self.client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code, 403)
+
+        server.METRICS_TOKEN = 'scraper-token'
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            res = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper-token'},
+                                  environ_base={'REMOTE_ADDR': '203.0.113.5'})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            server.METRICS_TOKEN = None
+
+    def test_pool_stats(self):
+        engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=2, max_overflow=0)
+        connection = engine.connect()
 
+        class Db:
+            def engines(self, app):
+                return {None: engine}
 
+        try:
+            stats = {labels['state']: value for labels, value in pool_stats(Db(), app)}
+        finally:
+            connection.close()
+        self.assertEqual(stats, {'checked_out': 1, 'idle': 0, 'overflow': 0, 'size': 2})
 
 
 
@@ -14,4 +1016,4 @@ if __name__ == '__main__':
     app.debug = True
     DebugToolbarExtension(app)
 
-    app.run(host='0.0.0.0')
\ No newline at end of file
+    app.run(host='0.0.0.0')